@@ -1,19 +1,36 @@
-import boto3
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime, timedelta
-import json
+from functools import partial
 import logging
 import configparser
+from classes.acknowledgement_manager import AcknowledgementManager
+from classes.keyed_executor import KeyedExecutor
+from classes.poll_scheduler import PollScheduler
 from classes.s3_object import S3Object
-import s3_functions
+from classes.visibility_heartbeat import VisibilityHeartbeat
+import clients
 from botocore.exceptions import ClientError
 
+# pandas, pyarrow and the merge modules take seconds to import on a cold instance. They are imported on a thread
+# by configure_merge while the first poll waits for messages, the functions below import what they use.
+
+# message body sent for each action on the outgoing queue
+ACTION_MESSAGES = {'stop': 'Stop Instance',
+                   'scale_out': 'Scale Out',
+                   'scale_in': 'Scale In'}
+
 
 def get_object(message_body):
     """
     Takes in the message body as a json object and returns the S3Object parsed from the message body.
     """
     try:
-        parsed_s3_object = S3Object(message_body['Records'][0]['s3']['bucket']['name'], message_body['Records'][0]['s3']['object']['key'])
+        record = message_body['Records'][0]
+        parsed_s3_object = S3Object(record['s3']['bucket']['name'], record['s3']['object']['key'],
+                                    event_time=record.get('eventTime'),
+                                    sequencer=record['s3']['object'].get('sequencer'),
+                                    size=record['s3']['object'].get('size'),
+                                    etag=record['s3']['object'].get('eTag'))
     except KeyError as e:
         # log the error
         logging.info('Handling KeyError: ' + str(e))
@@ -29,15 +46,20 @@ def get_object(message_body):
     return parsed_s3_object
 
 
-def send_sqs_message(ec2_instance_id, outgoing_message_queue_name):
+def send_sqs_message(ec2_instance_id, outgoing_message_queue_name, action='stop', details=None):
+    """
+    Sends the action for the instance on the outgoing queue, details are added as number attributes.
+    """
     # set the sqs resource
-    sqs = boto3.resource('sqs')
-    logging.info('Shutting down EC2')
+    sqs = clients.get_resource('sqs')
+    logging.info('Sending {} for EC2'.format(action))
     queue_shutdown = sqs.get_queue_by_name(QueueName=outgoing_message_queue_name)
     msg_data = {}
-    msg_data['msgBody'] = "Stop Instance"
+    msg_data['msgBody'] = ACTION_MESSAGES[action]
     msg_data['msgAttributes'] = {'instance_id': {'StringValue': ec2_instance_id, 'DataType': 'String'},
-                                'action': {'StringValue': 'stop', 'DataType': 'String'}}
+                                'action': {'StringValue': action, 'DataType': 'String'}}
+    for name, value in (details or {}).items():
+        msg_data['msgAttributes'][name] = {'StringValue': str(value), 'DataType': 'Number'}
     try:
         response = queue_shutdown.send_message(MessageBody=msg_data['msgBody'], MessageAttributes=msg_data['msgAttributes'])
         logging.info(response)
@@ -46,6 +68,46 @@ def send_sqs_message(ec2_instance_id, outgoing_message_queue_name):
     return True
 
 
+def get_heartbeat_interval(queue, visibility_timeout):
+    """
+    Returns the seconds between heartbeats, half the shorter of the queue's VisibilityTimeout and the timeout the
+    heartbeat sets, so a message is extended before either runs out.
+    """
+    try:
+        queue_visibility_timeout = int(queue.attributes.get('VisibilityTimeout', visibility_timeout))
+    except ClientError as e:
+        logging.info('Handling ClientError: {}'.format(e))
+        queue_visibility_timeout = visibility_timeout
+    return max(min(queue_visibility_timeout, visibility_timeout) / 2, 1)
+
+
+def process_messages(entries, file_type, heartbeat=None):
+    """
+    Merges the user objects from a group of messages for the same master in one pass and removes the messages
+    from the queue. entries is a list of (message, user_object) tuples in S3 event order.
+    heartbeat is the VisibilityHeartbeat the messages were added to when they were received, without one the
+    messages get their own while they are merged.
+    """
+    import message_functions
+    import s3_functions
+    results = [""] * len(entries)
+    valid = message_functions.log_entries(entries)
+    # do the upsert, the messages are kept hidden from other workers until they are deleted
+    own_heartbeat = message_functions.start_heartbeat(entries) if heartbeat is None else None
+    try:
+        if bool(file_type) and valid:
+            batch_results = s3_functions.merge_batch_to_mstr([entries[index][1] for index in valid], file_type)
+            for index, result in zip(valid, batch_results):
+                results[index] = result
+    finally:
+        if own_heartbeat is not None:
+            own_heartbeat.stop()
+        else:
+            heartbeat.remove([message for message, user_object in entries])
+    message_functions.acknowledge_messages(entries, results)
+    return results
+
+
 def main():
     config = configparser.ConfigParser()
     config.read('skills-demo.config')
@@ -54,54 +116,177 @@ def main():
     minutes_without_message_limit = config['default']['minutes_without_message_limit']
     incoming_message_queue_name = config['default']['incoming_message_queue_name']
     outgoing_message_queue_name = config['default']['outgoing_message_queue_name']
+    worker_count = config['default'].getint('worker_count', fallback=1)
+    execution_mode = config['default'].get('execution_mode', fallback='pool')
+    pipeline_queue_size = config['default'].getint('pipeline_queue_size', fallback=4)
+    client_max_pool_connections = config['default'].getint('client_max_pool_connections', fallback=32)
+    client_tcp_keepalive = config['default'].getboolean('client_tcp_keepalive', fallback=True)
+    dead_letter_queue_name = config['default'].get('dead_letter_queue_name', fallback=None)
+    acknowledge_batch_size = config['default'].getint('acknowledge_batch_size', fallback=10)
+    acknowledge_max_delay_seconds = config['default'].getfloat('acknowledge_max_delay_seconds', fallback=1.0)
+    poll_max_batch_messages = config['default'].getint('poll_max_batch_messages', fallback=50)
+    scale_out_queue_depth = config['default'].getint('scale_out_queue_depth', fallback=500)
+    scale_out_latency_seconds = config['default'].getint('scale_out_latency_seconds', fallback=300)
+    scale_in_queue_depth = config['default'].getint('scale_in_queue_depth', fallback=0)
+    scale_in_window_seconds = config['default'].getint('scale_in_window_seconds', fallback=300)
+    scale_signal_cooldown_seconds = config['default'].getint('scale_signal_cooldown_seconds', fallback=600)
+    queue_depth_check_seconds = config['default'].getint('queue_depth_check_seconds', fallback=30)
 
-    logging.basicConfig(level=logging.INFO, filemode='w', format='%(asctime)s %(message)s', datefmt='%m/%d/%Y %I:%M:%S')
+    logging.basicConfig(level=logging.INFO, filemode='w', format='%(asctime)s %(threadName)s %(message)s', datefmt='%m/%d/%Y %I:%M:%S')
     logging.info('Application Starting')
     logging.info('EC2 Instance: ' + ec2_instance_id)
     logging.info('Incoming message queue: ' + incoming_message_queue_name)
     logging.info('Outgoing message queue: ' + outgoing_message_queue_name)
-    # set last message received to current time.
-    last_message_received = datetime.now()
+    logging.info('Worker count: {}'.format(worker_count))
+    logging.info('Execution mode: {}'.format(execution_mode))
+    logging.info('Client pool connections: {} keep alive: {}'.format(client_max_pool_connections,
+                                                                    client_tcp_keepalive))
+    clients.set_client_config(client_max_pool_connections, client_tcp_keepalive)
     # set the sqs resource
-    sqs = boto3.resource('sqs')
+    sqs = clients.get_resource('sqs')
     # get the incoming queue
     queue = sqs.get_queue_by_name(QueueName=incoming_message_queue_name)
+    logging.info('Dead letter queue: {} acknowledge batch size: {} max delay seconds: {}'.format(
+        dead_letter_queue_name, acknowledge_batch_size, acknowledge_max_delay_seconds))
+    dead_letter_queue = sqs.get_queue_by_name(QueueName=dead_letter_queue_name) if dead_letter_queue_name else None
+    acknowledger = AcknowledgementManager(queue, dead_letter_queue, acknowledge_batch_size,
+                                          acknowledge_max_delay_seconds).start()
+    # load the merge modules while the first poll waits for messages
+    startup_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='startup')
+    visibility_timeout_seconds = config['default'].getint('visibility_timeout_seconds', fallback=300)
+    heartbeat_interval = get_heartbeat_interval(queue, visibility_timeout_seconds)
+    # messages are kept hidden from the moment they are received, while they wait for their master and are merged
+    heartbeat = VisibilityHeartbeat([], visibility_timeout_seconds, heartbeat_interval, queue).start()
+    merge_ready = startup_executor.submit(configure_merge, config['default'], acknowledger, heartbeat_interval)
+    startup_executor.shutdown(wait=False)
+    logging.info('Poll batch messages: {} scale out depth: {} latency seconds: {} scale in depth: {} window: {}'
+                 .format(poll_max_batch_messages, scale_out_queue_depth, scale_out_latency_seconds,
+                         scale_in_queue_depth, scale_in_window_seconds))
+    scheduler = PollScheduler(queue, partial(send_sqs_message, ec2_instance_id, outgoing_message_queue_name),
+                              max_batch_messages=poll_max_batch_messages, scale_out_depth=scale_out_queue_depth,
+                              scale_out_latency_seconds=scale_out_latency_seconds, scale_in_depth=scale_in_queue_depth,
+                              scale_in_window_seconds=scale_in_window_seconds,
+                              signal_cooldown_seconds=scale_signal_cooldown_seconds,
+                              depth_check_seconds=queue_depth_check_seconds)
+    if execution_mode == 'pipeline':
+        merge_ready.result()
+        import asyncio
+        from classes.merge_pipeline import MergePipeline
+        asyncio.run(MergePipeline(queue, worker_count, minutes_without_message_limit, pipeline_queue_size,
+                                  scheduler, heartbeat).run())
+    else:
+        run_worker_pool(queue, worker_count, minutes_without_message_limit, scheduler, merge_ready, heartbeat)
+    heartbeat.stop()
+    # delete the messages still waiting and let compactions already started finish before the instance is stopped
+    acknowledger.stop()
+    merge_ready.result()
+    import delta_log
+    delta_log.compaction_executor.shutdown(wait=True)
+    send_sqs_message(ec2_instance_id, outgoing_message_queue_name)
+    logging.info('Completed')
+
+
+def configure_merge(settings, acknowledger, heartbeat_interval=None):
+    """
+    Imports the merge modules and applies the merge settings of the config to them.
+    """
+    from classes.disk_dataframe_cache import DiskDataFrameCache
+    from classes.file_type_registry import FileTypeRegistry
+    from classes.local_file_type_store import LocalFileTypeStore
+    from classes.local_ledger_store import LocalLedgerStore
+    from classes.processed_ledger import ProcessedLedger
+    import message_functions
+    import metrics
+    import s3_functions
+    import transfer
+
+    mstr_cache_mb = settings.getint('mstr_cache_mb', fallback=512)
+    mstr_disk_cache_path = settings.get('mstr_disk_cache_path', fallback=None)
+    mstr_disk_cache_mb = settings.getint('mstr_disk_cache_mb', fallback=4096)
+    mstr_disk_cache_warm_count = settings.getint('mstr_disk_cache_warm_count', fallback=8)
+    file_type_registry_path = settings.get('file_type_registry_path', fallback=None)
+    transfer_part_size_mb = settings.getint('transfer_part_size_mb', fallback=8)
+    transfer_concurrency = settings.getint('transfer_concurrency', fallback=8)
+    transfer_max_buffer_mb = settings.getint('transfer_max_buffer_mb', fallback=64)
+    metrics_path = settings.get('metrics_path', fallback=None)
+    metrics_exporter = settings.get('metrics_exporter', fallback='none')
+    metrics_emf_path = settings.get('metrics_emf_path', fallback='metrics_emf.log')
+    metrics_port = settings.getint('metrics_port', fallback=9108)
+    processed_ledger_path = settings.get('processed_ledger_path', fallback=None)
+    visibility_timeout_seconds = settings.getint('visibility_timeout_seconds', fallback=300)
+    conflict_retries = settings.getint('conflict_retries', fallback=5)
+
+    logging.info('Mstr cache MB: {}'.format(mstr_cache_mb))
+    s3_functions.mstr_cache.set_max_bytes(mstr_cache_mb * 1024 * 1024)
+    if mstr_disk_cache_path:
+        logging.info('Mstr disk cache: {} MB: {}'.format(mstr_disk_cache_path, mstr_disk_cache_mb))
+        s3_functions.mstr_disk_cache = DiskDataFrameCache(mstr_disk_cache_path, mstr_disk_cache_mb * 1024 * 1024)
+        # the masters merged last before the instance stopped are the likeliest to be merged first
+        warmed = s3_functions.mstr_disk_cache.warm(s3_functions.mstr_cache, mstr_disk_cache_warm_count)
+        logging.info('Warmed mstr cache with {} masters'.format(warmed))
+    logging.info('Transfer part size MB: {} concurrency: {} max buffer MB: {}'.format(
+        transfer_part_size_mb, transfer_concurrency, transfer_max_buffer_mb))
+    transfer.set_transfer_config(transfer_part_size_mb, transfer_concurrency, transfer_max_buffer_mb)
+    logging.info('Metrics file: {} exporter: {}'.format(metrics_path, metrics_exporter))
+    metrics.add_exporters(metrics_path, metrics_exporter, metrics_emf_path, metrics_port)
+    if file_type_registry_path:
+        logging.info('File type registry: {}'.format(file_type_registry_path))
+        s3_functions.file_type_registry = FileTypeRegistry(LocalFileTypeStore(file_type_registry_path))
+    if processed_ledger_path:
+        logging.info('Processed ledger: {}'.format(processed_ledger_path))
+        s3_functions.processed_ledger = ProcessedLedger(LocalLedgerStore(processed_ledger_path))
+    logging.info('Visibility timeout seconds: {} heartbeat interval: {} conflict retries: {}'.format(
+        visibility_timeout_seconds, heartbeat_interval, conflict_retries))
+    message_functions.visibility_timeout = visibility_timeout_seconds
+    message_functions.heartbeat_interval = heartbeat_interval
+    s3_functions.conflict_retries = conflict_retries
+    message_functions.acknowledger = acknowledger
+    logging.info('Merge modules loaded')
 
-    while last_message_received > datetime.now() - timedelta(minutes=int(minutes_without_message_limit)):
+
+def run_worker_pool(queue, worker_count, minutes_without_message_limit, scheduler=None, merge_ready=None,
+                    heartbeat=None):
+    """
+    Polls the queue and merges each group of messages on a worker pool, one group at a time per master.
+    The scheduler decides how many messages each poll takes and how long it waits. merge_ready is the future of
+    configure_merge, the first messages wait for it. Received messages are added to the heartbeat straight away,
+    so a group waiting behind another group for the same master is not handed to a second worker.
+    """
+    scheduler = scheduler if scheduler is not None else PollScheduler(queue)
+    # set last message received to current time.
+    last_message_received = datetime.now()
+    executor = KeyedExecutor(max_workers=worker_count)
+
+    # keep going while messages are arriving or there is still work in flight
+    while last_message_received > datetime.now() - timedelta(minutes=float(minutes_without_message_limit)) \
+            or executor.pending():
+        # don't take more messages off the queue than the workers can keep up with
+        pending = executor.pending()
+        if len(pending) >= worker_count * 2:
+            wait(pending, return_when=FIRST_COMPLETED)
+            continue
         # poll the queue
-        logging.info('Polling Queue: {}'.format(incoming_message_queue_name))
-        messages = queue.receive_messages(WaitTimeSeconds=20)
+        logging.info('Polling Queue')
+        messages = scheduler.receive()
         # if message received, and it's not empty.
         if bool(messages):
             logging.info('Message received')
             # reset last_message_received
             last_message_received = datetime.now()
             logging.info('Received Message: {}'.format(last_message_received))
-            # loop through the messages received
-            for message in messages:
-                # process the message body to get the S3Object
-                user_object = get_object(json.loads(message.body))
-                result = ""
-                logging.info('User Object: {}'.format(user_object.path))
-                # make sure the object could be parsed from the message
-                if bool(user_object):
-                    logging.info('Processing the file: {}'.format(user_object.path))
-                    # look for known file matching the pattern of the current message
-                    file_type = s3_functions.lookup_file(user_object.key)
-                    # do the upsert...
-                    if bool(file_type):
-                        result = s3_functions.merge_to_mstr(user_object, file_type)
-                # if we were unsuccessful in parsing the message log it.
-                else:
-                    logging.error('Invalid message format received.')
-                # Right now we're just going to remove all processed messages
-                # whether they are valid or invalid.
-                # Later version will set up a dead letter queue to allow for checking bad messages.
-                logging.info('Merge Result: {}'.format(result))
-                message.delete()
-                logging.info('Message removed from queue.')
-    send_sqs_message(ec2_instance_id, outgoing_message_queue_name)
-    logging.info('Completed')
+            if heartbeat is not None:
+                heartbeat.add(messages)
+            if merge_ready is not None:
+                merge_ready.result()
+            import message_functions
+            # group the messages received so each master is read and written once per batch
+            for key, file_type, entries in message_functions.group_messages(messages):
+                executor.submit(key, process_messages, entries, file_type, heartbeat)
+        elif merge_ready is None or merge_ready.done():
+            import delta_log
+            # nothing to merge, fold aged deltas into their masters
+            delta_log.schedule_due_compactions()
+    executor.shutdown(wait=True)
 
 
 if __name__ == '__main__':
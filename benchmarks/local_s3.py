@@ -0,0 +1,168 @@
+from collections import Counter
+import hashlib
+import io
+import itertools
+import threading
+import time
+import types
+from botocore.exceptions import ClientError
+
+
+def get_etag(body):
+    return '"{}"'.format(hashlib.md5(body).hexdigest())
+
+
+class ThrottledBody:
+    """
+    Response body that is read no faster than the stream bandwidth.
+    """
+    def __init__(self, body, bytes_per_second):
+        self.body = io.BytesIO(body)
+        self.bytes_per_second = bytes_per_second
+
+    def read(self, size=-1):
+        chunk = self.body.read(size)
+        time.sleep(len(chunk) / self.bytes_per_second)
+        return chunk
+
+
+class LocalS3Object:
+    def __init__(self, s3, bucket, key):
+        self.s3 = s3
+        self.bucket_name = bucket
+        self.key = key
+
+    def get(self):
+        return self.s3.meta.client.get_object(Bucket=self.bucket_name, Key=self.key)
+
+    def put(self, Body, **conditions):
+        return self.s3.meta.client.put_object(Bucket=self.bucket_name, Key=self.key, Body=Body, **conditions)
+
+    def delete(self):
+        return self.s3.meta.client.delete_object(Bucket=self.bucket_name, Key=self.key)
+
+
+class LocalS3Client:
+    def __init__(self, s3):
+        self.s3 = s3
+
+    def head_object(self, Bucket, Key):
+        body = self.s3.request('head', Bucket, Key)
+        return {'ContentLength': len(body), 'ETag': self.s3.get_object_etag(Bucket, Key, body)}
+
+    def get_object(self, Bucket, Key, Range=None, IfMatch=None):
+        body = self.s3.request('get', Bucket, Key)
+        etag = self.s3.get_object_etag(Bucket, Key, body)
+        if IfMatch is not None and IfMatch != etag:
+            raise ClientError({'Error': {'Code': 'PreconditionFailed'}}, 'GetObject')
+        if Range is not None:
+            start, end = Range.replace('bytes=', '').split('-')
+            body = body[int(start):int(end) + 1]
+        return {'Body': self.s3.get_body(body), 'ContentLength': len(body), 'ETag': etag}
+
+    def put_object(self, Bucket, Key, Body, **conditions):
+        self.s3.request('put')
+        self.s3.transmit(Body)
+        return {'ETag': self.s3.store_object(Bucket, Key, bytes(Body), **conditions)}
+
+    def delete_object(self, Bucket, Key):
+        self.s3.request('delete')
+        with self.s3.lock:
+            self.s3.store.pop((Bucket, Key), None)
+        return {}
+
+    def create_multipart_upload(self, Bucket, Key):
+        self.s3.request('create_multipart')
+        upload_id = str(next(self.s3.upload_ids))
+        self.s3.uploads[upload_id] = {}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        # S3 bills each part as a PUT request
+        self.s3.request('put')
+        self.s3.transmit(Body)
+        self.s3.uploads[UploadId][PartNumber] = bytes(Body)
+        return {'ETag': get_etag(Body)}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, **conditions):
+        self.s3.request('complete_multipart')
+        parts = self.s3.uploads.pop(UploadId)
+        body = b''.join(parts[part['PartNumber']] for part in MultipartUpload['Parts'])
+        return {'ETag': self.s3.store_object(Bucket, Key, body, len(parts), **conditions)}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.s3.request('abort_multipart')
+        self.s3.uploads.pop(UploadId, None)
+
+
+class LocalS3:
+    """
+    In memory stand in for the S3 resource used by the merge functions and the transfer layer, for the unit tests
+    and the benchmarks. Every request waits for the latency and every stream is limited to bytes_per_second,
+    roughly how a single S3 connection behaves, so the benchmarks show the effect of running requests concurrently.
+    Without them it answers straight away. Requests are counted by operation in calls.
+    Objects are kept in store, a mapping of (bucket, key) to body that can be swapped for one shared by several
+    processes, along with a lock held across them. The ETag of an object is the MD5 of its body, or of its body
+    and part count when it was uploaded in parts, as S3 gives.
+    """
+    def __init__(self, latency=0, bytes_per_second=None, store=None, lock=None):
+        self.latency = latency
+        self.bytes_per_second = bytes_per_second
+        self.store = store if store is not None else {}
+        # conditional writes are checked and applied under this lock
+        self.lock = lock if lock is not None else threading.Lock()
+        # (bucket, key) -> MD5 and ETag of the objects uploaded in parts
+        self.part_etags = {}
+        self.uploads = {}
+        self.upload_ids = itertools.count(1)
+        self.calls = Counter()
+        self.calls_lock = threading.Lock()
+        self.meta = types.SimpleNamespace(client=LocalS3Client(self))
+
+    def Object(self, bucket, key):
+        return LocalS3Object(self, bucket, key)
+
+    def request(self, operation, bucket=None, key=None):
+        with self.calls_lock:
+            self.calls[operation] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if key is None:
+            return None
+        try:
+            return self.store[(bucket, key)]
+        except KeyError:
+            raise ClientError({'Error': {'Code': '404' if operation == 'head' else 'NoSuchKey'}}, operation)
+
+    def get_body(self, body):
+        if self.bytes_per_second is None:
+            return io.BytesIO(body)
+        return ThrottledBody(body, self.bytes_per_second)
+
+    def transmit(self, body):
+        if self.bytes_per_second is not None:
+            time.sleep(len(body) / self.bytes_per_second)
+
+    def get_object_etag(self, bucket, key, body):
+        etag = get_etag(body)
+        # an entry left by a part upload this process made of an object since written by another is ignored
+        md5, part_etag = self.part_etags.get((bucket, key), (None, None))
+        return part_etag if md5 == etag else etag
+
+    def store_object(self, bucket, key, body, part_count=None, IfMatch=None, IfNoneMatch=None):
+        """
+        Stores the object, checking the conditions of a conditional write against the current object first.
+        Returns the ETag of the new object.
+        """
+        with self.lock:
+            exists = (bucket, key) in self.store
+            if (IfNoneMatch == '*' and exists) or (IfMatch is not None and (
+                    not exists or self.get_object_etag(bucket, key, self.store[(bucket, key)]) != IfMatch)):
+                raise ClientError({'Error': {'Code': 'PreconditionFailed'}}, 'PutObject')
+            self.store[(bucket, key)] = body
+            etag = get_etag(body)
+            self.part_etags.pop((bucket, key), None)
+            if part_count is not None:
+                etag = '"{}-{}"'.format(etag.strip('"'), part_count)
+                self.part_etags[(bucket, key)] = (get_etag(body), etag)
+        return etag
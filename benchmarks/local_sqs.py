@@ -0,0 +1,138 @@
+from collections import Counter
+import itertools
+import json
+import time
+
+
+def get_s3_event_body(bucket, key, event_time, sequencer, size=None):
+    """
+    Returns the body of the ObjectCreated event S3 sends when an object is put.
+    """
+    s3_object = {'key': key, 'sequencer': sequencer}
+    if size is not None:
+        s3_object['size'] = size
+    return json.dumps({'Records': [{'eventTime': event_time,
+                                    'eventName': 'ObjectCreated:Put',
+                                    's3': {'bucket': {'name': bucket}, 'object': s3_object}}]})
+
+
+class LocalMessage:
+    def __init__(self, message_id, body, queue=None):
+        self.queue = queue
+        self.message_id = message_id
+        self.receipt_handle = 'receipt-{}'.format(message_id)
+        self.body = body
+        self.attributes = {}
+        self.deleted = False
+        self.visibility_timeout = None
+
+    def delete(self):
+        if self.queue is not None:
+            self.queue.calls['delete'] += 1
+        self.deleted = True
+
+    def change_visibility(self, VisibilityTimeout):
+        if self.queue is not None:
+            self.queue.calls['change_visibility'] += 1
+        self.visibility_timeout = VisibilityTimeout
+
+
+class LocalQueue:
+    """
+    In memory stand in for the SQS queues the app uses, for the unit tests and the benchmarks. Messages are handed
+    out in the order they were sent, a receive never takes messages from more than one of the batches they were
+    sent in, the way a receive from SQS can come back short. Deleted messages are marked deleted. Requests are
+    counted by operation in calls.
+    """
+    def __init__(self, batches=()):
+        self.batches = []
+        # every message sent, by receipt handle
+        self.messages = {}
+        self.ids = itertools.count(1)
+        self.attributes = {}
+        self.calls = Counter()
+        # the MaxNumberOfMessages and WaitTimeSeconds of each receive
+        self.receives = []
+        self.delete_requests = []
+        # receipt handle -> number of batch deletes it fails, or 'sender' when it always fails
+        self.delete_failures = {}
+        # the body and attributes of each send_message
+        self.sent = []
+        # the receipt handles of each visibility batch
+        self.visibility_requests = []
+        for batch in batches:
+            self.send_batch(batch)
+
+    def send_batch(self, messages):
+        """
+        Queues messages that are received together.
+        """
+        batch = list(messages)
+        for message in batch:
+            message.queue = self
+            self.messages[message.receipt_handle] = message
+        self.batches.append(batch)
+
+    def send_s3_event(self, bucket, key, size, sequencer):
+        """
+        Queues the ObjectCreated event S3 sends when an object is put, in the batch of the events sent before it.
+        """
+        message = LocalMessage(str(next(self.ids)),
+                               get_s3_event_body(bucket, key, '2020-02-22T21:28:03.647Z', '{:018X}'.format(sequencer),
+                                                 size), self)
+        self.messages[message.receipt_handle] = message
+        if not self.batches:
+            self.batches.append([])
+        self.batches[-1].append(message)
+
+    def send_message(self, MessageBody, MessageAttributes=None):
+        self.calls['send'] += 1
+        self.sent.append((MessageBody, MessageAttributes))
+        return {'MessageId': str(len(self.sent))}
+
+    def delete_messages(self, Entries):
+        self.calls['delete_batch'] += 1
+        self.delete_requests.append([entry['ReceiptHandle'] for entry in Entries])
+        response = {'Successful': [], 'Failed': []}
+        for entry in Entries:
+            failures = self.delete_failures.get(entry['ReceiptHandle'], 0)
+            if failures == 'sender':
+                response['Failed'].append({'Id': entry['Id'], 'SenderFault': True, 'Code': 'ReceiptHandleIsInvalid'})
+            elif failures:
+                self.delete_failures[entry['ReceiptHandle']] -= 1
+                response['Failed'].append({'Id': entry['Id'], 'SenderFault': False, 'Code': 'InternalError'})
+            else:
+                self.messages[entry['ReceiptHandle']].deleted = True
+                response['Successful'].append({'Id': entry['Id']})
+        return response
+
+    def change_message_visibility_batch(self, Entries):
+        self.calls['change_visibility_batch'] += 1
+        self.visibility_requests.append([entry['ReceiptHandle'] for entry in Entries])
+        response = {'Successful': [], 'Failed': []}
+        for entry in Entries:
+            message = self.messages.get(entry['ReceiptHandle'])
+            if message is None or message.deleted:
+                response['Failed'].append({'Id': entry['Id'], 'SenderFault': True, 'Code': 'ReceiptHandleIsInvalid'})
+            else:
+                message.visibility_timeout = entry['VisibilityTimeout']
+                response['Successful'].append({'Id': entry['Id']})
+        return response
+
+    def load(self):
+        self.calls['get_attributes'] += 1
+        self.attributes['ApproximateNumberOfMessages'] = str(sum(len(batch) for batch in self.batches))
+
+    def receive_messages(self, MaxNumberOfMessages=1, WaitTimeSeconds=0, AttributeNames=None):
+        self.calls['receive'] += 1
+        self.receives.append((MaxNumberOfMessages, WaitTimeSeconds))
+        if not self.batches:
+            # a long poll of an empty queue waits a little before coming back empty
+            if WaitTimeSeconds:
+                time.sleep(0.01)
+            return []
+        messages = self.batches[0][:MaxNumberOfMessages]
+        del self.batches[0][:MaxNumberOfMessages]
+        if not self.batches[0]:
+            self.batches.pop(0)
+        return messages
@@ -0,0 +1,269 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import numpy
+import pandas
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, '..'))
+from classes.file_types import FileType  # noqa: E402
+from classes.memory_ledger_store import MemoryLedgerStore  # noqa: E402
+from classes.processed_ledger import ProcessedLedger  # noqa: E402
+from classes.s3_object import S3Object  # noqa: E402
+from local_s3 import LocalS3  # noqa: E402
+from local_sqs import LocalQueue  # noqa: E402
+import delta_log  # noqa: E402
+import message_functions  # noqa: E402
+import metrics  # noqa: E402
+import partitioned_store  # noqa: E402
+import s3_functions  # noqa: E402
+import schema_functions  # noqa: E402
+
+BUCKET = 'benchmark'
+SCENARIO_DEFAULTS = {'mstr_rows': 10000,
+                     'stg_rows': 1000,
+                     'stg_files': 1,
+                     'columns': 5,
+                     'width': 12,
+                     'duplicate_rate': 0.05,
+                     'update_ratio': 0.5,
+                     'user_key': 'user/userEmailFile_bench.csv',
+                     'merge_mode': None,
+                     'storage_format': None,
+                     'column_schema': None,
+                     'seed': 0}
+
+
+def load_scenarios(path):
+    with open(path) as scenario_file:
+        return {name: dict(SCENARIO_DEFAULTS, **scenario) for name, scenario in json.load(scenario_file).items()}
+
+
+def get_file_type(scenario):
+    """
+    Returns the registered file type for the scenario's user key, with the merge mode and storage format of the
+    scenario when it sets them.
+    """
+    file_type = s3_functions.file_type_registry.lookup(scenario['user_key'])
+    if file_type is None:
+        raise SystemExit('No file type matches {}'.format(scenario['user_key']))
+    overrides = {name: scenario[name] for name in ('merge_mode', 'storage_format') if scenario[name] is not None}
+    return FileType.from_dict(dict(file_type.to_dict(), **overrides))
+
+
+def format_keys(column, keys):
+    if 'email' in column.lower():
+        return 'user' + pandas.Series(keys).astype(str) + '@example.com'
+    return keys
+
+
+def generate_frame(file_type, keys, columns, width, random):
+    """
+    Returns a dataframe with the file type's key columns built from keys and filler columns of random digits
+    width characters wide. The first key column holds the key, any other key columns are derived from it.
+    """
+    data = {}
+    for position, column in enumerate(file_type.key_columns):
+        data[column] = format_keys(column, keys if position == 0 else keys % 10)
+    for position in range(max(columns - len(file_type.key_columns), 0)):
+        values = pandas.Series(random.integers(0, 10 ** min(width, 18), len(keys)))
+        data['Col{}'.format(position)] = values.astype(str).str.zfill(width)
+    return pandas.DataFrame(data)
+
+
+def generate(file_type, scenario, stg_index):
+    """
+    Returns the dataframe of one stg file. update_ratio of the stg rows reuse a mstr key, the rest are new keys,
+    then duplicate_rate of the rows are replaced with a copy of another stg key.
+    """
+    random = numpy.random.default_rng(scenario['seed'] + stg_index)
+    mstr_rows = scenario['mstr_rows']
+    stg_rows = scenario['stg_rows']
+    update_rows = min(int(stg_rows * scenario['update_ratio']), mstr_rows)
+    first_new_key = mstr_rows + stg_index * stg_rows
+    stg_keys = numpy.concatenate([random.choice(mstr_rows, update_rows, replace=False),
+                                  numpy.arange(first_new_key, first_new_key + stg_rows - update_rows)])
+    duplicated = random.random(stg_rows) < scenario['duplicate_rate']
+    stg_keys[duplicated] = stg_keys[random.integers(0, stg_rows, int(duplicated.sum()))]
+    random.shuffle(stg_keys)
+    return generate_frame(file_type, stg_keys, scenario['columns'], scenario['width'], random)
+
+
+def put_csv(s3, key, df, file_type):
+    body = df.to_csv(index=False, sep=file_type.field_delimiter, quotechar=file_type.text_qualifier).encode('utf-8')
+    s3.store_object(BUCKET, key, body)
+    return len(body)
+
+
+def reset_peak_rss():
+    """
+    Resets the peak resident set size of the process so each stage reports its own peak, Linux only.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        pass
+
+
+class StageRecorder:
+    """
+    Runs the stages of a scenario and records the wall time, peak RSS and requests of each.
+    """
+    def __init__(self, s3, queue):
+        self.s3 = s3
+        self.queue = queue
+        self.stages = []
+
+    def get_calls(self):
+        calls = {'s3_' + operation: count for operation, count in self.s3.calls.items()}
+        calls.update({'sqs_' + operation: count for operation, count in self.queue.calls.items()})
+        return calls
+
+    def run(self, stage, function):
+        calls_before = self.get_calls()
+        reset_peak_rss()
+        start = time.perf_counter()
+        result = function()
+        seconds = time.perf_counter() - start
+        calls_after = self.get_calls()
+        self.stages.append({'stage': stage,
+                            'seconds': round(seconds, 4),
+                            'peak_rss_mb': round(metrics.get_peak_rss_mb(), 1),
+                            'requests': {operation: count - calls_before.get(operation, 0)
+                                         for operation, count in sorted(calls_after.items())
+                                         if count - calls_before.get(operation, 0)}})
+        return result
+
+
+def run_scenario(scenario):
+    """
+    Seeds a local S3 with the master and stg files of the scenario, queues their S3 events and merges them the way
+    app.process_messages does, one stage at a time. Returns the recorded stages.
+    """
+    file_type = get_file_type(scenario)
+    s3 = LocalS3()
+    queue = LocalQueue()
+    s3_functions.get_s3_resource = lambda: s3
+    # every scenario puts the same keys with the same sequencers, a ledger kept from the last one would skip them
+    s3_functions.processed_ledger = ProcessedLedger(MemoryLedgerStore())
+    # every run reads the master, the cache would hide the download
+    s3_functions.mstr_cache.set_max_bytes(0)
+
+    df_mstr = generate_frame(file_type, numpy.arange(scenario['mstr_rows']), scenario['columns'], scenario['width'],
+                             numpy.random.default_rng(scenario['seed']))
+    put_csv(s3, file_type.master_file_s3_key, df_mstr, file_type)
+    if scenario['column_schema'] == 'infer':
+        file_type.column_schema = schema_functions.get_inferred_schema(df_mstr, file_type)
+    if file_type.storage_format == 'parquet':
+        partitioned_store.partition_csv_mstr(s3, S3Object(BUCKET, file_type.master_file_s3_key), file_type)
+    del df_mstr
+    root, extension = os.path.splitext(scenario['user_key'])
+    for stg_index in range(scenario['stg_files']):
+        key = '{}_{}{}'.format(root, stg_index, extension)
+        size = put_csv(s3, key, generate(file_type, scenario, stg_index), file_type)
+        queue.send_s3_event(BUCKET, key, size, stg_index)
+    s3.calls.clear()
+
+    recorder = StageRecorder(s3, queue)
+    messages = recorder.run('poll', lambda: receive_all(queue))
+    key, registry_file_type, entries = message_functions.group_messages(messages)[0]
+    user_objects = [user_object for message, user_object in entries]
+    if file_type.storage_format == 'csv' and file_type.merge_mode == 'memory':
+        batch = recorder.run('load', lambda: s3_functions.load_batch(s3, user_objects, file_type))
+        recorder.run('apply', lambda: s3_functions.apply_batch(batch))
+        results = recorder.run('write', lambda: s3_functions.write_batch(s3, batch))
+        del batch
+    else:
+        results = recorder.run('merge', lambda: s3_functions.merge_batch_to_mstr(user_objects, file_type))
+    if file_type.merge_mode == 'delta':
+        recorder.run('compact', lambda: delta_log.compact(BUCKET, file_type))
+    recorder.run('acknowledge', lambda: message_functions.acknowledge_messages(entries, results))
+    if any(result != 'Success' for result in results):
+        raise SystemExit('Merge failed: {}'.format(results))
+    return recorder.stages
+
+
+def receive_all(queue):
+    messages = []
+    while True:
+        received = queue.receive_messages(MaxNumberOfMessages=10)
+        if not received:
+            return messages
+        messages.extend(received)
+
+
+def compare(results, baseline, tolerance, min_seconds):
+    """
+    Prints each stage next to the baseline and returns the regressions: stages that got slower or used more
+    memory than the tolerance allows, or whose request counts changed.
+    """
+    regressions = []
+    for name, scenario in results['scenarios'].items():
+        baseline_stages = {stage['stage']: stage for stage in baseline['scenarios'].get(name, {}).get('stages', [])}
+        for stage in scenario['stages']:
+            previous = baseline_stages.get(stage['stage'])
+            if previous is None:
+                print('{} {}: no baseline'.format(name, stage['stage']))
+                continue
+            print('{} {}: {:.3f}s (baseline {:.3f}s) peak rss {:.0f} MB (baseline {:.0f} MB)'.format(
+                name, stage['stage'], stage['seconds'], previous['seconds'], stage['peak_rss_mb'],
+                previous['peak_rss_mb']))
+            if stage['seconds'] > previous['seconds'] * (1 + tolerance) and \
+                    stage['seconds'] - previous['seconds'] > min_seconds:
+                regressions.append('{} {}: {:.3f}s, baseline {:.3f}s'.format(name, stage['stage'], stage['seconds'],
+                                                                            previous['seconds']))
+            if stage['peak_rss_mb'] > previous['peak_rss_mb'] * (1 + tolerance):
+                regressions.append('{} {}: peak rss {:.0f} MB, baseline {:.0f} MB'.format(
+                    name, stage['stage'], stage['peak_rss_mb'], previous['peak_rss_mb']))
+            if stage['requests'] != previous['requests']:
+                regressions.append('{} {}: requests {}, baseline {}'.format(name, stage['stage'], stage['requests'],
+                                                                            previous['requests']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs merge scenarios against a local S3 and SQS stand in and '
+                                                 'compares the timings with a stored baseline.')
+    parser.add_argument('--scenario-file', default=os.path.join(BENCHMARK_DIR, 'scenarios.json'))
+    parser.add_argument('--scenarios', default='small', help='comma separated scenario names from the scenario file')
+    for name, default in SCENARIO_DEFAULTS.items():
+        parser.add_argument('--' + name.replace('_', '-'), type=type(default) if default is not None else str,
+                            help='overrides the scenario value')
+    parser.add_argument('--output', help='file to write the results to as json')
+    parser.add_argument('--baseline', help='results file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown, 0.25 is 25%%')
+    parser.add_argument('--min-seconds', type=float, default=0.05,
+                        help='slowdowns smaller than this are treated as noise')
+    args = parser.parse_args()
+
+    scenarios = load_scenarios(args.scenario_file)
+    overrides = {name: getattr(args, name) for name in SCENARIO_DEFAULTS if getattr(args, name) is not None}
+    results = {'python': platform.python_version(), 'pandas': pandas.__version__, 'platform': platform.platform(),
+               'scenarios': {}}
+    for name in args.scenarios.split(','):
+        scenario = dict(scenarios[name], **overrides)
+        stages = run_scenario(scenario)
+        results['scenarios'][name] = {'parameters': scenario, 'stages': stages,
+                                      'total_seconds': round(sum(stage['seconds'] for stage in stages), 4)}
+        for stage in stages:
+            print('{} {}: {:.3f}s peak rss {:.0f} MB requests {}'.format(name, stage['stage'], stage['seconds'],
+                                                                        stage['peak_rss_mb'], stage['requests']))
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance, args.min_seconds)
+        for regression in regressions:
+            print('REGRESSION {}'.format(regression))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT_DIR)
+import clients  # noqa: E402
+
+# what app.main needs before the first poll, and what it imported up front before the merge modules were deferred
+FIRST_POLL_IMPORTS = 'import app'
+EAGER_IMPORTS = 'import app, asyncio, message_functions, s3_functions, delta_log, metrics, transfer; ' \
+                'import classes.merge_pipeline, classes.disk_dataframe_cache'
+
+
+def time_import(statement, runs):
+    """
+    Returns the median seconds a new interpreter takes to run the import statement.
+    """
+    code = 'import time; start = time.perf_counter(); {}; print(time.perf_counter() - start)'.format(statement)
+    return statistics.median(float(subprocess.run([sys.executable, '-c', code], cwd=ROOT_DIR, check=True,
+                                                  capture_output=True, text=True).stdout)
+                             for run in range(runs))
+
+
+def time_calls(function, calls):
+    start = time.perf_counter()
+    for call in range(calls):
+        function()
+    return (time.perf_counter() - start) / calls
+
+
+def new_resource(service):
+    """
+    A resource on a new session for every merge, how get_s3_resource and send_sqs_message made them.
+    """
+    import boto3
+    return boto3.session.Session().resource(service)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compares the start up time and the per message client overhead '
+                                                 'of the shared client layer with making clients per message.')
+    parser.add_argument('--runs', type=int, default=5, help='interpreters started for each import time')
+    parser.add_argument('--calls', type=int, default=20, help='resources made for each per message time')
+    args = parser.parse_args()
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+    print('import before first poll: {:.3f}s'.format(time_import(FIRST_POLL_IMPORTS, args.runs)))
+    print('import of every merge module: {:.3f}s'.format(time_import(EAGER_IMPORTS, args.runs)))
+    for service in ('s3', 'sqs'):
+        print('{} resource per message, new session: {:.2f}ms'.format(
+            service, time_calls(lambda: new_resource(service), args.calls) * 1000))
+        clients.get_resource(service)
+        print('{} resource per message, shared client: {:.4f}ms'.format(
+            service, time_calls(lambda: clients.get_resource(service), args.calls) * 1000))
+
+
+if __name__ == '__main__':
+    main()
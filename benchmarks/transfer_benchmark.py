@@ -0,0 +1,76 @@
+import argparse
+import io
+import os
+import sys
+import time
+import numpy
+import pandas
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from classes.s3_object import S3Object  # noqa: E402
+from local_s3 import LocalS3  # noqa: E402
+import transfer  # noqa: E402
+
+MB = 1024 * 1024
+
+
+def generate(rows, seed=0):
+    random = numpy.random.default_rng(seed)
+    return pandas.DataFrame({'Email': ['user{}@example.com'.format(key) for key in range(rows)],
+                             'Name': random.integers(0, 1000, rows).astype(str),
+                             'Score': random.random(rows)})
+
+
+def single_stream_download(s3, s3_object):
+    """
+    A single GET read into a new buffer, how the s3fs path read behaves.
+    """
+    return pandas.read_csv(io.BytesIO(s3.Object(s3_object.bucket, s3_object.key).get()['Body'].read()))
+
+
+def single_stream_upload(s3, s3_object, df):
+    """
+    Serializes the whole dataframe and then sends it with one PUT, how the s3fs path write behaves.
+    """
+    s3.Object(s3_object.bucket, s3_object.key).put(Body=df.to_csv(index=False).encode('utf-8'))
+
+
+def transfer_download(s3, s3_object):
+    s3_object.metadata = None
+    return pandas.read_csv(transfer.download_object(s3, s3_object))
+
+
+def time_call(function):
+    start = time.perf_counter()
+    function()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compares the transfer layer with single stream reads and writes '
+                                                 'against a local S3 stand in.')
+    parser.add_argument('--rows', type=int, default=2000000)
+    parser.add_argument('--part-size-mb', type=int, default=8)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds added to every request')
+    parser.add_argument('--stream-mb', type=float, default=50, help='bandwidth of a single stream in MB/s')
+    args = parser.parse_args()
+
+    transfer.set_transfer_config(args.part_size_mb, args.concurrency)
+    s3 = LocalS3(latency=args.latency, bytes_per_second=args.stream_mb * MB)
+    df = generate(args.rows)
+    s3_object = S3Object('bucket', 'mstr/benchmark.csv')
+
+    results = [('upload', 'single stream', time_call(lambda: single_stream_upload(s3, s3_object, df))),
+               ('upload', 'transfer', time_call(lambda: transfer.upload_csv(s3, s3_object, df))),
+               ('download', 'single stream', time_call(lambda: single_stream_download(s3, s3_object))),
+               ('download', 'transfer', time_call(lambda: transfer_download(s3, s3_object)))]
+    size_mb = len(s3.store[('bucket', 'mstr/benchmark.csv')]) / MB
+    print('object size: {:.1f} MB part size: {} MB concurrency: {}'.format(size_mb, args.part_size_mb,
+                                                                         args.concurrency))
+    for direction, method, seconds in results:
+        print('{} {}: {:.3f}s {:.1f} MB/s'.format(direction, method, seconds, size_mb / seconds))
+
+
+if __name__ == '__main__':
+    main()
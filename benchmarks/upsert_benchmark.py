@@ -0,0 +1,67 @@
+import argparse
+import os
+import sys
+import time
+import numpy
+import pandas
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import upsert_engine  # noqa: E402
+
+
+def legacy_upsert(df_mstr, df_stg, primary_key):
+    """
+    The original merge_to_mstr logic: a dedupe, two joins for the counts and a concat with a second dedupe.
+    """
+    df_stg = df_stg.drop_duplicates(subset=primary_key, keep='last')
+    update_count = len(df_mstr.merge(df_stg, "inner", on=primary_key).index)
+    new_record_count = len(df_mstr.merge(df_stg, "right", on=primary_key).index) - update_count
+    df_mstr_new = pandas.concat([df_mstr, df_stg])
+    df_mstr_new.drop_duplicates(subset=primary_key, keep='last', inplace=True)
+    return df_stg, df_mstr_new, update_count, new_record_count
+
+
+def generate(mstr_rows, stg_rows, seed=0):
+    """
+    Returns a mstr and a stg dataframe keyed on Email, with about half the stg keys already in the mstr and
+    about 10% of the stg rows duplicated.
+    """
+    random = numpy.random.default_rng(seed)
+    mstr_keys = numpy.arange(mstr_rows)
+    stg_keys = random.integers(0, mstr_rows * 2, stg_rows)
+    stg_keys[random.random(stg_rows) < 0.1] = stg_keys[0]
+
+    def frame(keys):
+        return pandas.DataFrame({'Email': ['user{}@example.com'.format(key) for key in keys],
+                                 'Name': random.integers(0, 1000, len(keys)).astype(str),
+                                 'Score': random.random(len(keys))})
+    return frame(mstr_keys), frame(stg_keys)
+
+
+def time_call(function, repeat):
+    timings = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compares the upsert engine with the original merge_to_mstr logic.')
+    parser.add_argument('--mstr-rows', type=int, default=1000000)
+    parser.add_argument('--stg-rows', type=int, default=200000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    df_mstr, df_stg = generate(args.mstr_rows, args.stg_rows)
+    legacy_seconds = time_call(lambda: legacy_upsert(df_mstr, df_stg, ['Email']), args.repeat)
+    engine_seconds = time_call(lambda: upsert_engine.upsert(df_mstr, df_stg, ['Email']), args.repeat)
+    print('mstr rows: {} stg rows: {}'.format(args.mstr_rows, args.stg_rows))
+    print('legacy: {:.3f}s'.format(legacy_seconds))
+    print('engine: {:.3f}s'.format(engine_seconds))
+    print('speedup: {:.2f}x'.format(legacy_seconds / engine_seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,35 @@
+import io
+import logging
+import os
+from botocore.exceptions import ClientError
+import partitioned_store
+
+CHANGE_SET_DIRECTORY = '_changes/'
+
+
+def get_change_set_key(file_type, user_object):
+    """
+    Returns the key the change set of a user object is written to, mstr/<name>/_changes/<user file>.parquet with
+    the event sequencer or ETag added so every upload of the same key gets its own change set.
+    """
+    version = user_object.sequencer or (user_object.metadata.etag or '').strip('"')
+    return '{}{}{}-{}.parquet'.format(partitioned_store.get_partition_prefix(file_type), CHANGE_SET_DIRECTORY,
+                                      os.path.splitext(os.path.basename(user_object.key))[0], version)
+
+
+def write_change_set(s3, file_type, user_object, df_change_set):
+    """
+    Writes the change set of a merged user object as parquet and returns its key. Written after the master, so
+    a consumer never sees changes the master does not have yet. The master is already committed by then, a failed
+    write is logged and returns an empty key rather than failing the merge, which a retry could not redo.
+    """
+    buffer = io.BytesIO()
+    df_change_set.to_parquet(buffer, index=False)
+    key = get_change_set_key(file_type, user_object)
+    try:
+        s3.Object(user_object.bucket, key).put(Body=buffer.getvalue())
+    except ClientError as e:
+        logging.info('Handling ClientError: {}, change set {} not written.'.format(e, key))
+        return ''
+    logging.info('Wrote change set {} with {} rows.'.format(key, len(df_change_set.index)))
+    return key
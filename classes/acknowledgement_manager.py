@@ -0,0 +1,132 @@
+import logging
+import threading
+import time
+from botocore.exceptions import ClientError
+
+# SQS deletes at most this many messages per DeleteMessageBatch request
+MAX_BATCH_SIZE = 10
+
+
+class AcknowledgementManager:
+    """
+    Deletes finished messages from the queue in batches, one DeleteMessageBatch request for up to batch_size
+    messages instead of a request per message. A batch is sent as soon as it is full, and a background thread
+    sends whatever is waiting every max_delay_seconds. Entries of a batch that fail to delete are sent again on
+    their own, up to retries times, after that the message comes back once its visibility timeout runs out.
+    Messages whose input can't be merged are sent to the dead letter queue before they are deleted, so they are
+    kept for checking without being merged again. Without a dead letter queue they are never deleted, so a redrive
+    policy on the queue can still move them.
+    """
+    def __init__(self, queue, dead_letter_queue=None, batch_size=MAX_BATCH_SIZE, max_delay_seconds=1.0, retries=3,
+                 backoff_seconds=0.2):
+        self.queue = queue
+        self.dead_letter_queue = dead_letter_queue
+        self.batch_size = min(max(batch_size, 1), MAX_BATCH_SIZE)
+        self.max_delay_seconds = max_delay_seconds
+        self.retries = retries
+        self.backoff_seconds = backoff_seconds
+        # (message, on_deleted, time added) waiting to be deleted
+        self.pending = []
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.requests = 0
+        self.deleted = 0
+        self.failed = 0
+        self.dead_lettered = 0
+
+    def start(self):
+        if self.thread is None:
+            self.stopped.clear()
+            self.thread = threading.Thread(target=self.run, name='acknowledge', daemon=True)
+            self.thread.start()
+        return self
+
+    def run(self):
+        while not self.stopped.wait(self.max_delay_seconds):
+            self.flush()
+
+    def stop(self):
+        """
+        Stops the background thread and deletes the messages still waiting.
+        """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.flush()
+
+    def add(self, message, on_deleted=None):
+        """
+        Queues the message to be deleted, on_deleted is called with the seconds it waited once it is.
+        """
+        with self.lock:
+            self.pending.append((message, on_deleted, time.perf_counter()))
+            full = len(self.pending) >= self.batch_size
+        if full:
+            self.flush()
+
+    def dead_letter(self, message, result, on_deleted=None):
+        """
+        Sends the message to the dead letter queue with its result, then queues it to be deleted.
+        A message that can't be sent there, or with no dead letter queue set, is not deleted.
+        Returns whether it is going to be deleted.
+        """
+        if self.dead_letter_queue is None:
+            logging.info('No dead letter queue set.')
+            return False
+        try:
+            self.dead_letter_queue.send_message(
+                MessageBody=message.body,
+                MessageAttributes={'result': {'StringValue': result or 'Invalid message', 'DataType': 'String'},
+                                   'message_id': {'StringValue': message.message_id, 'DataType': 'String'}})
+        except ClientError as e:
+            logging.info('Handling ClientError: {}'.format(e))
+            return False
+        self.dead_lettered += 1
+        logging.info('Message sent to dead letter queue.')
+        self.add(message, on_deleted)
+        return True
+
+    def flush(self):
+        while True:
+            with self.lock:
+                batch, self.pending = self.pending[:self.batch_size], self.pending[self.batch_size:]
+            if not batch:
+                return
+            self.delete_batch(batch)
+
+    def delete_batch(self, batch):
+        entries = {str(index): item for index, item in enumerate(batch)}
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.backoff_seconds * 2 ** (attempt - 1))
+            self.requests += 1
+            try:
+                response = self.queue.delete_messages(Entries=[{'Id': entry_id, 'ReceiptHandle': item[0].receipt_handle}
+                                                               for entry_id, item in entries.items()])
+            except ClientError as e:
+                logging.info('Handling ClientError: {}'.format(e))
+                continue
+            for successful in response.get('Successful', []):
+                self.on_deleted(entries.pop(successful['Id']))
+            for failed in response.get('Failed', []):
+                logging.info('Delete failed: {} {}'.format(failed.get('Code'), failed.get('Message')))
+                # a bad receipt handle fails however often it is sent
+                if failed.get('SenderFault'):
+                    self.on_failed(entries.pop(failed['Id']))
+            if not entries:
+                return
+        for item in entries.values():
+            self.on_failed(item)
+
+    def on_deleted(self, item):
+        message, on_deleted, added = item
+        self.deleted += 1
+        logging.info('Message removed from queue.')
+        if on_deleted is not None:
+            on_deleted(time.perf_counter() - added)
+
+    def on_failed(self, item):
+        self.failed += 1
+        logging.info('Message {} left on queue.'.format(item[0].message_id))
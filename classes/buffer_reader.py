@@ -0,0 +1,36 @@
+import io
+
+
+class BufferReader(io.RawIOBase):
+    """
+    Read only file object over a memoryview, lets the csv parser read a downloaded object straight from the
+    download buffer.
+    """
+    def __init__(self, view):
+        self.view = view
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        start = {io.SEEK_SET: 0, io.SEEK_CUR: self.position, io.SEEK_END: len(self.view)}[whence]
+        self.position = min(max(start + offset, 0), len(self.view))
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def readinto(self, b):
+        count = min(len(b), len(self.view) - self.position)
+        b[:count] = self.view[self.position:self.position + count]
+        self.position += count
+        return count
+
+    def close(self):
+        if not self.closed:
+            self.view.release()
+        super().close()
@@ -0,0 +1,63 @@
+from collections import OrderedDict
+import threading
+
+
+class DataFrameCache:
+    """
+    Size bounded LRU cache of parsed dataframes keyed by S3 path.
+    Each entry stores the ETag it was read or written with, and only a lookup with the same ETag is a hit.
+    Cached dataframes are shared, callers must not modify them in place.
+    """
+    def __init__(self, max_bytes=512 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, path, etag):
+        """
+        Returns the cached dataframe for the path if it was cached with the given ETag, otherwise None.
+        """
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is None or etag is None or entry[0] != etag:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(path)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, path, etag, df):
+        """
+        Caches the dataframe, evicting the least recently used entries until it fits.
+        Dataframes larger than the whole cache are not cached.
+        """
+        size = int(df.memory_usage(index=True, deep=True).sum())
+        with self.lock:
+            self._remove(path)
+            if size > self.max_bytes:
+                return
+            self.entries[path] = (etag, df, size)
+            self.current_bytes += size
+            self._evict()
+
+    def invalidate(self, path):
+        with self.lock:
+            self._remove(path)
+
+    def set_max_bytes(self, max_bytes):
+        with self.lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def _remove(self, path):
+        entry = self.entries.pop(path, None)
+        if entry is not None:
+            self.current_bytes -= entry[2]
+
+    def _evict(self):
+        while self.current_bytes > self.max_bytes and self.entries:
+            path, entry = self.entries.popitem(last=False)
+            self.current_bytes -= entry[2]
@@ -0,0 +1,47 @@
+import io
+import compression_functions
+
+
+class DecompressingReader(io.RawIOBase):
+    """
+    Read only file object that decompresses a compressed object as it is read, so the parser streams through the
+    file without the whole decompressed text being held. Seeking back to the start begins decompressing again,
+    which is all the parsers need.
+    """
+    def __init__(self, source, codec):
+        self.source = source
+        self.codec = codec
+        self.stream = compression_functions.open_decompressed(source, codec)
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence != io.SEEK_SET:
+            raise io.UnsupportedOperation('Can only seek from the start of a compressed file.')
+        if offset < self.position:
+            self.source.seek(0)
+            self.stream = compression_functions.open_decompressed(self.source, self.codec)
+            self.position = 0
+        while self.position < offset:
+            if not self.read(min(offset - self.position, io.DEFAULT_BUFFER_SIZE)):
+                break
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def readinto(self, b):
+        count = self.stream.readinto(b)
+        self.position += count
+        return count
+
+    def close(self):
+        self.stream = None
+        super().close()
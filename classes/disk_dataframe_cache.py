@@ -0,0 +1,182 @@
+from collections import OrderedDict
+import hashlib
+import logging
+import os
+import threading
+import uuid
+
+try:
+    import pyarrow
+    import pyarrow.feather
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+# schema metadata the S3 path and ETag of a cached dataframe are stored under
+PATH_KEY = b's3_path'
+ETAG_KEY = b's3_etag'
+EXTENSION = '.arrow'
+
+
+class DiskDataFrameCache:
+    """
+    Size bounded LRU cache of dataframes on local disk, keyed by S3 path and ETag like DataFrameCache.
+    Each dataframe is an uncompressed Arrow IPC (Feather) file that is memory mapped when it is read, so a master
+    comes back without being downloaded or parsed again. The path and ETag are kept in the file's schema metadata
+    and the last use in its modification time, so the cache is rebuilt from the directory after a restart.
+    """
+    def __init__(self, directory, max_bytes=4 * 1024 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        # path -> (etag, file path, size), least recently used first
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        if pyarrow is None:
+            logging.info('The disk cache needs pyarrow, it is turned off.')
+            return
+        os.makedirs(directory, exist_ok=True)
+        self.load()
+
+    def get_file_path(self, path, etag):
+        name = hashlib.sha1('{}|{}'.format(path, etag).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, name + EXTENSION)
+
+    def load(self):
+        """
+        Adds the files already in the directory, removing unreadable files, leftovers of interrupted writes and
+        older versions of a path.
+        """
+        files = []
+        for name in os.listdir(self.directory):
+            file_path = os.path.join(self.directory, name)
+            if not name.endswith(EXTENSION):
+                self._remove_file(file_path)
+                continue
+            try:
+                with pyarrow.memory_map(file_path) as source:
+                    metadata = pyarrow.ipc.open_file(source).schema.metadata or {}
+                stat = os.stat(file_path)
+                files.append((stat.st_mtime, metadata[PATH_KEY].decode('utf-8'), metadata[ETAG_KEY].decode('utf-8'),
+                              file_path, stat.st_size))
+            except (OSError, KeyError, pyarrow.ArrowException) as e:
+                logging.info('Handling disk cache error: {}'.format(e))
+                self._remove_file(file_path)
+        with self.lock:
+            for last_used, path, etag, file_path, size in sorted(files):
+                self._remove(path)
+                self.entries[path] = (etag, file_path, size)
+                self.current_bytes += size
+            self._evict()
+        logging.info('Disk cache: {} dataframes, {} bytes'.format(len(self.entries), self.current_bytes))
+
+    def get(self, path, etag):
+        """
+        Returns the cached dataframe for the path if it was cached with the given ETag, otherwise None.
+        """
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is None or etag is None or entry[0] != etag:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(path)
+        df = self.read(entry[1])
+        with self.lock:
+            if df is None:
+                self.misses += 1
+                if self.entries.get(path) is entry:
+                    self._remove(path)
+                return None
+            self.hits += 1
+        return df
+
+    def read(self, file_path):
+        try:
+            with pyarrow.memory_map(file_path) as source:
+                df = pyarrow.ipc.open_file(source).read_all().to_pandas()
+            # the modification time is the last use when the cache is loaded again
+            os.utime(file_path)
+            return df
+        except (OSError, pyarrow.ArrowException) as e:
+            logging.info('Handling disk cache error: {}'.format(e))
+            return None
+
+    def put(self, path, etag, df):
+        """
+        Writes the dataframe to the cache, evicting the least recently used files until it fits.
+        Dataframes larger than the whole cache, or that Arrow can not store, are not cached.
+        """
+        if pyarrow is None or etag is None or self.max_bytes <= 0:
+            return
+        file_path = self.get_file_path(path, etag)
+        temp_path = '{}.{}.tmp'.format(file_path, uuid.uuid4().hex)
+        try:
+            table = pyarrow.Table.from_pandas(df)
+            metadata = dict(table.schema.metadata or {})
+            metadata.update({PATH_KEY: path.encode('utf-8'), ETAG_KEY: etag.encode('utf-8')})
+            table = table.replace_schema_metadata(metadata)
+            pyarrow.feather.write_feather(table, temp_path, compression='uncompressed')
+            # readers only ever see a whole file
+            os.replace(temp_path, file_path)
+            size = os.path.getsize(file_path)
+        except (OSError, pyarrow.ArrowException) as e:
+            logging.info('Handling disk cache error: {}'.format(e))
+            self._remove_file(temp_path)
+            return
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is None or entry[1] != file_path:
+                self._remove(path)
+            else:
+                self.current_bytes -= self.entries.pop(path)[2]
+            if size > self.max_bytes:
+                self._remove_file(file_path)
+                return
+            self.entries[path] = (etag, file_path, size)
+            self.current_bytes += size
+            self._evict()
+
+    def warm(self, cache, count):
+        """
+        Reads the count most recently used dataframes into the in memory cache, the most recent last so it is the
+        last to be evicted there. Returns how many were read.
+        """
+        with self.lock:
+            entries = list(self.entries.items())[-count:] if count > 0 else []
+        warmed = 0
+        for path, (etag, file_path, size) in entries:
+            df = self.read(file_path)
+            if df is not None:
+                cache.put(path, etag, df)
+                warmed += 1
+        return warmed
+
+    def invalidate(self, path):
+        with self.lock:
+            self._remove(path)
+
+    def set_max_bytes(self, max_bytes):
+        with self.lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def _remove(self, path):
+        entry = self.entries.pop(path, None)
+        if entry is not None:
+            self.current_bytes -= entry[2]
+            self._remove_file(entry[1])
+
+    def _evict(self):
+        while self.current_bytes > self.max_bytes and self.entries:
+            path, entry = self.entries.popitem(last=False)
+            self.current_bytes -= entry[2]
+            self._remove_file(entry[1])
+
+    @staticmethod
+    def _remove_file(file_path):
+        try:
+            os.remove(file_path)
+        except OSError:
+            pass
@@ -0,0 +1,49 @@
+import json
+import threading
+import time
+
+
+class EmfExporter:
+    """
+    Writes each file's metrics to a local file in CloudWatch embedded metric format, for the CloudWatch agent to
+    ship. The numeric fields are published as metrics under the namespace, with the master file and the result
+    as dimensions.
+    """
+    def __init__(self, path, namespace='s3-data-merge'):
+        self.path = path
+        self.namespace = namespace
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_unit(name):
+        if name.endswith('_seconds'):
+            return 'Seconds'
+        if name.startswith('bytes_') or name.endswith('_file_size'):
+            return 'Bytes'
+        if name.endswith('_mb'):
+            return 'Megabytes'
+        return 'Count'
+
+    def get_document(self, record):
+        document = {'MstrFileName': record['mstr_file_name'], 'Result': record['result']}
+        metrics = []
+        for name, value in record.items():
+            if isinstance(value, dict):
+                for stage, seconds in value.items():
+                    document['{}_seconds'.format(stage)] = seconds
+                    metrics.append({'Name': '{}_seconds'.format(stage), 'Unit': 'Seconds'})
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                document[name] = value
+                metrics.append({'Name': name, 'Unit': self.get_unit(name)})
+        document['StgFileName'] = record['stg_file_name']
+        document['_aws'] = {'Timestamp': int(time.time() * 1000),
+                            'CloudWatchMetrics': [{'Namespace': self.namespace,
+                                                   'Dimensions': [['MstrFileName', 'Result']],
+                                                   'Metrics': metrics}]}
+        return document
+
+    def export(self, record):
+        line = json.dumps(self.get_document(record))
+        with self.lock:
+            with open(self.path, 'a') as emf_file:
+                emf_file.write(line + '\n')
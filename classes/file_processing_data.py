@@ -15,7 +15,22 @@ class FileProcessingData:
                  mstr_new_column_count=0,
                  mstr_new_file_size=0,
                  update_count=0,
-                 new_record_count=0
+                 new_record_count=0,
+                 mstr_cache_hits=0,
+                 mstr_cache_misses=0,
+                 mstr_disk_cache_hits=0,
+                 mstr_disk_cache_misses=0,
+                 stage_seconds=None,
+                 bytes_downloaded=0,
+                 bytes_uploaded=0,
+                 peak_memory_mb=0,
+                 stg_uncompressed_size=0,
+                 mstr_prev_uncompressed_size=0,
+                 mstr_new_uncompressed_size=0,
+                 unchanged_count=0,
+                 duplicate_event=0,
+                 mstr_write_skipped=0,
+                 change_set_key=''
                  ):
         self.stg_file_name = stg_file_name
         self.mstr_file_name = mstr_file_name
@@ -32,6 +47,30 @@ class FileProcessingData:
         self.mstr_new_file_size = mstr_new_file_size
         self.update_count = update_count
         self.new_record_count = new_record_count
+        # running totals for the master dataframe cache of this process
+        self.mstr_cache_hits = mstr_cache_hits
+        self.mstr_cache_misses = mstr_cache_misses
+        # running totals for the local disk cache of masters, kept at 0 when it is turned off
+        self.mstr_disk_cache_hits = mstr_disk_cache_hits
+        self.mstr_disk_cache_misses = mstr_disk_cache_misses
+        # wall time of each stage of processing the file, stages shared by a batch are counted on its first file
+        self.stage_seconds = stage_seconds if stage_seconds is not None else {}
+        self.bytes_downloaded = bytes_downloaded
+        self.bytes_uploaded = bytes_uploaded
+        # peak resident set size of the process when the file finished
+        self.peak_memory_mb = peak_memory_mb
+        # size of the csv text, the file sizes above are what is stored in S3 and are smaller for compressed files
+        self.stg_uncompressed_size = stg_uncompressed_size
+        self.mstr_prev_uncompressed_size = mstr_prev_uncompressed_size
+        self.mstr_new_uncompressed_size = mstr_new_uncompressed_size
+        # updates that left the row as it was
+        self.unchanged_count = unchanged_count
+        # 1 when the event was already in the processed ledger and the file was not merged again
+        self.duplicate_event = duplicate_event
+        # 1 when no mstr row changed and the master was not rewritten
+        self.mstr_write_skipped = mstr_write_skipped
+        # key of the change set written for the file, when its file type writes them
+        self.change_set_key = change_set_key
 
     def __str__(self):
         data_string = 'stg_file_name: {} \n'.format(self.stg_file_name)
@@ -49,5 +88,27 @@ class FileProcessingData:
         data_string = data_string + 'mstr_new_file_size: {}\n'.format(self.mstr_new_file_size)
         data_string = data_string + 'update_count: {}\n'.format(self.update_count)
         data_string = data_string + 'new_record_count: {}\n'.format(self.new_record_count)
+        data_string = data_string + 'unchanged_count: {}\n'.format(self.unchanged_count)
+        data_string = data_string + 'duplicate_event: {}\n'.format(self.duplicate_event)
+        data_string = data_string + 'mstr_write_skipped: {}\n'.format(self.mstr_write_skipped)
+        if self.change_set_key:
+            data_string = data_string + 'change_set_key: {}\n'.format(self.change_set_key)
+        data_string = data_string + 'mstr_cache_hits: {}\n'.format(self.mstr_cache_hits)
+        data_string = data_string + 'mstr_cache_misses: {}\n'.format(self.mstr_cache_misses)
+        data_string = data_string + 'mstr_disk_cache_hits: {}\n'.format(self.mstr_disk_cache_hits)
+        data_string = data_string + 'mstr_disk_cache_misses: {}\n'.format(self.mstr_disk_cache_misses)
+        for stage, seconds in self.stage_seconds.items():
+            data_string = data_string + '{}_seconds: {:.3f}\n'.format(stage, seconds)
+        data_string = data_string + 'bytes_downloaded: {}\n'.format(self.bytes_downloaded)
+        data_string = data_string + 'bytes_uploaded: {}\n'.format(self.bytes_uploaded)
+        data_string = data_string + 'stg_uncompressed_size: {}\n'.format(self.stg_uncompressed_size)
+        data_string = data_string + 'mstr_prev_uncompressed_size: {}\n'.format(self.mstr_prev_uncompressed_size)
+        data_string = data_string + 'mstr_new_uncompressed_size: {}\n'.format(self.mstr_new_uncompressed_size)
         return data_string
 
+    def to_dict(self):
+        """
+        Returns the stats as a dictionary that can be written out as json.
+        """
+        return dict(vars(self), stage_seconds=dict(self.stage_seconds))
+
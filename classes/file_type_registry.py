@@ -0,0 +1,103 @@
+import fnmatch
+import logging
+import re
+import threading
+import time
+from classes.file_types import FileType
+
+WILDCARD_CHARACTERS = '*?['
+
+
+class FileTypeRegistry:
+    """
+    Looks up the file type for an object key.
+    Patterns are indexed in a trie on their literal prefix, the part before the first wildcard, so a lookup only
+    runs the precompiled patterns whose prefix the key starts with. When several patterns match, the one listed
+    first in the store wins. The store is checked for changes at most every reload_interval seconds.
+    """
+    def __init__(self, store, reload_interval=5):
+        self.store = store
+        self.reload_interval = reload_interval
+        self.lock = threading.Lock()
+        self.trie = {}
+        self.file_types = []
+        self.loaded_version = None
+        self.last_checked = 0
+        self.reload()
+
+    def reload(self):
+        """
+        Rebuilds the index from the store.
+        """
+        with self.lock:
+            version = self.store.version()
+            file_types = []
+            for item in self.store.load():
+                try:
+                    file_types.append(FileType.from_dict(item))
+                except ValueError as e:
+                    # a file type with settings the merge can't honour is left out rather than merged wrongly
+                    logging.info('Handling ValueError: {}'.format(e))
+            trie = {}
+            for order, file_type in enumerate(file_types):
+                self._insert(trie, order, file_type)
+            self.trie = trie
+            self.file_types = file_types
+            self.loaded_version = version
+            self.last_checked = time.monotonic()
+        logging.info('Loaded {} file types.'.format(len(file_types)))
+
+    def reload_if_changed(self):
+        if time.monotonic() - self.last_checked < self.reload_interval:
+            return
+        self.last_checked = time.monotonic()
+        if self.store.version() != self.loaded_version:
+            self.reload()
+
+    def lookup(self, object_key):
+        """
+        Returns the first file type whose incoming_file_pattern matches the key, or None.
+        """
+        self.reload_if_changed()
+        node = self.trie
+        candidates = list(node.get(None, []))
+        for character in object_key:
+            node = node.get(character)
+            if node is None:
+                break
+            candidates.extend(node.get(None, []))
+        for order, pattern, file_type in sorted(candidates, key=lambda candidate: candidate[0]):
+            if pattern.match(object_key):
+                return file_type
+        return None
+
+    def add(self, file_type):
+        """
+        Persists a new file type to the store and adds it to the index.
+        """
+        self.store.put(file_type.to_dict())
+        with self.lock:
+            self._insert(self.trie, len(self.file_types), file_type)
+            self.file_types.append(file_type)
+            self.loaded_version = self.store.version()
+
+    def update(self, file_type):
+        """
+        Persists a change to a file type already in the index, such as a newly inferred schema.
+        """
+        self.store.put(file_type.to_dict())
+        with self.lock:
+            self.loaded_version = self.store.version()
+
+    def __len__(self):
+        return len(self.file_types)
+
+    @staticmethod
+    def _insert(trie, order, file_type):
+        pattern = file_type.incoming_file_pattern
+        prefix_length = min([pattern.find(character) for character in WILDCARD_CHARACTERS if character in pattern] +
+                            [len(pattern)])
+        node = trie
+        for character in pattern[:prefix_length]:
+            node = node.setdefault(character, {})
+        node.setdefault(None, []).append((order, re.compile(fnmatch.translate(pattern)), file_type))
@@ -1,11 +1,83 @@
+# how the stg rows are applied to the mstr, see update_mode
+UPDATE_MODES = ('replace', 'partial')
+
+
 class FileType:
-    def __init__(self, file_process_name, incoming_file_pattern, master_file_s3_key, primary_key, field_delimiter, text_qualifier):
+    def __init__(self, file_process_name, incoming_file_pattern, master_file_s3_key, primary_key, field_delimiter, text_qualifier,
+                 merge_mode='memory', memory_limit_mb=512, storage_format='csv', partition_count=16,
+                 dedupe_strategy='last', timestamp_column=None, compaction_row_limit=1000000,
+                 compaction_age_minutes=60, column_schema=None, infer_schema=False, mstr_compression=None,
+                 mstr_compression_level=None, write_change_set=False, update_mode='replace', export_csv=False):
         self.file_process_name = file_process_name
         self.incoming_file_pattern = incoming_file_pattern
         self.master_file_s3_key = master_file_s3_key
+        # a single column name, or a list of column names for a composite key.
         self.primary_key = primary_key
         self.field_delimiter = field_delimiter
         self.text_qualifier = text_qualifier
+        # 'memory' loads both files into dataframes, 'streaming' spills hash partitions to local disk,
+        # 'delta' appends the stg rows to a delta log that is compacted into the master later.
+        self.merge_mode = merge_mode
+        # upper bound on the memory a streaming merge should use.
+        self.memory_limit_mb = memory_limit_mb
+        # 'csv' keeps the master as a single object, 'parquet' stores it as hash partitions of the primary key.
+        self.storage_format = storage_format
+        # number of partitions a new parquet master is split into.
+        self.partition_count = partition_count
+        # which stg row wins when a key is repeated: 'first', 'last' or 'newest' by timestamp_column.
+        self.dedupe_strategy = dedupe_strategy
+        self.timestamp_column = timestamp_column
+        # a delta master is compacted once its deltas hold this many rows or the oldest is this old.
+        self.compaction_row_limit = compaction_row_limit
+        self.compaction_age_minutes = compaction_age_minutes
+        # optional {'dtypes': {column: dtype}, 'categorical_columns': [...], 'columns': [...]}, columns limits the
+        # columns read and kept. Files of a type with a schema are parsed with pyarrow.
+        self.column_schema = column_schema
+        # infer the schema from the first file read and save it to the registry, set for created file types.
+        self.infer_schema = infer_schema
+        # codec the master is written with, 'gzip', 'zstd' or 'bz2', None writes it uncompressed. The level is the
+        # codec's compression level, None uses the codec default.
+        self.mstr_compression = mstr_compression
+        self.mstr_compression_level = mstr_compression_level
+        # write the inserted, updated and unchanged keys of every merged file to a parquet object next to the master.
+        self.write_change_set = write_change_set
+        # 'replace' swaps every mstr row the stg has for the stg row, 'partial' only sets the columns the stg file
+        # has and leaves the other mstr columns as they are, for stg files carrying the key and the changed columns.
+        self.update_mode = update_mode
+        # write a parquet master out as a single csv object at master_file_s3_key after every merge that changes it.
+        self.export_csv = export_csv
+        self.validate()
+
+    def validate(self):
+        """
+        Raises a ValueError for settings the merge modes can not honour.
+        """
+        if self.update_mode not in UPDATE_MODES:
+            raise ValueError('Unknown update mode {} for {}'.format(self.update_mode, self.file_process_name))
+        if self.merge_mode == 'delta' and self.write_change_set:
+            # a delta is appended without reading the master, so there is nothing to compare it with
+            raise ValueError('{} can not write change sets with the delta merge mode'.format(self.file_process_name))
+        if self.export_csv and self.storage_format != 'parquet':
+            raise ValueError('{} can only export a parquet master to csv'.format(self.file_process_name))
+
+    @property
+    def key_columns(self):
+        """
+        Returns the primary key as a list of column names.
+        """
+        if isinstance(self.primary_key, (list, tuple)):
+            return list(self.primary_key)
+        return [self.primary_key]
+
+    def to_dict(self):
+        """
+        Returns the file type as a dictionary that can be stored in the file type registry.
+        """
+        return dict(vars(self))
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
 
     def __eq__(self, other):
         return self.file_process_name == other.file_process_name and self.incoming_file_pattern == other.incoming_file_pattern\
@@ -0,0 +1,17 @@
+import json
+import threading
+
+
+class JsonLinesExporter:
+    """
+    Appends each file's metrics to a file as a line of json.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def export(self, record):
+        line = json.dumps(record, sort_keys=True)
+        with self.lock:
+            with open(self.path, 'a') as metrics_file:
+                metrics_file.write(line + '\n')
@@ -0,0 +1,60 @@
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import threading
+
+
+class KeyedExecutor:
+    """
+    Thread pool that runs tasks with different keys in parallel, while tasks sharing a key run one at a time in the
+    order they were submitted.
+    """
+    def __init__(self, max_workers):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.lock = threading.Lock()
+        # tasks waiting behind the running task for each key
+        self.waiting = {}
+        self.in_flight = set()
+
+    def submit(self, key, fn, *args):
+        """
+        Schedules fn(*args) to run after every task already submitted with the same key. Returns a Future.
+        """
+        future = Future()
+        with self.lock:
+            self.in_flight.add(future)
+            if key in self.waiting:
+                self.waiting[key].append((future, fn, args))
+                return future
+            self.waiting[key] = deque()
+        self.executor.submit(self._run, key, future, fn, args)
+        return future
+
+    def _run(self, key, future, fn, args):
+        if future.set_running_or_notify_cancel():
+            try:
+                future.set_result(fn(*args))
+            except BaseException as e:
+                future.set_exception(e)
+        with self.lock:
+            self.in_flight.discard(future)
+            if self.waiting[key]:
+                next_task = self.waiting[key].popleft()
+            else:
+                del self.waiting[key]
+                next_task = None
+        if next_task is not None:
+            self.executor.submit(self._run, key, *next_task)
+
+    def pending(self):
+        """
+        Returns the futures that are running or waiting to run.
+        """
+        with self.lock:
+            return set(self.in_flight)
+
+    def shutdown(self, wait=True):
+        # wait for the queued tasks first, they are only handed to the pool when the task ahead of them finishes
+        if wait:
+            for future in self.pending():
+                future.exception()
+        self.executor.shutdown(wait=wait)
@@ -0,0 +1,63 @@
+import json
+import os
+import tempfile
+import threading
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+
+class LocalFileTypeStore:
+    """
+    File type store backed by a local JSON or YAML file holding a list of file type dictionaries.
+    YAML is used for .yaml and .yml files and needs PyYAML installed.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        if self.is_yaml() and yaml is None:
+            raise ImportError('PyYAML is required to read {}'.format(path))
+
+    def is_yaml(self):
+        return os.path.splitext(self.path)[1].lower() in ('.yaml', '.yml')
+
+    def version(self):
+        """
+        Returns a value that changes whenever the file changes.
+        """
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path) as registry_file:
+            if self.is_yaml():
+                return yaml.safe_load(registry_file) or []
+            return json.load(registry_file)
+
+    def put(self, file_type_data):
+        """
+        Appends a file type to the file, or replaces the one with the same incoming_file_pattern in place so the
+        order of the patterns does not change.
+        The file is rewritten through a temporary file so a reader never sees it half written.
+        """
+        with self.lock:
+            items = self.load()
+            patterns = [item['incoming_file_pattern'] for item in items]
+            if file_type_data['incoming_file_pattern'] in patterns:
+                items[patterns.index(file_type_data['incoming_file_pattern'])] = file_type_data
+            else:
+                items.append(file_type_data)
+            directory = os.path.dirname(os.path.abspath(self.path))
+            with tempfile.NamedTemporaryFile('w', dir=directory, delete=False) as registry_file:
+                if self.is_yaml():
+                    yaml.safe_dump(items, registry_file, sort_keys=False)
+                else:
+                    json.dump(items, registry_file, indent=2)
+            os.replace(registry_file.name, self.path)
@@ -0,0 +1,32 @@
+import json
+import os
+import threading
+
+
+class LocalLedgerStore:
+    """
+    Ledger store backed by a local JSON lines file, one processed object per line.
+    The file is read once when the store is created and new entries are appended, so the ledger survives a
+    restart of the app.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entry_keys = set()
+        if os.path.exists(path):
+            with open(path) as ledger_file:
+                for line in ledger_file:
+                    if line.strip():
+                        self.entry_keys.add(json.loads(line)['key'])
+
+    def contains(self, entry_key):
+        with self.lock:
+            return entry_key in self.entry_keys
+
+    def put(self, entry_key, entry_data):
+        with self.lock:
+            if entry_key in self.entry_keys:
+                return
+            with open(self.path, 'a') as ledger_file:
+                ledger_file.write(json.dumps(dict(entry_data, key=entry_key)) + '\n')
+            self.entry_keys.add(entry_key)
@@ -0,0 +1,26 @@
+import copy
+import threading
+
+
+class MemoryFileTypeStore:
+    """
+    In memory file type store, standing in for a DynamoDB table keyed on incoming_file_pattern.
+    """
+    def __init__(self, items=None):
+        self.items = {}
+        self.updates = 0
+        self.lock = threading.Lock()
+        for item in items or []:
+            self.put(item)
+
+    def version(self):
+        return self.updates
+
+    def load(self):
+        with self.lock:
+            return [copy.deepcopy(item) for item in self.items.values()]
+
+    def put(self, file_type_data):
+        with self.lock:
+            self.items[file_type_data['incoming_file_pattern']] = copy.deepcopy(file_type_data)
+            self.updates += 1
@@ -0,0 +1,18 @@
+import threading
+
+
+class MemoryLedgerStore:
+    """
+    In memory ledger store, standing in for a DynamoDB table keyed on the ledger key.
+    """
+    def __init__(self):
+        self.items = {}
+        self.lock = threading.Lock()
+
+    def contains(self, entry_key):
+        with self.lock:
+            return entry_key in self.items
+
+    def put(self, entry_key, entry_data):
+        with self.lock:
+            self.items[entry_key] = dict(entry_data)
@@ -0,0 +1,28 @@
+class MergeBatch:
+    """
+    State of a read-merge-write cycle for a list of user objects sharing a master, passed between the load,
+    apply and write steps.
+    """
+    def __init__(self, user_objects, file_type):
+        self.user_objects = user_objects
+        self.file_type = file_type
+        self.mstr_object = None
+        self.df_mstr = None
+        self.mstr_prev_file_size = 0
+        # ETag of the master when it was loaded, None when there was no master
+        self.mstr_etag = None
+        # loaded stg dataframes as (index, dataframe) in the order they are applied
+        self.stg_frames = []
+        # (index, FileProcessingData) for the user objects applied to df_mstr
+        self.applied = []
+        # whether any applied user object changed a mstr row, the master is only written when one did
+        self.mstr_changed = False
+        # change set dataframe of each applied user object by index, when the file type writes change sets
+        self.change_sets = {}
+        self.results = [None] * len(user_objects)
+
+    def fail(self, result):
+        """
+        Returns the results with every user object that has no result yet set to the given result.
+        """
+        return [existing or result for existing in self.results]
@@ -0,0 +1,214 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from functools import partial
+import logging
+from classes.pipeline_job import PipelineJob
+from classes.poll_scheduler import PollScheduler
+from classes.visibility_heartbeat import VisibilityHeartbeat
+from botocore.exceptions import ClientError
+from pandas.core.groupby.groupby import DataError
+import delta_log
+import message_functions
+import s3_functions
+
+
+class MergePipeline:
+    """
+    Runs the poll, download, merge and upload steps as asyncio stages joined by bounded queues, so the next batch
+    of messages and objects is fetched while the current merge runs and uploads happen in the background.
+    A full queue makes the stage in front of it wait, which holds back polling when merges fall behind.
+    Jobs for the same master hold a lock from download until their upload commits, so they stay in order, and
+    messages are only deleted after the upload of their master. Messages are added to the heartbeat as soon as
+    they are received and removed when they are acknowledged. A lock is dropped once no job for its master holds
+    or waits for it.
+    """
+    def __init__(self, queue, worker_count, minutes_without_message_limit, queue_size=4, scheduler=None,
+                 heartbeat=None):
+        self.queue = queue
+        self.scheduler = scheduler if scheduler is not None else PollScheduler(queue)
+        self.heartbeat = heartbeat
+        self.worker_count = worker_count
+        self.minutes_without_message_limit = minutes_without_message_limit
+        self.load_queue = None
+        self.merge_queue = None
+        self.upload_queue = None
+        self.queue_size = queue_size
+        self.io_executor = None
+        self.merge_executor = None
+        self.locks = {}
+        # number of jobs holding or waiting for the lock of each master
+        self.lock_users = {}
+
+    async def run(self):
+        self.load_queue = asyncio.Queue(maxsize=self.queue_size)
+        self.merge_queue = asyncio.Queue(maxsize=self.queue_size)
+        self.upload_queue = asyncio.Queue(maxsize=self.queue_size)
+        self.io_executor = ThreadPoolExecutor(max_workers=self.worker_count * 2, thread_name_prefix='io')
+        self.merge_executor = ThreadPoolExecutor(max_workers=self.worker_count, thread_name_prefix='merge')
+        own_heartbeat = self.heartbeat is None
+        if own_heartbeat:
+            self.heartbeat = VisibilityHeartbeat([], message_functions.visibility_timeout,
+                                                 message_functions.heartbeat_interval, self.queue).start()
+        stages = []
+        for worker in range(self.worker_count):
+            stages.append(asyncio.create_task(self.load_stage()))
+            stages.append(asyncio.create_task(self.merge_stage()))
+            stages.append(asyncio.create_task(self.upload_stage()))
+        try:
+            await self.poll_stage()
+            # let the jobs already taken off the queue finish
+            await self.load_queue.join()
+            await self.merge_queue.join()
+            await self.upload_queue.join()
+        finally:
+            for stage in stages:
+                stage.cancel()
+            await asyncio.gather(*stages, return_exceptions=True)
+            self.io_executor.shutdown(wait=True)
+            self.merge_executor.shutdown(wait=True)
+            if own_heartbeat:
+                self.heartbeat.stop()
+                self.heartbeat = None
+
+    async def run_in(self, executor, function, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(executor, partial(function, *args, **kwargs))
+
+    async def poll_stage(self):
+        last_message_received = datetime.now()
+        while last_message_received > datetime.now() - timedelta(minutes=float(self.minutes_without_message_limit)):
+            logging.info('Polling Queue')
+            messages = await self.run_in(self.io_executor, self.scheduler.receive)
+            if bool(messages):
+                last_message_received = datetime.now()
+                logging.info('Received Message: {}'.format(last_message_received))
+                await self.run_in(self.io_executor, self.heartbeat.add, messages)
+                # the file type lookup can read the registry store, so it is kept off the event loop
+                batches = await self.run_in(self.io_executor, message_functions.group_messages, messages)
+                for key, file_type, entries in batches:
+                    job = PipelineJob(key, file_type, entries, message_functions.log_entries(entries))
+                    await self.load_queue.put(job)
+            else:
+                # nothing to merge, fold aged deltas into their masters
+                await self.run_in(self.io_executor, delta_log.schedule_due_compactions)
+
+    async def load_stage(self):
+        while True:
+            job = await self.load_queue.get()
+            try:
+                if self.is_mergeable(job):
+                    # taken straight after get so jobs for the same master queue up on the lock in order
+                    job.lock = self.get_lock(job.key)
+                    await job.lock.acquire()
+                    if self.uses_batch_steps(job):
+                        await self.run_in(self.io_executor, self.run_step, job, self.load_job)
+                await self.merge_queue.put(job)
+            finally:
+                self.load_queue.task_done()
+
+    async def merge_stage(self):
+        while True:
+            job = await self.merge_queue.get()
+            try:
+                if self.is_mergeable(job) and self.uses_batch_steps(job):
+                    await self.run_in(self.merge_executor, self.run_step, job, self.apply_job)
+                elif self.is_mergeable(job):
+                    # parquet and streaming file types do the whole merge in one call
+                    await self.run_in(self.merge_executor, self.merge_job, job)
+                await self.upload_queue.put(job)
+            finally:
+                self.merge_queue.task_done()
+
+    async def upload_stage(self):
+        while True:
+            job = await self.upload_queue.get()
+            try:
+                if self.is_mergeable(job) and self.uses_batch_steps(job):
+                    await self.run_in(self.io_executor, self.run_step, job, self.write_job)
+                self.heartbeat.remove([message for message, user_object in job.entries])
+                try:
+                    await self.run_in(self.io_executor, message_functions.acknowledge_messages, job.entries,
+                                      job.results)
+                except Exception as e:
+                    # the messages are left on the queue to be merged again, the stage carries on with the next job
+                    logging.info('Handling Exception error: {}'.format(e))
+            finally:
+                if job.lock is not None:
+                    job.lock.release()
+                    self.release_lock(job.key)
+                self.upload_queue.task_done()
+
+    def get_lock(self, key):
+        """
+        Returns the lock of the master, counting the job as one of its users.
+        """
+        self.lock_users[key] = self.lock_users.get(key, 0) + 1
+        return self.locks.setdefault(key, asyncio.Lock())
+
+    def release_lock(self, key):
+        """
+        Drops the lock of the master once the last job using it is done with it.
+        """
+        self.lock_users[key] -= 1
+        if self.lock_users[key] == 0:
+            del self.lock_users[key]
+            del self.locks[key]
+
+    @staticmethod
+    def is_mergeable(job):
+        return bool(job.file_type) and bool(job.valid)
+
+    @staticmethod
+    def uses_batch_steps(job):
+        return job.file_type.storage_format == 'csv' and job.file_type.merge_mode == 'memory'
+
+    @staticmethod
+    def run_step(job, step):
+        """
+        Runs one step of the batch merge, once a step fails the later steps are skipped.
+        """
+        if job.failed:
+            return
+        try:
+            step(job)
+            return
+        except DataError as e:
+            logging.info('Handling DataError: {}'.format(e))
+            result = 'Error'
+        except KeyError as e:
+            logging.info('Handling KeyError: {}'.format(e))
+            result = 'Key error'
+        except Exception as e:
+            logging.info('Handling Exception error: {}'.format(e))
+            result = 'Error'
+        job.failed = True
+        if job.batch is None:
+            job.set_batch_results([result] * len(job.valid))
+        else:
+            job.set_batch_results(job.batch.fail(result))
+
+    @staticmethod
+    def load_job(job):
+        job.batch = s3_functions.load_batch(s3_functions.get_s3_resource(), [job.entries[index][1] for index in job.valid],
+                                            job.file_type)
+
+    @staticmethod
+    def apply_job(job):
+        s3_functions.apply_batch(job.batch)
+
+    @staticmethod
+    def write_job(job):
+        try:
+            job.set_batch_results(s3_functions.write_batch(s3_functions.get_s3_resource(), job.batch))
+        except ClientError as e:
+            if not s3_functions.is_conflict(e):
+                raise
+            # another worker wrote the master after this job loaded it, merge the batch again on top of its version
+            logging.info('Mstr {} changed while merging.'.format(job.key))
+            job.set_batch_results(s3_functions.merge_batch_to_mstr([job.entries[index][1] for index in job.valid],
+                                                                   job.file_type))
+
+    @staticmethod
+    def merge_job(job):
+        job.set_batch_results(s3_functions.merge_batch_to_mstr([job.entries[index][1] for index in job.valid],
+                                                               job.file_type))
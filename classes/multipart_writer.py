@@ -0,0 +1,105 @@
+from concurrent.futures import ThreadPoolExecutor
+import io
+import logging
+import threading
+import time
+
+
+class MultipartWriter(io.RawIOBase):
+    """
+    Writable file object that uploads to an S3 object as it is written.
+    Every part_size bytes written are sent as a part of a multipart upload on a background thread, at most
+    max_concurrency parts are in flight and a write waits for a free slot. Closing the writer uploads the last
+    part and completes the upload, an object smaller than one part is sent with a single PUT instead.
+    Call abort if writing fails, closing would commit the partial object.
+    conditions are the IfMatch or IfNoneMatch arguments of the request that commits the object, so it is only
+    written if the object has not changed since it was read.
+    """
+    def __init__(self, s3, s3_object, part_size, max_concurrency, conditions=None):
+        self.s3 = s3
+        self.s3_object = s3_object
+        self.part_size = part_size
+        self.max_concurrency = max_concurrency
+        self.conditions = conditions or {}
+        self.part = bytearray()
+        self.parts = []
+        self.upload_id = None
+        self.executor = None
+        self.slots = threading.BoundedSemaphore(max_concurrency)
+        self.size = 0
+        self.response = None
+        # time writes spent waiting for a free upload slot
+        self.wait_seconds = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.part += b
+        self.size += len(b)
+        while len(self.part) >= self.part_size:
+            self._submit_part(self.part[:self.part_size])
+            del self.part[:self.part_size]
+        return len(b)
+
+    def _submit_part(self, body):
+        client = self.s3.meta.client
+        if self.upload_id is None:
+            response = client.create_multipart_upload(Bucket=self.s3_object.bucket, Key=self.s3_object.key)
+            self.upload_id = response['UploadId']
+            self.executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix='upload')
+        # a failed part fails the write straight away instead of at close
+        for future in self.parts:
+            if future.done() and future.exception() is not None:
+                raise future.exception()
+        start = time.perf_counter()
+        self.slots.acquire()
+        self.wait_seconds += time.perf_counter() - start
+        self.parts.append(self.executor.submit(self._upload_part, len(self.parts) + 1, bytes(body)))
+
+    def _upload_part(self, part_number, body):
+        try:
+            response = self.s3.meta.client.upload_part(Bucket=self.s3_object.bucket, Key=self.s3_object.key,
+                                                       UploadId=self.upload_id, PartNumber=part_number, Body=body)
+            return {'PartNumber': part_number, 'ETag': response['ETag']}
+        finally:
+            self.slots.release()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.upload_id is None:
+                target = self.s3.Object(self.s3_object.bucket, self.s3_object.key)
+                self.response = target.put(Body=bytes(self.part), **self.conditions)
+            else:
+                if self.part:
+                    self._submit_part(self.part)
+                parts = [future.result() for future in self.parts]
+                self.response = self.s3.meta.client.complete_multipart_upload(
+                    Bucket=self.s3_object.bucket, Key=self.s3_object.key, UploadId=self.upload_id,
+                    MultipartUpload={'Parts': parts}, **self.conditions)
+                logging.info('Uploaded {} parts to {}'.format(len(parts), self.s3_object.path))
+        except Exception:
+            self.abort()
+            raise
+        self._shutdown()
+        super().close()
+
+    def abort(self):
+        """
+        Stops the upload and discards the parts already sent, the object is left as it was.
+        """
+        if self.closed:
+            return
+        self._shutdown()
+        if self.upload_id is not None:
+            self.s3.meta.client.abort_multipart_upload(Bucket=self.s3_object.bucket, Key=self.s3_object.key,
+                                                       UploadId=self.upload_id)
+        self.part = bytearray()
+        super().close()
+
+    def _shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
@@ -0,0 +1,9 @@
+class ObjectMetadata:
+    def __init__(self, exists, size=0, etag=None):
+        self.exists = exists
+        self.size = size
+        # ETags are stored without the surrounding quotes S3 returns them with, the same as in event records
+        self.etag = etag.strip('"') if etag else etag
+
+    def __eq__(self, other):
+        return self.exists == other.exists and self.size == other.size and self.etag == other.etag
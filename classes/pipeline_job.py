@@ -0,0 +1,20 @@
+class PipelineJob:
+    """
+    A group of messages for one master moving through the pipeline stages.
+    """
+    def __init__(self, key, file_type, entries, valid):
+        self.key = key
+        self.file_type = file_type
+        # (message, user_object) tuples in S3 event order
+        self.entries = entries
+        # indexes of the entries with a user object
+        self.valid = valid
+        self.batch = None
+        # set once a step fails, the remaining steps are skipped
+        self.failed = False
+        self.results = [""] * len(entries)
+        self.lock = None
+
+    def set_batch_results(self, batch_results):
+        for index, result in zip(self.valid, batch_results):
+            self.results[index] = result
@@ -0,0 +1,146 @@
+import logging
+import time
+from collections import deque
+from botocore.exceptions import ClientError
+
+# SQS hands out at most this many messages per receive
+MAX_RECEIVE_MESSAGES = 10
+# the longest long poll SQS allows
+MAX_WAIT_SECONDS = 20
+# the most recent signals kept for inspection
+MAX_SIGNALS_KEPT = 100
+
+
+class PollScheduler:
+    """
+    Decides how the incoming queue is polled from its approximate depth and the age of the messages received.
+    An empty queue is long polled ten messages at a time, which costs one request every twenty seconds while idle.
+    With a backlog it is short polled until up to max_batch_messages are taken in one round, so each master is
+    read and written once for more files and the backlog drains faster than it would one receive at a time.
+    When the backlog or the age of the oldest message received crosses its threshold a scale_out signal is sent,
+    when the queue has stayed at or below scale_in_depth for scale_in_window_seconds a scale_in signal is, so a
+    queue that is empty between bursts doesn't take workers away. A signal isn't repeated, and scale_in isn't sent
+    after any signal, within signal_cooldown_seconds, so workers are not taken away straight after being added.
+    """
+    def __init__(self, queue, send_signal=None, max_batch_messages=50, scale_out_depth=500,
+                 scale_out_latency_seconds=300, scale_in_depth=0, scale_in_window_seconds=300,
+                 signal_cooldown_seconds=600, depth_check_seconds=30, clock=time.time):
+        self.queue = queue
+        self.send_signal = send_signal
+        self.max_batch_messages = max(max_batch_messages, 1)
+        self.scale_out_depth = scale_out_depth
+        self.scale_out_latency_seconds = scale_out_latency_seconds
+        self.scale_in_depth = scale_in_depth
+        self.scale_in_window_seconds = scale_in_window_seconds
+        self.signal_cooldown_seconds = signal_cooldown_seconds
+        self.depth_check_seconds = depth_check_seconds
+        self.clock = clock
+        # approximate number of visible messages on the queue at the last check
+        self.queue_depth = 0
+        # seconds the oldest message of the last round waited on the queue
+        self.message_age = 0
+        # when the queue was first seen at or below scale_in_depth since it was last above it
+        self.low_depth_since = None
+        self.last_depth_check = None
+        self.last_signal = None
+        self.last_signal_time = None
+        self.signals = deque(maxlen=MAX_SIGNALS_KEPT)
+
+    def refresh_depth(self):
+        """
+        Reads the approximate depth of the queue, at most once every depth_check_seconds as every read is a request.
+        """
+        now = self.clock()
+        if self.last_depth_check is not None and now - self.last_depth_check < self.depth_check_seconds:
+            return self.queue_depth
+        self.last_depth_check = now
+        try:
+            self.queue.load()
+            self.queue_depth = int(self.queue.attributes.get('ApproximateNumberOfMessages', 0))
+        except ClientError as e:
+            logging.info('Handling ClientError: {}'.format(e))
+        return self.queue_depth
+
+    def has_backlog(self):
+        return self.queue_depth > 0
+
+    def get_batch_size(self):
+        """
+        Returns how many messages to take in this round, more the deeper the queue is.
+        """
+        return min(self.max_batch_messages, max(self.queue_depth, MAX_RECEIVE_MESSAGES))
+
+    def get_wait_seconds(self, received):
+        """
+        Long polls an empty queue, a queue with a backlog or a round that already has messages doesn't wait.
+        """
+        return 0 if received or self.has_backlog() else MAX_WAIT_SECONDS
+
+    def get_message_age(self, messages):
+        """
+        Returns the seconds the oldest of the messages has been on the queue, from its SentTimestamp attribute.
+        """
+        sent = [int(message.attributes['SentTimestamp']) for message in messages
+                if (getattr(message, 'attributes', None) or {}).get('SentTimestamp')]
+        if not sent:
+            return 0
+        return max(self.clock() - min(sent) / 1000, 0)
+
+    def receive(self):
+        """
+        Receives one round of messages, then sends a scale signal if one is due.
+        """
+        self.refresh_depth()
+        batch_size = self.get_batch_size()
+        messages = []
+        while len(messages) < batch_size:
+            count = min(batch_size - len(messages), MAX_RECEIVE_MESSAGES)
+            received = self.queue.receive_messages(MaxNumberOfMessages=count, AttributeNames=['SentTimestamp'],
+                                                   WaitTimeSeconds=self.get_wait_seconds(messages))
+            messages.extend(received)
+            # a short receive means the queue is drained for now
+            if len(received) < count:
+                break
+        self.message_age = self.get_message_age(messages)
+        if messages:
+            # the depth read before the round is stale by what was just taken
+            self.queue_depth = max(self.queue_depth - len(messages), 0)
+        logging.info('Received {} messages, queue depth {} oldest message {:.1f}s'.format(
+            len(messages), self.queue_depth, self.message_age))
+        self.signal(self.get_scale_action())
+        return messages
+
+    def get_scale_action(self):
+        """
+        Returns scale_out when the backlog or the message age is over its threshold, scale_in when the queue has
+        been at or below scale_in_depth for scale_in_window_seconds, otherwise None.
+        """
+        if self.queue_depth >= self.scale_out_depth or self.message_age >= self.scale_out_latency_seconds:
+            self.low_depth_since = None
+            return 'scale_out'
+        if self.queue_depth > self.scale_in_depth:
+            self.low_depth_since = None
+            return None
+        now = self.clock()
+        if self.low_depth_since is None:
+            self.low_depth_since = now
+        if now - self.low_depth_since >= self.scale_in_window_seconds:
+            return 'scale_in'
+        return None
+
+    def signal(self, action):
+        """
+        Sends the action unless a signal is still cooling down, scale_out after scale_in is sent straight away.
+        """
+        if action is None or self.send_signal is None:
+            return False
+        now = self.clock()
+        cooling_down = self.last_signal_time is not None and now - self.last_signal_time < self.signal_cooldown_seconds
+        if cooling_down and (action == self.last_signal or action == 'scale_in'):
+            return False
+        self.last_signal = action
+        self.last_signal_time = now
+        self.signals.append(action)
+        logging.info('Scale signal: {}'.format(action))
+        self.send_signal(action, {'queue_depth': self.queue_depth, 'message_age_seconds': int(self.message_age)})
+        return True
@@ -0,0 +1,38 @@
+import logging
+import time
+
+
+class ProcessedLedger:
+    """
+    Records the user objects that have been merged, so a redelivered S3 event is not merged a second time.
+    Entries are keyed on the bucket, key, ETag and sequencer of the event. Uploading the same key again is a new
+    event with a new sequencer, so it is merged. Objects that did not come from an S3 event have no sequencer and
+    are always merged.
+    """
+    def __init__(self, store):
+        self.store = store
+
+    @staticmethod
+    def get_entry_key(s3_object):
+        """
+        Returns the ledger key of the object, or None for an object without the event fields.
+        """
+        if s3_object.sequencer is None or s3_object.metadata is None or s3_object.metadata.etag is None:
+            return None
+        return '{}/{}|{}|{}'.format(s3_object.bucket, s3_object.key, s3_object.metadata.etag.strip('"'),
+                                    s3_object.sequencer)
+
+    def contains(self, s3_object):
+        entry_key = self.get_entry_key(s3_object)
+        if entry_key is not None and self.store.contains(entry_key):
+            logging.info('Already processed: {}'.format(s3_object.path))
+            return True
+        return False
+
+    def record(self, s3_object, result):
+        """
+        Adds a processed object to the ledger.
+        """
+        entry_key = self.get_entry_key(s3_object)
+        if entry_key is not None:
+            self.store.put(entry_key, {'result': result, 'processed': time.time()})
@@ -0,0 +1,88 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+
+PREFIX = 's3_data_merge_'
+
+
+class PrometheusExporter:
+    """
+    Keeps running totals of the file metrics and serves them in the Prometheus text format on /metrics.
+    Throughput is the rate of the byte and row totals, the stage totals show where the time goes.
+    """
+    def __init__(self, port=9108, host=''):
+        self.port = port
+        self.host = host
+        self.lock = threading.Lock()
+        self.files = {}
+        self.stage_seconds = {}
+        self.totals = {'bytes_downloaded': 0, 'bytes_uploaded': 0, 'stg_rows': 0, 'update_rows': 0,
+                       'new_rows': 0}
+        self.peak_memory_mb = 0
+        self.server = None
+
+    def export(self, record):
+        with self.lock:
+            files_key = (record['mstr_file_name'], record['result'])
+            self.files[files_key] = self.files.get(files_key, 0) + 1
+            for stage, seconds in record['stage_seconds'].items():
+                self.stage_seconds[stage] = self.stage_seconds.get(stage, 0) + seconds
+            self.totals['bytes_downloaded'] += record['bytes_downloaded']
+            self.totals['bytes_uploaded'] += record['bytes_uploaded']
+            self.totals['stg_rows'] += record['stg_row_count']
+            self.totals['update_rows'] += record['update_count']
+            self.totals['new_rows'] += record['new_record_count']
+            self.peak_memory_mb = max(self.peak_memory_mb, record['peak_memory_mb'])
+
+    def render(self):
+        """
+        Returns the current totals in the Prometheus text exposition format.
+        """
+        with self.lock:
+            lines = ['# TYPE {}files_total counter'.format(PREFIX)]
+            for (mstr_file_name, result), count in sorted(self.files.items()):
+                lines.append('{}files_total{{mstr_file="{}",result="{}"}} {}'.format(
+                    PREFIX, escape(mstr_file_name), escape(result), count))
+            lines.append('# TYPE {}stage_seconds_total counter'.format(PREFIX))
+            for stage, seconds in sorted(self.stage_seconds.items()):
+                lines.append('{}stage_seconds_total{{stage="{}"}} {}'.format(PREFIX, escape(stage), seconds))
+            for name, total in self.totals.items():
+                lines.append('# TYPE {}{}_total counter'.format(PREFIX, name))
+                lines.append('{}{}_total {}'.format(PREFIX, name, total))
+            lines.append('# TYPE {}peak_memory_bytes gauge'.format(PREFIX))
+            lines.append('{}peak_memory_bytes {}'.format(PREFIX, int(self.peak_memory_mb * 1024 * 1024)))
+        return '\n'.join(lines) + '\n'
+
+    def start(self):
+        """
+        Serves /metrics on a background thread.
+        """
+        exporter = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = exporter.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((self.host, self.port), MetricsHandler)
+        threading.Thread(target=self.server.serve_forever, name='metrics', daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -1,7 +1,30 @@
+from classes.object_metadata import ObjectMetadata
+from classes.stage_timer import StageTimer
+
+
 class S3Object:
-    def __init__(self, bucket, key):
+    def __init__(self, bucket, key, event_time=None, sequencer=None, size=None, etag=None):
         self.bucket = bucket
         self.key = key
         self.path = 's3://{}/{}'.format(bucket, key)
+        # ordering fields from the S3 event record, when the object came from a message
+        self.event_time = event_time
+        self.sequencer = sequencer
+        # existence, size and ETag, filled from the event record, a HEAD request or the response of a write
+        self.metadata = None
+        if size is not None and etag is not None:
+            self.metadata = ObjectMetadata(True, size, etag)
+        # time spent on this object, and for a user object the stats of merging it, reported by metrics.emit
+        self.stage_timer = StageTimer()
+        self.processing_data = None
+        # size of the object's data before compression, set when a compressed object is read or written
+        self.uncompressed_size = None
+
+    def event_order(self, sequencer_length=32):
+        """
+        Returns a sort key that puts S3 events in the order they happened.
+        Sequencers of different lengths are compared after right padding the shorter one with zeros.
+        """
+        return (self.event_time or '', (self.sequencer or '').ljust(sequencer_length, '0'))
 
 
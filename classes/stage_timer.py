@@ -0,0 +1,27 @@
+from contextlib import contextmanager
+import time
+
+
+class StageTimer:
+    """
+    Adds up the wall time spent in each named stage of processing a file.
+    """
+    def __init__(self):
+        self.seconds = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds):
+        self.seconds[name] = self.seconds.get(name, 0) + seconds
+
+    def prefixed(self, prefix):
+        """
+        Returns the stage timings with the prefix added to each stage name.
+        """
+        return {prefix + name: seconds for name, seconds in self.seconds.items()}
@@ -0,0 +1,26 @@
+class UpsertResult:
+    def __init__(self, df_stg, df_mstr_new, stg_row_count=0, update_count=0, new_record_count=0, unchanged_count=0,
+                 df_change_set=None, mstr_row_positions=None):
+        # the stg dataframe after deduping on the primary key
+        self.df_stg = df_stg
+        self.df_mstr_new = df_mstr_new
+        self.stg_row_count = stg_row_count
+        self.update_count = update_count
+        self.new_record_count = new_record_count
+        # updated keys whose stg row has the same values as the mstr row it replaces
+        self.unchanged_count = unchanged_count
+        # inserted, updated and unchanged keys, only built when the file type writes change sets
+        self.df_change_set = df_change_set
+        # positions in the mstr of the rows df_mstr_new starts with, before the new keys, set by partial_upsert
+        self.mstr_row_positions = mstr_row_positions
+
+    @property
+    def stg_duplicates(self):
+        return self.stg_row_count - len(self.df_stg.index)
+
+    @property
+    def mstr_unchanged(self):
+        """
+        Returns whether applying the stg leaves every mstr row as it was, no new keys and no changed values.
+        """
+        return self.new_record_count == 0 and self.unchanged_count == self.update_count
@@ -0,0 +1,100 @@
+import logging
+import threading
+from botocore.exceptions import ClientError
+
+# SQS changes the visibility of at most this many messages per ChangeMessageVisibilityBatch request
+MAX_BATCH_SIZE = 10
+
+
+class VisibilityHeartbeat:
+    """
+    Keeps SQS messages hidden from the other workers while they are being merged. The visibility timeout of the
+    messages is extended to visibility_timeout seconds when the heartbeat starts, then every interval seconds on
+    a background thread until it is stopped. A merge that takes longer than the queue's visibility timeout is then
+    not handed to a second worker. One heartbeat can be shared by every message in flight, messages are added
+    as soon as they are received and removed once they are acknowledged.
+    With the queue the messages came from, they are extended with one ChangeMessageVisibilityBatch request per
+    MAX_BATCH_SIZE messages, without it with a request per message.
+    """
+    def __init__(self, messages, visibility_timeout, interval=None, queue=None):
+        self.messages = list(messages)
+        self.queue = queue
+        self.lock = threading.Lock()
+        self.visibility_timeout = visibility_timeout
+        self.interval = interval if interval is not None else visibility_timeout / 2
+        self.stopped = threading.Event()
+        self.thread = None
+        self.beats = 0
+
+    def start(self):
+        if self.thread is None and self.visibility_timeout > 0:
+            # the queue's own timeout may be shorter than the first interval
+            if self.messages:
+                self.beat()
+            self.thread = threading.Thread(target=self.run, name='heartbeat', daemon=True)
+            self.thread.start()
+        return self
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.beat()
+
+    def add(self, messages):
+        """
+        Extends the messages straight away and keeps extending them with the others until they are removed.
+        """
+        messages = list(messages)
+        if self.visibility_timeout > 0:
+            self.extend(messages)
+        with self.lock:
+            self.messages.extend(messages)
+
+    def remove(self, messages):
+        removed = {id(message) for message in messages}
+        with self.lock:
+            self.messages = [message for message in self.messages if id(message) not in removed]
+
+    def beat(self):
+        with self.lock:
+            messages = list(self.messages)
+        self.extend(messages)
+        self.beats += 1
+
+    def extend(self, messages):
+        if self.queue is not None:
+            for start in range(0, len(messages), MAX_BATCH_SIZE):
+                self.extend_batch(messages[start:start + MAX_BATCH_SIZE])
+            return
+        for message in messages:
+            try:
+                message.change_visibility(VisibilityTimeout=self.visibility_timeout)
+            except ClientError as e:
+                logging.info('Handling ClientError: {}'.format(e))
+
+    def extend_batch(self, messages):
+        """
+        Extends up to MAX_BATCH_SIZE messages with one request. A message that fails, such as one deleted since it
+        was read, is logged and left to its current timeout.
+        """
+        entries = [{'Id': str(index), 'ReceiptHandle': message.receipt_handle,
+                    'VisibilityTimeout': self.visibility_timeout} for index, message in enumerate(messages)]
+        try:
+            response = self.queue.change_message_visibility_batch(Entries=entries)
+        except ClientError as e:
+            logging.info('Handling ClientError: {}'.format(e))
+            return
+        for failure in response.get('Failed', []):
+            logging.info('Visibility of message {} not changed: {}'.format(
+                messages[int(failure['Id'])].message_id, failure.get('Code')))
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
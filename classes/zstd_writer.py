@@ -0,0 +1,41 @@
+import io
+
+MB = 1024 * 1024
+
+
+class ZstdWriter(io.RawIOBase):
+    """
+    Writable file object that compresses what is written to it with zstd into another file object.
+    Every frame_size bytes are compressed as a separate zstd frame, a file of concatenated frames decompresses to
+    the concatenated data, so memory stays bounded however large the file is. Closing it leaves the target open.
+    """
+    def __init__(self, target, codec, frame_size=4 * MB):
+        self.target = target
+        self.codec = codec
+        self.frame_size = frame_size
+        self.frame = bytearray()
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def write(self, b):
+        self.frame += b
+        self.position += len(b)
+        if len(self.frame) >= self.frame_size:
+            self._write_frame()
+        return len(b)
+
+    def _write_frame(self):
+        self.target.write(self.codec.compress(bytes(self.frame), asbytes=True))
+        self.frame = bytearray()
+
+    def close(self):
+        if self.closed:
+            return
+        if self.frame or self.position == 0:
+            self._write_frame()
+        super().close()
@@ -0,0 +1,83 @@
+import threading
+
+# connections the shared client of each service keeps open, every worker and transfer thread draws on the same
+# pool so it should be at least worker_count * transfer_concurrency, app.main sets these from the config
+max_pool_connections = 32
+# keep idle connections alive between messages instead of opening new ones
+tcp_keepalive = True
+connect_timeout = 10
+read_timeout = 60
+
+# boto3 is imported when the first client is made, not when this module is
+session = None
+shared_clients = {}
+resource_types = {}
+# bumped when the settings change, so the resources each thread already made are replaced
+generation = 0
+lock = threading.RLock()
+thread_resources = threading.local()
+
+
+def set_client_config(pool_connections, keepalive=True):
+    """
+    Sets the connection pool size and keep alive of the clients, clients already made are replaced.
+    """
+    global max_pool_connections, tcp_keepalive, session, generation
+    with lock:
+        max_pool_connections = max(pool_connections, 1)
+        tcp_keepalive = keepalive
+        session = None
+        shared_clients.clear()
+        resource_types.clear()
+        generation += 1
+
+
+def get_config_kwargs():
+    return {'max_pool_connections': max_pool_connections,
+            'tcp_keepalive': tcp_keepalive,
+            'connect_timeout': connect_timeout,
+            'read_timeout': read_timeout,
+            'retries': {'mode': 'standard'}}
+
+
+def get_session():
+    """
+    Returns the boto3 session every client is made from. Making a session loads the service models, so it is
+    done once per process rather than for every merge.
+    """
+    global session
+    with lock:
+        if session is None:
+            import boto3
+            session = boto3.session.Session()
+        return session
+
+
+def get_client(service):
+    """
+    Returns the client of the service shared by every thread, boto3 clients are thread safe and share one pool
+    of kept alive connections.
+    """
+    with lock:
+        if service not in shared_clients:
+            from botocore.config import Config
+            shared_clients[service] = get_session().client(service, config=Config(**get_config_kwargs()))
+        return shared_clients[service]
+
+
+def get_resource(service):
+    """
+    Returns the resource of the service for this thread. boto3 resources must not be shared between threads, so
+    each thread makes its own once and reuses it for every message, all of them on the shared client.
+    """
+    resources = getattr(thread_resources, 'resources', None)
+    if resources is None or thread_resources.generation != generation:
+        resources = thread_resources.resources = {}
+        thread_resources.generation = generation
+    if service not in resources:
+        with lock:
+            if service not in resource_types:
+                resource_types[service] = type(get_session().resource(service, config=None))
+            resources[service] = resource_types[service](client=get_client(service))
+    return resources[service]
+
@@ -0,0 +1,86 @@
+import bz2
+import gzip
+import os
+from classes.zstd_writer import ZstdWriter
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+# codecs recognised from the key's extension
+EXTENSIONS = {'.gz': 'gzip',
+              '.gzip': 'gzip',
+              '.zst': 'zstd',
+              '.zstd': 'zstd',
+              '.bz2': 'bz2'}
+# codecs recognised from the first bytes of the object, these win over the extension
+MAGIC_BYTES = {b'\x1f\x8b': 'gzip',
+               b'\x28\xb5\x2f\xfd': 'zstd',
+               b'BZh': 'bz2'}
+DEFAULT_LEVELS = {'gzip': 6,
+                  'zstd': 3,
+                  'bz2': 9}
+
+
+def get_extension_codec(key):
+    """
+    Returns the codec named by the key's extension, or None.
+    """
+    return EXTENSIONS.get(os.path.splitext(key)[1].lower())
+
+
+def strip_extension(key):
+    """
+    Returns the key without its compression extension, user/file.csv.gz becomes user/file.csv.
+    """
+    if get_extension_codec(key) is None:
+        return key
+    return os.path.splitext(key)[0]
+
+
+def detect_codec(reader, key=None):
+    """
+    Returns the codec the object is compressed with, from its magic bytes or else its key, None when it is not
+    compressed. The reader is left at the start.
+    """
+    head = reader.read(4)
+    reader.seek(0)
+    for magic, codec in MAGIC_BYTES.items():
+        if head.startswith(magic):
+            return codec
+    return get_extension_codec(key) if key is not None else None
+
+
+def open_decompressed(source, codec):
+    """
+    Returns a binary file object reading source decompressed. Closing it leaves source open.
+    """
+    if codec == 'gzip':
+        return gzip.GzipFile(fileobj=source, mode='rb')
+    if codec == 'bz2':
+        return bz2.BZ2File(source, 'rb')
+    if codec == 'zstd':
+        if pyarrow is None:
+            raise ValueError('Reading zstd needs pyarrow.')
+        # the arrow stream closes the file it reads from, so it gets its own reader over the same bytes
+        data = pyarrow.py_buffer(source.view) if hasattr(source, 'view') else source.read()
+        return pyarrow.CompressedInputStream(pyarrow.BufferReader(data), 'zstd')
+    raise ValueError('Unknown compression codec: {}'.format(codec))
+
+
+def open_compressed(writer, codec, level=None):
+    """
+    Returns a binary file object that compresses what is written to it into writer. Closing it writes the end of
+    the compressed stream and leaves writer open. tell() on it returns the uncompressed size written so far.
+    """
+    level = DEFAULT_LEVELS.get(codec) if level is None else level
+    if codec == 'gzip':
+        return gzip.GzipFile(fileobj=writer, mode='wb', compresslevel=level, mtime=0)
+    if codec == 'bz2':
+        return bz2.BZ2File(writer, 'wb', compresslevel=level)
+    if codec == 'zstd':
+        if pyarrow is None:
+            raise ValueError('Writing zstd needs pyarrow.')
+        return ZstdWriter(writer, pyarrow.Codec('zstd', compression_level=level))
+    raise ValueError('Unknown compression codec: {}'.format(codec))
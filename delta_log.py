@@ -0,0 +1,311 @@
+import io
+import json
+import logging
+import threading
+import time
+from classes.s3_object import S3Object
+from classes.file_processing_data import FileProcessingData
+from classes.keyed_executor import KeyedExecutor
+from botocore.exceptions import ClientError
+from pandas.core.groupby.groupby import DataError
+import pandas
+import partitioned_store
+import s3_functions
+import upsert_engine
+
+DELTA_DIRECTORY = '_delta/'
+MANIFEST_NAME = '_manifest.json'
+
+# compactions run here, one at a time per master, so they never hold up the merges
+compaction_executor = KeyedExecutor(max_workers=1)
+# guards the read-modify-write of each master's delta manifest
+manifest_locks = {}
+manifest_locks_lock = threading.Lock()
+# file types of the delta masters written by this process, keyed by (bucket, master key), checked for due
+# compactions while idle
+delta_masters = {}
+
+
+def get_delta_prefix(file_type):
+    """
+    Returns the key prefix the deltas of the master are stored under, mstr/<name>/_delta/.
+    """
+    return partitioned_store.get_partition_prefix(file_type) + DELTA_DIRECTORY
+
+
+def get_manifest_key(file_type):
+    return get_delta_prefix(file_type) + MANIFEST_NAME
+
+
+def get_manifest_lock(bucket, file_type):
+    with manifest_locks_lock:
+        return manifest_locks.setdefault((bucket, file_type.master_file_s3_key), threading.Lock())
+
+
+def new_manifest():
+    """
+    Returns the manifest of a master without deltas. compacted_sequence is the last delta folded into the base.
+    """
+    return {'next_sequence': 1,
+            'compacted_sequence': 0,
+            'deltas': []}
+
+
+def read_manifest(s3, bucket, file_type):
+    """
+    Returns the delta manifest of the master, a new manifest if the master has no deltas yet.
+    """
+    return read_manifest_version(s3, bucket, file_type)[0]
+
+
+def read_manifest_version(s3, bucket, file_type):
+    """
+    Returns the delta manifest of the master and its ETag, a new manifest and None if the master has no deltas yet.
+    """
+    try:
+        response = s3.Object(bucket, get_manifest_key(file_type)).get()
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return new_manifest(), None
+        raise
+    return json.loads(response['Body'].read()), response.get('ETag')
+
+
+def write_manifest(s3, bucket, file_type, manifest, conditions=None):
+    s3.Object(bucket, get_manifest_key(file_type)).put(Body=json.dumps(manifest, indent=2).encode('utf-8'),
+                                                       **(conditions or {}))
+
+
+def write_delta(s3, bucket, file_type, sequence, df):
+    """
+    Writes the rows of one user object as a delta and returns its manifest entry.
+    A delta is never overwritten, when another worker has written the sequence number already the next free one
+    is used.
+    """
+    buffer = io.BytesIO()
+    df.to_parquet(buffer, index=False)
+    for attempt in range(s3_functions.conflict_retries + 1):
+        key = '{}{:010d}.parquet'.format(get_delta_prefix(file_type), sequence)
+        try:
+            s3.Object(bucket, key).put(Body=buffer.getvalue(), **s3_functions.get_write_conditions(None))
+            break
+        except ClientError as e:
+            if not s3_functions.is_conflict(e) or attempt == s3_functions.conflict_retries:
+                raise
+            sequence += 1
+    return {'sequence': sequence, 'key': key, 'row_count': len(df.index), 'size': buffer.tell(),
+            'created': time.time()}
+
+
+def read_delta(s3, bucket, delta):
+    body = s3.Object(bucket, delta['key']).get()['Body'].read()
+    return pandas.read_parquet(io.BytesIO(body))
+
+
+def append_delta(s3, bucket, file_type, df):
+    """
+    Adds the dataframe to the end of the master's delta log. The manifest is the commit point, a delta is only
+    part of the master once the manifest listing it is written. The manifest is only written if no other worker
+    changed it since it was read, otherwise the delta is appended again to the new manifest.
+    Returns the new manifest, or None when every attempt lost to another worker.
+    """
+    with get_manifest_lock(bucket, file_type):
+        for attempt in range(s3_functions.conflict_retries + 1):
+            manifest, manifest_etag = read_manifest_version(s3, bucket, file_type)
+            delta = write_delta(s3, bucket, file_type, manifest['next_sequence'], df)
+            manifest = dict(manifest, next_sequence=delta['sequence'] + 1, deltas=manifest['deltas'] + [delta])
+            try:
+                write_manifest(s3, bucket, file_type, manifest, s3_functions.get_write_conditions(manifest_etag))
+                return manifest
+            except ClientError as e:
+                if not s3_functions.is_conflict(e):
+                    raise
+                logging.info('Delta manifest {} changed while appending, attempt {}.'.format(
+                    get_manifest_key(file_type), attempt + 1))
+                partitioned_store.delete_objects(s3, bucket, [delta['key']])
+                s3_functions.wait_to_retry(attempt)
+    return None
+
+
+def needs_compaction(manifest, file_type, now=None):
+    """
+    Returns whether the pending deltas have reached the row count or age limit of the file type.
+    """
+    if not manifest['deltas']:
+        return False
+    now = time.time() if now is None else now
+    row_count = sum(delta['row_count'] for delta in manifest['deltas'])
+    oldest = min(delta['created'] for delta in manifest['deltas'])
+    return row_count >= file_type.compaction_row_limit or now - oldest >= file_type.compaction_age_minutes * 60
+
+
+def get_merged_view(s3, bucket, file_type, manifest, mstr_object=None):
+    """
+    Applies the deltas in the manifest to the base master in sequence order, the last write of a key wins.
+    Returns the UpsertResult of applying all the deltas at once, or one at a time for the partial update mode as
+    each delta only sets its own columns. The metadata of the base read is left on mstr_object when one is passed in.
+    """
+    mstr_object = mstr_object or S3Object(bucket, file_type.master_file_s3_key)
+    df_base = s3_functions.get_dataframe(s3, mstr_object, file_type, cache=s3_functions.mstr_cache, project=False)
+    deltas = [read_delta(s3, bucket, delta) for delta in manifest['deltas']]
+    if file_type.update_mode == 'partial':
+        return upsert_engine.partial_upsert_each(df_base, deltas, file_type.key_columns)
+    df_deltas = pandas.concat([df_base.iloc[0:0]] + deltas, ignore_index=True)
+    return upsert_engine.upsert(df_base, df_deltas, file_type.key_columns, keep='last')
+
+
+def read_mstr(bucket, file_type):
+    """
+    Returns the current master of a delta file type, the base with every committed delta applied.
+    """
+    s3 = s3_functions.get_s3_resource()
+    try:
+        return get_merged_view(s3, bucket, file_type, read_manifest(s3, bucket, file_type)).df_mstr_new
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+            raise
+        # a compaction removed the deltas after the manifest was read, they are in the base now
+        logging.info('Deltas compacted while reading, reading again.')
+        return get_merged_view(s3, bucket, file_type, read_manifest(s3, bucket, file_type)).df_mstr_new
+
+
+def compact(bucket, file_type):
+    """
+    Folds the pending deltas into the base master and removes them from the log.
+    The base is written before the manifest drops the deltas. Applying a delta twice gives the same master, so a
+    compaction stopped in between leaves the master correct. The base is only written if no other worker changed
+    it since it was read, a compaction that loses the race leaves the deltas for the next one. Deltas that leave
+    every row of the base as it was are dropped without writing the base.
+    """
+    s3 = s3_functions.get_s3_resource()
+    try:
+        manifest = read_manifest(s3, bucket, file_type)
+        if not manifest['deltas']:
+            return 'Success'
+        compacted_sequence = manifest['deltas'][-1]['sequence']
+        logging.info('Compacting {} deltas into {}.'.format(len(manifest['deltas']), file_type.master_file_s3_key))
+        mstr_object = S3Object(bucket, file_type.master_file_s3_key)
+        upsert_result = get_merged_view(s3, bucket, file_type, manifest, mstr_object)
+        base_etag = mstr_object.metadata.etag if mstr_object.metadata.exists else None
+        if upsert_result.mstr_unchanged:
+            logging.info('No mstr rows changed, skipping the mstr write.')
+        else:
+            try:
+                mstr_metadata = s3_functions.write_csv(s3, mstr_object, upsert_result.df_mstr_new,
+                                                       file_type.mstr_compression, file_type.mstr_compression_level,
+                                                       s3_functions.get_write_conditions(base_etag))
+            except ClientError as e:
+                if not s3_functions.is_conflict(e):
+                    raise
+                logging.info('Mstr {} was compacted by another worker.'.format(file_type.master_file_s3_key))
+                return s3_functions.CONFLICT
+            s3_functions.mstr_cache.put(mstr_object.path, mstr_metadata.etag,
+                                        upsert_result.df_mstr_new.infer_objects())
+        with get_manifest_lock(bucket, file_type):
+            for attempt in range(s3_functions.conflict_retries + 1):
+                manifest, manifest_etag = read_manifest_version(s3, bucket, file_type)
+                compacted = [delta for delta in manifest['deltas'] if delta['sequence'] <= compacted_sequence]
+                manifest = dict(manifest, compacted_sequence=max(compacted_sequence, manifest['compacted_sequence']),
+                                deltas=[delta for delta in manifest['deltas'] if delta['sequence'] > compacted_sequence])
+                try:
+                    write_manifest(s3, bucket, file_type, manifest, s3_functions.get_write_conditions(manifest_etag))
+                    break
+                except ClientError as e:
+                    if not s3_functions.is_conflict(e):
+                        raise
+                    # a delta was appended in between, drop the compacted deltas from the new manifest
+                    s3_functions.wait_to_retry(attempt)
+            else:
+                # the base holds the deltas, applying them again on the next compaction gives the same master
+                return s3_functions.CONFLICT
+        partitioned_store.delete_objects(s3, bucket, [delta['key'] for delta in compacted])
+        logging.info('Compacted through delta {}, update_count: {} new_record_count: {} mstr_new_row_count: {}'
+                     .format(compacted_sequence, upsert_result.update_count, upsert_result.new_record_count,
+                             len(upsert_result.df_mstr_new.index)))
+    except DataError as e:
+        logging.info('Handling DataError: {}'.format(e))
+        return 'Error'
+    except KeyError as e:
+        logging.info('Handling KeyError: {}'.format(e))
+        return 'Key error'
+    except Exception as e:
+        logging.info('Handling Exception error: {}'.format(e))
+        return 'Error'
+    return 'Success'
+
+
+def schedule_compaction(bucket, file_type):
+    """
+    Queues a compaction of the master in the background. Returns a Future with the result.
+    """
+    return compaction_executor.submit((bucket, file_type.master_file_s3_key), compact, bucket, file_type)
+
+
+def schedule_due_compactions():
+    """
+    Queues a compaction for every delta master of this process whose deltas are past the age limit.
+    Called while the app is idle, so masters that stop receiving files are still compacted.
+    """
+    s3 = s3_functions.get_s3_resource()
+    for (bucket, mstr_key), file_type in list(delta_masters.items()):
+        try:
+            if needs_compaction(read_manifest(s3, bucket, file_type), file_type):
+                schedule_compaction(bucket, file_type)
+        except ClientError as e:
+            logging.info('Handling ClientError: {}'.format(e))
+
+
+def merge_to_delta_mstr(user_object, file_type):
+    """
+    Version of merge_to_mstr for file types using the delta merge mode.
+    The deduped rows of the user object are appended to the master's delta log instead of rewriting the master,
+    so the cost does not grow with the master. The update and new record counts are worked out when the deltas
+    are compacted, and deltas that change nothing are dropped then without writing the master. Change sets
+    need the master at merge time, FileType does not allow them with this mode.
+    """
+    s3 = s3_functions.get_s3_resource()
+    # make sure the user object still exists
+    if not s3_functions.s3_file_exists(s3, user_object):
+        logging.info('User file does not exist.')
+        return 'User file not found'
+
+    if not user_object.key.startswith('user/'):
+        logging.info('User object error')
+        return 'User object error'
+
+    try:
+        logging.info('Loading stg dataframe.')
+        df_stg = s3_functions.get_dataframe(s3, user_object, file_type)
+        logging.info('Loaded stg dataframe.')
+        stg_initial_rowcount = len(df_stg.index)
+        df_stg_distinct = upsert_engine.dedupe_file_type(df_stg, file_type, user_object.stage_timer)
+
+        manifest = append_delta(s3, user_object.bucket, file_type, df_stg_distinct)
+        if manifest is None:
+            return s3_functions.CONFLICT
+        delta_masters[(user_object.bucket, file_type.master_file_s3_key)] = file_type
+        logging.info('Appended delta {} to {}.'.format(manifest['next_sequence'] - 1, file_type.master_file_s3_key))
+
+        file_processing_data = FileProcessingData(stg_file_name=user_object.key.replace('user/', ''),
+                                                  mstr_file_name=file_type.master_file_s3_key.replace('mstr/', ''),
+                                                  stg_row_count=stg_initial_rowcount,
+                                                  stg_column_count=len(df_stg.columns),
+                                                  stg_file_size=s3_functions.get_object_metadata(s3, user_object).size,
+                                                  stg_duplicates=stg_initial_rowcount-len(df_stg_distinct.index),
+                                                  stg_distinct_row_count=len(df_stg_distinct.index),
+                                                  stg_uncompressed_size=user_object.uncompressed_size or 0
+                                                  )
+        logging.info(str(file_processing_data))
+        user_object.processing_data = file_processing_data
+        if needs_compaction(manifest, file_type):
+            schedule_compaction(user_object.bucket, file_type)
+    except DataError as e:
+        logging.info('Handling DataError: {}'.format(e))
+        return 'Error'
+    except KeyError as e:
+        logging.info('Handling KeyError: {}'.format(e))
+        return 'Key error'
+    except Exception as e:
+        logging.info('Handling Exception error: {}'.format(e))
+        return 'Error'
+    return 'Success'
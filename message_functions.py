@@ -0,0 +1,146 @@
+from functools import partial
+import json
+import logging
+import time
+from app import get_object
+from classes.visibility_heartbeat import VisibilityHeartbeat
+import metrics
+import s3_functions
+
+# seconds each heartbeat hides the messages being merged for, app.main sets this from the config, 0 turns it off
+visibility_timeout = 300
+# seconds between heartbeats, app.main sets this from the queue's VisibilityTimeout, None is half visibility_timeout
+heartbeat_interval = None
+# AcknowledgementManager deleting finished messages in batches, app.main sets this
+acknowledger = None
+# results of input that can never be merged: a body without an S3 object or an object no file type matches, and a
+# user object that no longer exists. Only these go to the dead letter queue, any other failure may pass on a retry.
+BAD_INPUT_RESULTS = ('', 'User file not found')
+
+
+def parse_message(message):
+    """
+    Returns the S3Object parsed from the message, or None when the body is not an S3 event, which leaves the
+    message with the invalid input result so it goes to the dead letter queue.
+    """
+    try:
+        return get_object(json.loads(message.body))
+    except ValueError as e:
+        logging.info('Handling ValueError: {}'.format(e))
+    except KeyError as e:
+        logging.info('Handling KeyError: {}'.format(e))
+    except TypeError as e:
+        logging.info('Handling TypeError: {}'.format(e))
+    return None
+
+
+def get_serialization_key(message, file_type):
+    """
+    Returns the key messages are serialized on. Messages for the same master file must be merged one at a time and
+    in order, anything without a file type can run on its own.
+    """
+    if bool(file_type):
+        return file_type.master_file_s3_key
+    return message.message_id
+
+
+def group_messages(messages):
+    """
+    Parses the messages and groups them by the master file they update. A message that can't be parsed is grouped
+    on its own with no user object.
+    Returns a list of (serialization key, file type, entries) with the entries of each group in S3 event order.
+    """
+    groups = {}
+    for message in messages:
+        # process the message body to get the S3Object
+        start = time.perf_counter()
+        user_object = parse_message(message)
+        file_type = None
+        if bool(user_object):
+            user_object.stage_timer.add('message_parse', time.perf_counter() - start)
+            logging.info('User Object: {}'.format(user_object.path))
+            # look for known file matching the pattern of the current message
+            with user_object.stage_timer.stage('file_type_lookup'):
+                file_type = s3_functions.lookup_file(user_object.key)
+        key = get_serialization_key(message, file_type)
+        groups.setdefault(key, (file_type, []))[1].append((message, user_object))
+    batches = []
+    for key, (file_type, entries) in groups.items():
+        entries.sort(key=lambda entry: entry[1].event_order() if bool(entry[1]) else ('', ''))
+        batches.append((key, file_type, entries))
+    return batches
+
+
+def start_heartbeat(entries):
+    """
+    Returns a started VisibilityHeartbeat keeping the messages of the entries hidden while they are merged.
+    """
+    # the acknowledger deletes from the queue the messages came from
+    queue = acknowledger.queue if acknowledger is not None else None
+    return VisibilityHeartbeat([message for message, user_object in entries], visibility_timeout,
+                               heartbeat_interval, queue).start()
+
+
+def is_done(result):
+    """
+    Returns whether the message's merge is finished with and the message can be deleted.
+    """
+    return result in ('Success', s3_functions.ALREADY_PROCESSED)
+
+
+def is_bad_input(result):
+    """
+    Returns whether the message's input can never be merged, however often it is retried.
+    """
+    return result in BAD_INPUT_RESULTS
+
+
+def emit_deleted(user_object, result, seconds):
+    """
+    Emits the metrics of a user object once its message has been deleted, seconds is how long the delete took.
+    """
+    user_object.stage_timer.add('delete', seconds)
+    metrics.emit(user_object, result)
+
+
+def acknowledge_messages(entries, results):
+    """
+    Logs the result of each message, removes the finished ones from the queue and emits the metrics of their user
+    objects. With an acknowledger the messages are deleted in batches, without one each message is deleted on its
+    own. A message whose input can never be merged is sent to the dead letter queue and deleted. Any other message,
+    such as one whose merge failed on an S3 error or lost every attempt to another worker, is left on the queue to
+    be merged again once its visibility timeout runs out, as is bad input when there is no dead letter queue.
+    """
+    for (message, user_object), result in zip(entries, results):
+        logging.info('Merge Result: {}'.format(result))
+        on_deleted = partial(emit_deleted, user_object, result) if bool(user_object) else None
+        if is_done(result) and acknowledger is None:
+            start = time.perf_counter()
+            message.delete()
+            logging.info('Message removed from queue.')
+            if on_deleted is not None:
+                on_deleted(time.perf_counter() - start)
+        elif is_done(result):
+            acknowledger.add(message, on_deleted)
+        elif not (is_bad_input(result) and acknowledger is not None and
+                  acknowledger.dead_letter(message, result, on_deleted)):
+            if bool(user_object):
+                metrics.emit(user_object, result)
+            logging.info('Message left on queue.')
+
+
+def log_entries(entries):
+    """
+    Logs the files about to be processed and any message that could not be parsed.
+    Returns the indexes of the entries with a user object.
+    """
+    valid = []
+    for index, (message, user_object) in enumerate(entries):
+        # make sure the object could be parsed from the message
+        if bool(user_object):
+            logging.info('Processing the file: {}'.format(user_object.path))
+            valid.append(index)
+        # if we were unsuccessful in parsing the message log it.
+        else:
+            logging.error('Invalid message format received.')
+    return valid
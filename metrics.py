@@ -0,0 +1,83 @@
+import logging
+import resource
+import sys
+from classes.emf_exporter import EmfExporter
+from classes.file_processing_data import FileProcessingData
+from classes.json_lines_exporter import JsonLinesExporter
+from classes.prometheus_exporter import PrometheusExporter
+
+# where each file's metrics are sent, app.main sets these from the config
+exporters = []
+# stages recorded on every object read, reported as stg_ or mstr_ stages
+OBJECT_STAGES = ('download', 'parse')
+
+
+def add_exporters(metrics_path=None, exporter=None, emf_path=None, port=None):
+    """
+    Sets up the exporters from the config. metrics_path gets a json line per file, exporter adds 'emf' to write
+    CloudWatch embedded metric format to emf_path or 'prometheus' to serve the totals on port.
+    """
+    if metrics_path:
+        exporters.append(JsonLinesExporter(metrics_path))
+    if exporter == 'emf':
+        exporters.append(EmfExporter(emf_path))
+    elif exporter == 'prometheus':
+        exporters.append(PrometheusExporter(port).start())
+    elif exporter not in (None, '', 'none'):
+        logging.info('Unknown metrics exporter: {}'.format(exporter))
+
+
+def get_peak_rss_mb():
+    """
+    Returns the peak resident set size of the process.
+    """
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def get_stage_seconds(s3_object, prefix):
+    """
+    Returns the stage timings recorded on the object, with the prefix added to the download and parse stages
+    that are recorded for both the stg and the mstr object.
+    """
+    return {prefix + stage if stage in OBJECT_STAGES else stage: seconds
+            for stage, seconds in s3_object.stage_timer.seconds.items()}
+
+
+def get_processing_data(user_object):
+    """
+    Returns the processing data the merge recorded for the user object. A user object that failed before its
+    stats were recorded gets one with only its name.
+    """
+    if user_object.processing_data is None:
+        user_object.processing_data = FileProcessingData(stg_file_name=user_object.key.replace('user/', ''),
+                                                         mstr_file_name='')
+    return user_object.processing_data
+
+
+def emit(user_object, result):
+    """
+    Sends the metrics of a processed user object to every exporter, once its message has been deleted.
+    The stages recorded on the user object are added to the stages the merge recorded for the master.
+    A failing exporter is logged and skipped.
+    """
+    file_processing_data = get_processing_data(user_object)
+    for stage, seconds in get_stage_seconds(user_object, 'stg_').items():
+        file_processing_data.stage_seconds[stage] = file_processing_data.stage_seconds.get(stage, 0) + seconds
+    if 'download' in user_object.stage_timer.seconds:
+        file_processing_data.bytes_downloaded += user_object.metadata.size
+    file_processing_data.peak_memory_mb = get_peak_rss_mb()
+    record = dict(file_processing_data.to_dict(), result=result)
+    for exporter in exporters:
+        try:
+            exporter.export(record)
+        except Exception as e:
+            logging.info('Handling Exception error: {}'.format(e))
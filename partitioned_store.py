@@ -0,0 +1,361 @@
+import io
+import json
+import logging
+import os
+import uuid
+from classes.s3_object import S3Object
+from classes.file_processing_data import FileProcessingData
+from botocore.exceptions import ClientError
+from pandas.core.groupby.groupby import DataError
+import pandas
+import change_set_functions
+import s3_functions
+import streaming_merge
+import transfer
+import upsert_engine
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+MANIFEST_NAME = '_manifest.json'
+
+
+def get_partition_prefix(file_type):
+    """
+    Returns the key prefix the master partitions are stored under, the master key without its extension.
+    """
+    return os.path.splitext(file_type.master_file_s3_key)[0] + '/'
+
+
+def get_manifest_key(file_type):
+    return get_partition_prefix(file_type) + MANIFEST_NAME
+
+
+def new_manifest(file_type):
+    """
+    Returns the manifest of a master without any partitions.
+    """
+    return {'partition_count': file_type.partition_count,
+            'primary_key': file_type.key_columns,
+            'columns': file_type.key_columns,
+            # rows are placed by streaming_merge.get_key_text, 1 and 1.0 land in the same partition
+            'normalized_keys': True,
+            'partitions': {}}
+
+
+def read_manifest(s3, bucket, file_type):
+    """
+    Returns the manifest of the partitioned master, or None if the master has not been partitioned yet.
+    """
+    return read_manifest_version(s3, bucket, file_type)[0]
+
+
+def read_manifest_version(s3, bucket, file_type):
+    """
+    Returns the manifest and its ETag, (None, None) if the master has not been partitioned yet.
+    """
+    try:
+        response = s3.Object(bucket, get_manifest_key(file_type)).get()
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return None, None
+        raise
+    return json.loads(response['Body'].read()), response.get('ETag')
+
+
+def write_manifest(s3, bucket, file_type, manifest, conditions=None):
+    s3.Object(bucket, get_manifest_key(file_type)).put(Body=json.dumps(manifest, indent=2).encode('utf-8'),
+                                                       **(conditions or {}))
+
+
+def read_partition(s3, bucket, manifest, partition_id):
+    """
+    Returns the dataframe for a single partition, reindexed to the columns in the manifest.
+    A partition that has never been written is returned empty.
+    """
+    partition = manifest['partitions'].get(str(partition_id))
+    if partition is None:
+        return pandas.DataFrame(columns=manifest['columns'])
+    body = s3.Object(bucket, partition['key']).get()['Body'].read()
+    return pandas.read_parquet(io.BytesIO(body)).reindex(columns=manifest['columns'])
+
+
+def read_partition_table(s3, bucket, manifest, partition_id):
+    """
+    Returns the partition as an Arrow table, or None when it has never been written.
+    """
+    partition = manifest['partitions'].get(str(partition_id))
+    if partition is None:
+        return None
+    body = s3.Object(bucket, partition['key']).get()['Body'].read()
+    return pyarrow.parquet.read_table(io.BytesIO(body))
+
+
+def write_partition(s3, bucket, file_type, partition_id, df):
+    """
+    Writes the partition, a dataframe or an Arrow table, to a new object and returns its manifest entry.
+    Partitions are never overwritten in place, the manifest is only pointed at the new object once it is written.
+    """
+    buffer = io.BytesIO()
+    if isinstance(df, pandas.DataFrame):
+        df.to_parquet(buffer, index=False)
+        row_count = len(df.index)
+    else:
+        pyarrow.parquet.write_table(df, buffer)
+        row_count = df.num_rows
+    key = '{}part-{:05d}-{}.parquet'.format(get_partition_prefix(file_type), partition_id, uuid.uuid4().hex)
+    s3.Object(bucket, key).put(Body=buffer.getvalue())
+    return {'key': key, 'row_count': row_count, 'size': buffer.tell()}
+
+
+def partial_upsert_partition(s3, bucket, file_type, manifest, partition_id, df_stg):
+    """
+    Applies a partial update to one partition. Only the key and stg columns are turned into a dataframe, the other
+    columns stay Arrow columns that are carried over to the rows they were on without being converted, and are
+    empty on new rows. Returns the UpsertResult and the table to write, None when the partition is unchanged.
+    """
+    table = read_partition_table(s3, bucket, manifest, partition_id)
+    if table is None:
+        table = pyarrow.table({column: pyarrow.nulls(0) for column in manifest['columns']})
+    columns = [column for column in manifest['columns']
+               if column in file_type.key_columns or column in df_stg.columns]
+    df_mstr = table.select([column for column in columns if column in table.column_names]).to_pandas()
+    upsert_result = upsert_engine.upsert_file_type(df_mstr.reindex(columns=columns), df_stg, file_type)
+    if upsert_result.mstr_unchanged:
+        return upsert_result, None
+    df_mstr_new = upsert_result.df_mstr_new
+    table_new = pyarrow.Table.from_pandas(df_mstr_new, preserve_index=False)
+    positions = pyarrow.array(upsert_result.mstr_row_positions, type=pyarrow.int64())
+    new_row_count = len(df_mstr_new.index) - len(positions)
+    arrays = []
+    for column in manifest['columns']:
+        if column in df_mstr_new.columns:
+            arrays.append(table_new.column(column))
+        elif column in table.column_names:
+            carried = table.column(column).take(positions)
+            arrays.append(pyarrow.chunked_array(carried.chunks + [pyarrow.nulls(new_row_count, type=carried.type)],
+                                                type=carried.type))
+        else:
+            arrays.append(pyarrow.nulls(len(df_mstr_new.index)))
+    return upsert_result, pyarrow.table(arrays, names=manifest['columns'])
+
+
+def get_manifest_totals(manifest):
+    """
+    Returns the row count and size of all the partitions in the manifest.
+    """
+    row_count = sum(partition['row_count'] for partition in manifest['partitions'].values())
+    file_size = sum(partition['size'] for partition in manifest['partitions'].values())
+    return row_count, file_size
+
+
+def upsert_partitions(s3, bucket, file_type, manifest, df_stg, change_sets=None):
+    """
+    Upserts the stg dataframe into the partitions containing its keys, leaving every other partition untouched.
+    A partition whose rows the stg leaves as they were is not rewritten either. The change set of each partition
+    is appended to change_sets when the file type writes them. File types with the partial update mode only read
+    the key and stg columns into pandas, see partial_upsert_partition.
+    Returns the new manifest, the list of replaced object keys, the update count, the new record count and the
+    unchanged count.
+    """
+    manifest = dict(manifest, partitions=dict(manifest['partitions']))
+    manifest['columns'] = manifest['columns'] + [column for column in df_stg.columns if column not in manifest['columns']]
+    replaced_keys = []
+    update_count = 0
+    new_record_count = 0
+    unchanged_count = 0
+    partition_ids = streaming_merge.get_partition_ids(df_stg, manifest['primary_key'], manifest['partition_count'],
+                                                      manifest.get('normalized_keys', False))
+    partial = file_type.update_mode == 'partial' and pyarrow is not None
+    for partition_id, df_stg_partition in df_stg.groupby(partition_ids.values):
+        if partial:
+            upsert_result, table = partial_upsert_partition(s3, bucket, file_type, manifest, partition_id,
+                                                            df_stg_partition)
+        else:
+            df_mstr = read_partition(s3, bucket, manifest, partition_id)
+            upsert_result = upsert_engine.upsert_file_type(df_mstr, df_stg_partition, file_type)
+            table = upsert_result.df_mstr_new.reindex(columns=manifest['columns'])
+        update_count += upsert_result.update_count
+        new_record_count += upsert_result.new_record_count
+        unchanged_count += upsert_result.unchanged_count
+        if change_sets is not None and upsert_result.df_change_set is not None:
+            change_sets.append(upsert_result.df_change_set)
+        if upsert_result.mstr_unchanged:
+            continue
+        previous = manifest['partitions'].get(str(partition_id))
+        if previous is not None:
+            replaced_keys.append(previous['key'])
+        manifest['partitions'][str(partition_id)] = write_partition(s3, bucket, file_type, partition_id, table)
+    return manifest, replaced_keys, update_count, new_record_count, unchanged_count
+
+
+def delete_objects(s3, bucket, keys):
+    for key in keys:
+        try:
+            s3.Object(bucket, key).delete()
+        except ClientError as e:
+            logging.info('Handling ClientError: {}'.format(e))
+
+
+def get_new_keys(prev_manifest, manifest):
+    """
+    Returns the keys of the partitions in the manifest that are not in the previous one.
+    """
+    prev_keys = {partition['key'] for partition in prev_manifest['partitions'].values()}
+    return [partition['key'] for partition in manifest['partitions'].values() if partition['key'] not in prev_keys]
+
+
+def partition_csv_mstr(s3, mstr_object, file_type):
+    """
+    One time conversion of an existing csv master into partitions. Returns the new manifest, or the manifest of
+    another worker that converted it first.
+    """
+    logging.info('Partitioning csv mstr {}.'.format(mstr_object.path))
+    df_mstr = s3_functions.get_dataframe(s3, mstr_object, file_type, project=False)
+    manifest, replaced_keys, update_count, new_record_count, unchanged_count = \
+        upsert_partitions(s3, mstr_object.bucket, file_type, new_manifest(file_type), df_mstr)
+    try:
+        write_manifest(s3, mstr_object.bucket, file_type, manifest, s3_functions.get_write_conditions(None))
+    except ClientError as e:
+        if not s3_functions.is_conflict(e):
+            raise
+        delete_objects(s3, mstr_object.bucket, get_new_keys(new_manifest(file_type), manifest))
+        return read_manifest(s3, mstr_object.bucket, file_type)
+    return manifest
+
+
+def merge_to_partitioned_mstr(user_object, file_type):
+    """
+    Version of merge_to_mstr for file types stored as hash partitioned parquet.
+    Only the partitions holding keys from the user object are read and rewritten. The manifest is written
+    conditionally on the ETag it was read with, when another worker changed it the upsert is done again.
+    A file type with export_csv then has the changed master written out as csv.
+    """
+    s3 = s3_functions.get_s3_resource()
+    mstr_object = S3Object(user_object.bucket, file_type.master_file_s3_key)
+    # make sure the user object still exists
+    if not s3_functions.s3_file_exists(s3, user_object):
+        logging.info('User file does not exist.')
+        return 'User file not found'
+
+    if not user_object.key.startswith('user/'):
+        logging.info('User object error')
+        return 'User object error'
+
+    try:
+        logging.info('Loading stg dataframe.')
+        df_stg = s3_functions.get_dataframe(s3, user_object, file_type)
+        logging.info('Loaded stg dataframe.')
+        stg_initial_rowcount = len(df_stg.index)
+        df_stg_distinct = upsert_engine.dedupe_file_type(df_stg, file_type, user_object.stage_timer)
+        for attempt in range(s3_functions.conflict_retries + 1):
+            manifest, manifest_etag = read_manifest_version(s3, mstr_object.bucket, file_type)
+            if manifest is None and s3_functions.get_object_metadata(s3, mstr_object).exists:
+                partition_csv_mstr(s3, mstr_object, file_type)
+                manifest, manifest_etag = read_manifest_version(s3, mstr_object.bucket, file_type)
+            if manifest is None:
+                manifest = new_manifest(file_type)
+            mstr_prev_row_count, mstr_prev_file_size = get_manifest_totals(manifest)
+            mstr_prev_column_count = len(manifest['columns'])
+
+            logging.info('Upserting mstr partitions.')
+            prev_manifest = manifest
+            change_sets = []
+            manifest, replaced_keys, update_count, new_record_count, unchanged_count = \
+                upsert_partitions(s3, mstr_object.bucket, file_type, manifest, df_stg_distinct, change_sets)
+            mstr_write_skipped = manifest == prev_manifest
+            if mstr_write_skipped:
+                break
+            try:
+                # the manifest is the commit point, only written if no other worker changed it since it was read
+                write_manifest(s3, mstr_object.bucket, file_type, manifest,
+                               s3_functions.get_write_conditions(manifest_etag))
+            except ClientError as e:
+                if not s3_functions.is_conflict(e):
+                    raise
+                logging.info('Mstr manifest {} changed while merging, attempt {}.'.format(
+                    get_manifest_key(file_type), attempt + 1))
+                delete_objects(s3, mstr_object.bucket, get_new_keys(prev_manifest, manifest))
+                s3_functions.wait_to_retry(attempt)
+                continue
+            # the replaced partitions are only removed once the manifest is written
+            delete_objects(s3, mstr_object.bucket, replaced_keys)
+            break
+        else:
+            return s3_functions.CONFLICT
+        logging.info('Rewrote {} of {} mstr partitions.'.format(len(replaced_keys), manifest['partition_count']))
+        if file_type.export_csv and not mstr_write_skipped:
+            export_merged_mstr(mstr_object.bucket, file_type)
+        change_set_key = ''
+        if change_sets:
+            change_set_key = change_set_functions.write_change_set(s3, file_type, user_object,
+                                                                   pandas.concat(change_sets, ignore_index=True))
+
+        mstr_new_row_count, mstr_new_file_size = get_manifest_totals(manifest)
+        file_processing_data = FileProcessingData(stg_file_name=user_object.key.replace('user/', ''),
+                                                  mstr_file_name=file_type.master_file_s3_key.replace('mstr/', ''),
+                                                  stg_row_count=stg_initial_rowcount,
+                                                  stg_column_count=len(df_stg.columns),
+                                                  stg_file_size=s3_functions.get_object_metadata(s3, user_object).size,
+                                                  stg_duplicates=stg_initial_rowcount-len(df_stg_distinct.index),
+                                                  stg_distinct_row_count=len(df_stg_distinct.index),
+                                                  mstr_prev_row_count=mstr_prev_row_count,
+                                                  mstr_prev_column_count=mstr_prev_column_count,
+                                                  mstr_prev_file_size=mstr_prev_file_size,
+                                                  mstr_new_row_count=mstr_new_row_count,
+                                                  mstr_new_column_count=len(manifest['columns']),
+                                                  mstr_new_file_size=mstr_new_file_size,
+                                                  update_count=update_count,
+                                                  new_record_count=new_record_count,
+                                                  stg_uncompressed_size=user_object.uncompressed_size or 0,
+                                                  unchanged_count=unchanged_count,
+                                                  mstr_write_skipped=int(mstr_write_skipped),
+                                                  change_set_key=change_set_key
+                                                  )
+        logging.info(str(file_processing_data))
+        user_object.processing_data = file_processing_data
+    except DataError as e:
+        logging.info('Handling DataError: {}'.format(e))
+        return 'Error'
+    except KeyError as e:
+        logging.info('Handling KeyError: {}'.format(e))
+        return 'Key error'
+    except Exception as e:
+        logging.info('Handling Exception error: {}'.format(e))
+        return 'Error'
+    return 'Success'
+
+
+def export_merged_mstr(bucket, file_type):
+    """
+    Exports the master after a merge changed it. The merge is already committed, so a failed export is only
+    logged and the csv is brought up to date by the next merge that changes the master.
+    """
+    try:
+        export_mstr_to_csv(bucket, file_type)
+    except ClientError as e:
+        logging.info('Handling ClientError: {}, the csv export of {} is out of date.'.format(
+            e, file_type.file_process_name))
+
+
+def export_mstr_to_csv(bucket, file_type):
+    """
+    Writes the partitioned master out as a single csv object at file_type.master_file_s3_key, for consumers
+    that need the flat file.
+    """
+    s3 = s3_functions.get_s3_resource()
+    manifest = read_manifest(s3, bucket, file_type)
+    if manifest is None:
+        logging.info('No partitioned mstr found for {}.'.format(file_type.file_process_name))
+        return 'Mstr not found'
+    mstr_object = S3Object(bucket, file_type.master_file_s3_key)
+    df_mstr = pandas.concat([read_partition(s3, bucket, manifest, int(partition_id))
+                             for partition_id in sorted(manifest['partitions'], key=int)] +
+                            [pandas.DataFrame(columns=manifest['columns'])])
+    transfer.upload_csv(s3, mstr_object, df_mstr, file_type.mstr_compression, file_type.mstr_compression_level,
+                        sep=file_type.field_delimiter, quotechar=file_type.text_qualifier)
+    logging.info('Exported {} rows to {}.'.format(len(df_mstr.index), mstr_object.path))
+    return 'Success'
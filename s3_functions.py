@@ -1,82 +1,255 @@
-import boto3
-from botocore.exceptions import ParamValidationError
+from botocore.exceptions import ClientError, ParamValidationError
 import logging
+import random
+import time
 from classes.s3_object import S3Object
-import fnmatch
+from classes.object_metadata import ObjectMetadata
+import os
 from classes.file_types import FileType
+from classes.file_type_registry import FileTypeRegistry
+from classes.local_file_type_store import LocalFileTypeStore
 from classes.file_processing_data import FileProcessingData
+from classes.dataframe_cache import DataFrameCache
+from classes.decompressing_reader import DecompressingReader
+from classes.merge_batch import MergeBatch
+from classes.processed_ledger import ProcessedLedger
+from classes.memory_ledger_store import MemoryLedgerStore
 from pandas.core.groupby.groupby import DataError
 import pandas
-import s3fs
+import change_set_functions
+import clients
+import compression_functions
+import delta_log
+import metrics
+import partitioned_store
+import schema_functions
+import streaming_merge
+import transfer
+import upsert_engine
+
+# parsed master dataframes, shared by every merge in this process
+mstr_cache = DataFrameCache()
+# masters kept on local disk between restarts, app.main sets this when a cache directory is configured
+mstr_disk_cache = None
+# known file types, app.main can point this at a different store
+file_type_registry = FileTypeRegistry(LocalFileTypeStore(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                      'file_types.json')))
+# S3 events already merged, app.main can point this at a local file
+processed_ledger = ProcessedLedger(MemoryLedgerStore())
+ALREADY_PROCESSED = 'Already processed'
+# result of a merge that kept losing the race for its master to other workers, its message is left on the queue
+CONFLICT = 'Conflict'
+# error codes of a conditional write whose object changed since it was read
+CONFLICT_CODES = ('PreconditionFailed', 'ConditionalRequestConflict', '412', '409')
+# how often a merge is retried after another worker changed its master, app.main sets these from the config
+conflict_retries = 5
+conflict_backoff_seconds = 0.2
 
 
 def lookup_file(object_key):
     """
     Takes in the S3 Object Key and returns the file processing information.
+    A compressed upload such as user/file.csv.gz matches the patterns for user/file.csv as well as its own.
     """
     if isinstance(object_key, str):
-        # Populate list of known files. Currently hardcoded.
-        # Future version will have an API set up to pull this data from dynamoDB table.
-        file_types = [FileType("Email CSV", "user/userEmailFile*.csv", "mstr/userEmailFile.csv", "Email", ",", "\""),
-                       FileType("Identifier CSV", "user/randomDataFile*.csv", "mstr/randomDataFile.csv", "Id", ",", "\"")]
-        # Loop through known files to find the match to the currently posted file.
-        for file_type in file_types:
-            if fnmatch.fnmatch(object_key, file_type.incoming_file_pattern):
-                # return the known file object once we have a match
-                logging.info('File Type Found: {}'.format(file_type.file_process_name))
-                return file_type
+        # look for the known file matching the currently posted file.
+        file_type = file_type_registry.lookup(object_key)
+        if file_type is None and compression_functions.get_extension_codec(object_key) is not None:
+            file_type = file_type_registry.lookup(compression_functions.strip_extension(object_key))
+        if file_type is not None:
+            logging.info('File Type Found: {}'.format(file_type.file_process_name))
+            return file_type
         # If there is no match, create new file type.
     return create_new_file_type(object_key)
 
 
+def get_s3_resource():
+    """
+    Returns the s3 resource of this thread. It is kept for every merge the thread runs and its connections are
+    pooled with the other threads', see clients.
+    """
+    return clients.get_resource('s3')
+
+
+def get_object_metadata(s3, s3_object):
+    """
+    Returns the ObjectMetadata of the object, making a single HEAD request the first time the object is checked.
+    Metadata already known from the event record or from writing the object is returned without a request.
+    """
+    if s3_object.metadata is None:
+        try:
+            response = s3.meta.client.head_object(Bucket=s3_object.bucket, Key=s3_object.key)
+            s3_object.metadata = ObjectMetadata(True, response['ContentLength'], response['ETag'])
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('404', 'NoSuchKey'):
+                raise
+            s3_object.metadata = ObjectMetadata(False)
+    return s3_object.metadata
+
+
+def set_written_metadata(s3_object, size, response):
+    """
+    Records the metadata of an object this process has just written, taken from the write response.
+    """
+    s3_object.metadata = ObjectMetadata(True, size, response.get('ETag'))
+    return s3_object.metadata
+
+
+def get_write_conditions(etag):
+    """
+    Returns the arguments that make a write only succeed if the object still has the ETag it was read with, or
+    is still missing when it did not exist.
+    """
+    if etag is None:
+        return {'IfNoneMatch': '*'}
+    return {'IfMatch': '"{}"'.format(etag.strip('"'))}
+
+
+def is_conflict(error):
+    """
+    Returns whether a ClientError is a conditional write failing because another worker changed the object.
+    """
+    return error.response['Error']['Code'] in CONFLICT_CODES
+
+
+def wait_to_retry(attempt):
+    """
+    Sleeps a random, growing time before retrying after a conflict, so the workers racing for a master spread out.
+    """
+    time.sleep(random.uniform(0, conflict_backoff_seconds * (attempt + 1)))
+
+
 def s3_file_exists(s3, s3_object):
     """
-    Takes in the S3 Object Key and returns the file processing information.
+    Takes in the S3 Object and returns whether it exists.
     """
     try:
-        bucket_obj = s3.Bucket(s3_object.bucket)
-        objs = list(bucket_obj.objects.filter(Prefix=s3_object.key))
-        if len(objs) > 0 and objs[0].key == s3_object.key:
-            return True
+        return get_object_metadata(s3, s3_object).exists
     except TypeError as e:
         logging.info('Handling TypeError: {}'.format(e))
     except AttributeError as e:
         logging.info('Handling AttributeError: {}'.format(e))
+    except ParamValidationError as e:
+        logging.info('Handling ParamValidationError: {}'.format(e))
     return False
 
 
+def is_already_processed(user_object, file_type):
+    """
+    Returns whether the processed ledger has already seen the S3 event of the user object. A duplicate gets
+    processing data recording that it was skipped.
+    """
+    if not processed_ledger.contains(user_object):
+        return False
+    user_object.processing_data = FileProcessingData(stg_file_name=user_object.key.replace('user/', ''),
+                                                     mstr_file_name=file_type.master_file_s3_key.replace('mstr/', ''),
+                                                     stg_file_size=user_object.metadata.size,
+                                                     duplicate_event=1)
+    return True
+
+
 def create_new_file_type(key):
     """
-    Currently just returns a faked out a file type using the key passed in. Future versions where we use a data store for the
-    file types will allow this function to write to the data store.
+    Creates a file type for a key no known pattern matches, and persists it to the file type registry so the
+    next file with this key finds it there.
     """
 
     if not isinstance(key, str) or not key.startswith('user/'):
         logging.info('Invalid object key: {}'.format(key))
         return None
+    # compressed and uncompressed uploads of the same file share a file type and master
+    key = compression_functions.strip_extension(key)
     file_type = FileType(file_process_name=key.replace('user/', ''),
                          incoming_file_pattern=key,
                          master_file_s3_key=key.replace('user/', 'mstr/'),
                          primary_key='Id',
                          field_delimiter=',',
-                         text_qualifier='\"'
+                         text_qualifier='\"',
+                         infer_schema=True
                          )
+    file_type_registry.add(file_type)
     return file_type
 
 
-def get_dataframe(s3, s3_object, file_type):
+def read_csv(s3, s3_object, file_type, project=True):
+    """
+    Parses the csv object into a dataframe, reading it from the download buffer of the transfer layer.
+    A gzip, zstd or bz2 object is decompressed as it is parsed, whatever its key.
+    A file type that infers its schema gets it from the first file read, which is then parsed again with it.
+    The column projection of the schema is only applied with project. A user object that was put again since its
+    event is read as its current version.
+    """
+    with s3_object.stage_timer.stage('download'):
+        reader = transfer.download_object(s3, s3_object, current=s3_object.key.startswith('user/'))
+    with s3_object.stage_timer.stage('parse'):
+        codec = compression_functions.detect_codec(reader, s3_object.key)
+        if codec is not None:
+            reader = DecompressingReader(reader, codec)
+        df = schema_functions.parse_csv(reader, file_type, project)
+        if file_type.infer_schema and file_type.column_schema is None:
+            set_inferred_schema(file_type, df)
+            reader.seek(0)
+            df = schema_functions.parse_csv(reader, file_type, project)
+        # the parsers read a compressed object to the end, an uncompressed one is its own size
+        s3_object.uncompressed_size = reader.tell() if codec is not None else s3_object.metadata.size
+        return df
+
+
+def set_inferred_schema(file_type, df):
+    """
+    Sets the schema of the file type from a parsed file and saves it to the file type registry.
+    """
+    file_type.column_schema = schema_functions.get_inferred_schema(df, file_type)
+    logging.info('Inferred schema for {}: {}'.format(file_type.file_process_name, file_type.column_schema))
+    file_type_registry.update(file_type)
+
+
+def write_csv(s3, s3_object, df, compression=None, compression_level=None, conditions=None):
+    """
+    Writes the dataframe to the object as csv, uploaded in parts as it is serialized and compressed with the
+    codec when one is given. conditions from get_write_conditions make the write fail with a conflict if the
+    object changed. Returns the metadata of the new object.
+    """
+    writer = transfer.upload_csv(s3, s3_object, df, compression=compression, compression_level=compression_level,
+                                 conditions=conditions)
+    return set_written_metadata(s3_object, writer.size, writer.response)
+
+
+def get_dataframe(s3, s3_object, file_type, cache=None, disk_cache=None, project=True):
     """
     Returns a data frame for the given object and type.
     If the object does not exist, returns an empty dataframe.
+    A master is read with project False, so the columns left out of the schema's projection are written back.
+    When a cache is passed in, a cached dataframe with the object's current ETag is returned instead of reading
+    the object, and a dataframe that is read is added to the cache. A disk cache is checked after the cache,
+    a dataframe it has is mapped from disk instead of being downloaded and parsed.
     """
     if not isinstance(file_type, FileType):
         logging.info('Bad file_type')
         return None
     try:
         if s3_file_exists(s3, s3_object):
-            return pandas.read_csv(filepath_or_buffer=s3_object.path,
-                                   delimiter=file_type.field_delimiter,
-                                   quotechar=file_type.text_qualifier)
+            etag = s3_object.metadata.etag
+            if cache is not None:
+                df = cache.get(s3_object.path, etag)
+                if df is not None:
+                    logging.info('Cache hit: {}'.format(s3_object.path))
+                    return df
+            if disk_cache is not None:
+                with s3_object.stage_timer.stage('disk_cache_read'):
+                    df = disk_cache.get(s3_object.path, etag)
+                if df is not None:
+                    logging.info('Disk cache hit: {}'.format(s3_object.path))
+                    if cache is not None:
+                        cache.put(s3_object.path, etag, df)
+                    return df
+            df = read_csv(s3, s3_object, file_type, project)
+            if cache is not None:
+                cache.put(s3_object.path, etag, df)
+            if disk_cache is not None:
+                with s3_object.stage_timer.stage('disk_cache_write'):
+                    disk_cache.put(s3_object.path, etag, df)
+            return df
     except TypeError as e:
         logging.info('Handling TypeError: {}'.format(e))
     except AttributeError as e:
@@ -84,82 +257,230 @@ def get_dataframe(s3, s3_object, file_type):
     except ParamValidationError as e:
         logging.info('Handling ParamValidationError: {}'.format(e))
     # Return an empty data frame containing the primary key.
-    return pandas.DataFrame(columns=[file_type.primary_key])
+    return pandas.DataFrame(columns=file_type.key_columns)
 
 
 def merge_to_mstr(user_object, file_type):
     """
     Reads the user and master objects into dataframes. Updates the master dataframe with changes from the user
     object and writes a new master object with these updates.
+    File types stored as parquet partitions are handed off to partitioned_store, file types using the streaming
+    merge mode are handed off to streaming_merge and the delta merge mode to delta_log.
+    """
+    return merge_batch_to_mstr([user_object], file_type)[0]
+
+
+def get_stg_processing_data(user_object, file_type, df_mstr, upsert_result, mstr_prev_file_size,
+                            mstr_prev_uncompressed_size=0):
+    """
+    Returns the processing stats for applying one user object to the master.
     """
-    s3 = boto3.resource('s3')
-    s3fs.S3FileSystem.cachable = False
+    return FileProcessingData(stg_file_name=user_object.key.replace('user/', ''),
+                              mstr_file_name=file_type.master_file_s3_key.replace('mstr/', ''),
+                              stg_row_count=upsert_result.stg_row_count,
+                              stg_column_count=len(upsert_result.df_stg.columns),
+                              stg_file_size=user_object.metadata.size,
+                              stg_duplicates=upsert_result.stg_duplicates,
+                              stg_distinct_row_count=len(upsert_result.df_stg.index),
+                              mstr_prev_row_count=len(df_mstr.index),
+                              mstr_prev_column_count=len(df_mstr.columns),
+                              mstr_prev_file_size=mstr_prev_file_size,
+                              mstr_new_row_count=len(upsert_result.df_mstr_new.index),
+                              mstr_new_column_count=len(upsert_result.df_mstr_new.columns),
+                              update_count=upsert_result.update_count,
+                              new_record_count=upsert_result.new_record_count,
+                              unchanged_count=upsert_result.unchanged_count,
+                              stg_uncompressed_size=user_object.uncompressed_size or 0,
+                              mstr_prev_uncompressed_size=mstr_prev_uncompressed_size
+                              )
+
+
+def load_batch(s3, user_objects, file_type):
+    """
+    First step of a batch merge, reads the master and the user objects into dataframes.
+    User objects that can't be used get their result set straight away.
+    """
+    batch = MergeBatch(user_objects, file_type)
     # set the master object
-    mstr_object = S3Object(user_object.bucket, file_type.master_file_s3_key)
-    # make sure the user object still exists
-    if not s3_file_exists(s3, user_object):
-        logging.info('User file does not exist.')
-        return 'User file not found'
+    batch.mstr_object = S3Object(user_objects[0].bucket, file_type.master_file_s3_key)
+    logging.info('Loading mstr dataframe.')
+    # load the mstr dataframe
+    batch.df_mstr = get_dataframe(s3, batch.mstr_object, file_type, cache=mstr_cache, disk_cache=mstr_disk_cache,
+                                  project=False)
+    logging.info('Loaded mstr dataframe.')
+    batch.mstr_prev_file_size = get_object_metadata(s3, batch.mstr_object).size
+    # the new master is only written if the master still has this ETag
+    batch.mstr_etag = batch.mstr_object.metadata.etag if batch.mstr_object.metadata.exists else None
 
-    if not user_object.key.startswith('user/'):
-        logging.info('User object error')
-        return 'User object error'
+    for index, user_object in enumerate(user_objects):
+        # make sure the user object still exists
+        if not s3_file_exists(s3, user_object):
+            logging.info('User file does not exist.')
+            batch.results[index] = 'User file not found'
+            continue
 
-    try:
-        logging.info('Loading stg dataframe.')
+        if not user_object.key.startswith('user/'):
+            logging.info('User object error')
+            batch.results[index] = 'User object error'
+            continue
+
+        if is_already_processed(user_object, file_type):
+            batch.results[index] = ALREADY_PROCESSED
+            continue
+
+        logging.info('Loading stg dataframe: {}'.format(user_object.path))
         # load the stg dataframe
-        df_stg = get_dataframe(s3, user_object, file_type)
+        batch.stg_frames.append((index, get_dataframe(s3, user_object, file_type)))
         logging.info('Loaded stg dataframe.')
-        logging.info('Loading mstr dataframe.')
-        # load the mstr dataframe
-        df_mstr = get_dataframe(s3, mstr_object, file_type)
-        logging.info('Loaded mstr dataframe.')
-        # get an initial row count for the stg
-        stg_initial_rowcount = len(df_stg.index)
-        logging.info('stg_initial_count: {}'.format(stg_initial_rowcount))
-        # dedupe the stg data on the identifier, just going to keep last since this is just a demo.
-        df_stg.drop_duplicates(subset=[file_type.primary_key], keep='last', inplace=True)
-        # count of records to update
-        update_count = len(df_mstr.merge(df_stg, "inner", on=file_type.primary_key).index)
-        logging.info('update_count: {}'.format(update_count))
-        # create a concatenated dataframe
-        logging.info('Loading new mstr dataframe.')
-        df_mstr_new = pandas.concat([df_mstr, df_stg])
-        df_mstr_new.drop_duplicates(subset=[file_type.primary_key], keep='last', inplace=True)
-        logging.info('Loaded new mstr dataframe.')
-        # dedupe, keeping last which will be from the stg
-        # df_mstr_new.drop_duplicates(subset=[file_type.primary_key], keep='last', inplace=True)
-        # set the processing stats
+    return batch
+
+
+def apply_batch(batch):
+    """
+    Second step of a batch merge, applies the loaded user dataframes to the master in order.
+    A user object that fails to apply gets its error result and the rest are still applied.
+    """
+    df_mstr = batch.df_mstr
+    mstr_prev_file_size = batch.mstr_prev_file_size
+    # not known when the master came from the cache
+    mstr_prev_uncompressed_size = batch.mstr_object.uncompressed_size or 0
+    for index, df_stg in batch.stg_frames:
+        user_object = batch.user_objects[index]
+        try:
+            logging.info('stg_initial_count: {}'.format(len(df_stg.index)))
+            # dedupe the stg, replace the matching mstr rows and add the new ones in a single pass
+            upsert_result = upsert_engine.upsert_file_type(df_mstr, df_stg, batch.file_type, user_object.stage_timer)
+            logging.info('update_count: {}'.format(upsert_result.update_count))
+            # set the processing stats
+            file_processing_data = get_stg_processing_data(user_object, batch.file_type, df_mstr, upsert_result,
+                                                           mstr_prev_file_size, mstr_prev_uncompressed_size)
+        except DataError as e:
+            logging.info('Handling DataError: {}'.format(e))
+            batch.results[index] = 'Error'
+            continue
+        except KeyError as e:
+            logging.info('Handling KeyError: {}'.format(e))
+            batch.results[index] = 'Key error'
+            continue
+        # an update that changes no values keeps the mstr as it was, rows in their current order
+        if not upsert_result.mstr_unchanged:
+            df_mstr = upsert_result.df_mstr_new
+            batch.mstr_changed = True
         mstr_prev_file_size = 0
-        if s3_file_exists(s3, mstr_object):
-            mstr_prev_file_size = s3.Object(mstr_object.bucket, mstr_object.key).content_length
-        file_processing_data = FileProcessingData(stg_file_name=user_object.key.replace('user/', ''),
-                                                  mstr_file_name=file_type.master_file_s3_key.replace('mstr/', ''),
-                                                  stg_row_count=stg_initial_rowcount,
-                                                  stg_column_count=len(df_stg.columns),
-                                                  stg_file_size=s3.Object(user_object.bucket, user_object.key).content_length,
-                                                  stg_duplicates=stg_initial_rowcount-len(df_stg.index),
-                                                  stg_distinct_row_count=len(df_stg.index),
-                                                  mstr_prev_row_count=len(df_mstr.index),
-                                                  mstr_prev_column_count=len(df_mstr.columns),
-                                                  mstr_prev_file_size=mstr_prev_file_size,
-                                                  mstr_new_row_count=len(df_mstr_new.index),
-                                                  mstr_new_column_count=len(df_mstr_new.columns),
-                                                  update_count=update_count,
-                                                  new_record_count=len(df_mstr.merge(df_stg, "right", on=file_type.primary_key).index) - update_count
-                                                  )
-
-        # write out the new file
-        df_mstr_new.to_csv(mstr_object.path, index=False)
-        file_processing_data.mstr_new_file_size = s3.Object(mstr_object.bucket, mstr_object.key).content_length
-        logging.info(str(file_processing_data))
-    except DataError as e:
-        logging.info('Handling DataError: {}'.format(e))
-        return 'Error'
-    except KeyError as e:
-        logging.info('Handling KeyError: {}'.format(e))
-        return 'Key error'
-    except Exception as e:
-        logging.info('Handling Exception error: {}'.format(e))
-        return 'Error'
-    return 'Success'
+        mstr_prev_uncompressed_size = 0
+        if upsert_result.df_change_set is not None:
+            batch.change_sets[index] = upsert_result.df_change_set
+        batch.applied.append((index, file_processing_data))
+    batch.df_mstr = df_mstr
+    batch.stg_frames = []
+    return batch
+
+
+def write_batch(s3, batch):
+    """
+    Last step of a batch merge, writes the new master if any user object changed it, then the change sets of the
+    applied user objects, and logs the stats. Raises a conflict ClientError when another worker wrote the master
+    after it was loaded. The applied user objects are added to the processed ledger.
+    Returns the results of the batch.
+    """
+    if batch.applied:
+        first_processing_data = batch.applied[0][1]
+        if batch.mstr_changed:
+            logging.info('Writing new mstr with {} user files applied.'.format(len(batch.applied)))
+            # write out the new file, the size and ETag come from the write so the master is not checked again
+            mstr_metadata = write_csv(s3, batch.mstr_object, batch.df_mstr, batch.file_type.mstr_compression,
+                                      batch.file_type.mstr_compression_level, get_write_conditions(batch.mstr_etag))
+            # this worker wrote the master last, the next merge can skip reading it back as long as the ETag matches
+            df_cached = batch.df_mstr.infer_objects()
+            mstr_cache.put(batch.mstr_object.path, mstr_metadata.etag, df_cached)
+            if mstr_disk_cache is not None:
+                with batch.mstr_object.stage_timer.stage('disk_cache_write'):
+                    mstr_disk_cache.put(batch.mstr_object.path, mstr_metadata.etag, df_cached)
+            first_processing_data.bytes_uploaded = mstr_metadata.size
+        else:
+            logging.info('No mstr rows changed, skipping the mstr write.')
+            mstr_metadata = batch.mstr_object.metadata
+        # the master is read and written once for the batch, its stages and bytes are counted on the first file
+        first_processing_data.stage_seconds = metrics.get_stage_seconds(batch.mstr_object, 'mstr_')
+        if 'download' in batch.mstr_object.stage_timer.seconds:
+            first_processing_data.bytes_downloaded = batch.mstr_prev_file_size
+        for index, file_processing_data in batch.applied:
+            file_processing_data.mstr_new_file_size = mstr_metadata.size or 0
+            file_processing_data.mstr_new_uncompressed_size = batch.mstr_object.uncompressed_size or 0
+            file_processing_data.mstr_write_skipped = int(not batch.mstr_changed)
+            file_processing_data.mstr_cache_hits = mstr_cache.hits
+            file_processing_data.mstr_cache_misses = mstr_cache.misses
+            if mstr_disk_cache is not None:
+                file_processing_data.mstr_disk_cache_hits = mstr_disk_cache.hits
+                file_processing_data.mstr_disk_cache_misses = mstr_disk_cache.misses
+            if index in batch.change_sets:
+                file_processing_data.change_set_key = change_set_functions.write_change_set(
+                    s3, batch.file_type, batch.user_objects[index], batch.change_sets.pop(index))
+            logging.info(str(file_processing_data))
+            batch.user_objects[index].processing_data = file_processing_data
+            batch.results[index] = 'Success'
+            processed_ledger.record(batch.user_objects[index], 'Success')
+    return batch.results
+
+
+def merge_each(user_objects, file_type, merge):
+    """
+    Merges the user objects one at a time with the merge function of their merge mode, skipping the ones already
+    in the processed ledger and adding the merged ones.
+    """
+    results = []
+    for user_object in user_objects:
+        if is_already_processed(user_object, file_type):
+            results.append(ALREADY_PROCESSED)
+            continue
+        result = merge(user_object, file_type)
+        if result == 'Success':
+            processed_ledger.record(user_object, result)
+        results.append(result)
+    return results
+
+
+def merge_batch_to_mstr(user_objects, file_type):
+    """
+    Applies a list of user objects for the same file type to the master in a single read-merge-write cycle.
+    The user objects are applied in the order given, which should be the S3 event order.
+    Returns a list with the result of each user object. Stats are logged for every user object, the previous file
+    size is only known for the first one since the intermediate masters are never written.
+    File types stored as parquet partitions or using the streaming or delta merge modes are merged one object at a
+    time.
+    User objects whose S3 event was already merged are skipped with the result 'Already processed'.
+    The master is written conditionally on the ETag it was read with. When another worker wrote it in between, the
+    batch is merged again on top of the new master, up to conflict_retries times. The streaming merge does the same
+    for each object, parquet and delta masters are committed through a manifest written the same way.
+    """
+    if isinstance(file_type, FileType) and file_type.storage_format == 'parquet':
+        return merge_each(user_objects, file_type, partitioned_store.merge_to_partitioned_mstr)
+    if isinstance(file_type, FileType) and file_type.merge_mode == 'delta':
+        return merge_each(user_objects, file_type, delta_log.merge_to_delta_mstr)
+    if isinstance(file_type, FileType) and file_type.merge_mode == 'streaming':
+        return merge_each(user_objects, file_type, streaming_merge.merge_to_mstr_streaming)
+    s3 = get_s3_resource()
+    batch = MergeBatch(user_objects, file_type)
+    for attempt in range(conflict_retries + 1):
+        try:
+            batch = load_batch(s3, user_objects, file_type)
+            apply_batch(batch)
+            return write_batch(s3, batch)
+        except ClientError as e:
+            if not is_conflict(e):
+                logging.info('Handling ClientError: {}'.format(e))
+                return batch.fail('Error')
+            # another worker wrote the master first, merge again on top of its version
+            logging.info('Mstr {} changed while merging, attempt {}.'.format(file_type.master_file_s3_key,
+                                                                             attempt + 1))
+            wait_to_retry(attempt)
+        except DataError as e:
+            logging.info('Handling DataError: {}'.format(e))
+            return batch.fail('Error')
+        except KeyError as e:
+            logging.info('Handling KeyError: {}'.format(e))
+            return batch.fail('Key error')
+        except Exception as e:
+            logging.info('Handling Exception error: {}'.format(e))
+            return batch.fail('Error')
+    return batch.fail(CONFLICT)
@@ -0,0 +1,130 @@
+import csv
+import logging
+import pandas
+
+try:
+    import pyarrow
+    import pyarrow.csv
+except ImportError:
+    pyarrow = None
+
+# dtypes a schema can give a column, with the arrow type each one is parsed as
+ARROW_TYPES = {'str': 'string',
+               'string': 'string',
+               'category': 'string',
+               'int64': 'int64',
+               'Int64': 'int64',
+               'float64': 'float64',
+               'bool': 'bool_',
+               'boolean': 'bool_'}
+
+
+def get_inferred_schema(df, file_type):
+    """
+    Returns a column schema for the columns of the dataframe. Key columns are always read as strings so the key
+    dtype is the same in every file, integers are nullable so a later file with a blank still parses.
+    """
+    dtypes = {}
+    for column, dtype in df.dtypes.items():
+        if column in file_type.key_columns:
+            dtypes[column] = 'str'
+        elif pandas.api.types.is_bool_dtype(dtype):
+            dtypes[column] = 'boolean'
+        elif pandas.api.types.is_integer_dtype(dtype):
+            dtypes[column] = 'Int64'
+        elif pandas.api.types.is_float_dtype(dtype):
+            dtypes[column] = 'float64'
+        else:
+            dtypes[column] = 'str'
+    return {'dtypes': dtypes}
+
+
+def apply_schema(df, column_schema):
+    """
+    Converts the columns of the dataframe to the dtypes of the schema.
+    """
+    dtypes = get_dtypes(column_schema)
+    return df.astype({column: dtype for column, dtype in dtypes.items() if column in df.columns})
+
+
+def get_dtypes(column_schema):
+    """
+    Returns the dtype of every column in the schema, with the categorical columns as category.
+    """
+    dtypes = dict(column_schema.get('dtypes') or {})
+    for column in column_schema.get('categorical_columns') or []:
+        dtypes[column] = 'category'
+    return dtypes
+
+
+def get_columns(column_schema, file_type):
+    """
+    Returns the projected columns including the key columns, or None when every column is read.
+    """
+    columns = column_schema.get('columns')
+    if not columns:
+        return None
+    return list(columns) + [column for column in file_type.key_columns if column not in columns]
+
+
+def read_header(reader, file_type):
+    """
+    Returns the column names from the first line of the file and moves the reader back to the start.
+    """
+    line = reader.readline().decode('utf-8-sig')
+    reader.seek(0)
+    return next(csv.reader([line], delimiter=file_type.field_delimiter, quotechar=file_type.text_qualifier), [])
+
+
+def parse_arrow(reader, file_type, project=True):
+    """
+    Parses the file with the pyarrow csv reader, straight from the download buffer when the reader has one.
+    Columns missing from the schema are read as strings, so their text is written back unchanged.
+    Every column is read when project is False.
+    """
+    dtypes = get_dtypes(file_type.column_schema)
+    columns = get_columns(file_type.column_schema, file_type) if project else None
+    header = read_header(reader, file_type)
+    column_types = {column: getattr(pyarrow, ARROW_TYPES.get(dtypes.get(column), 'string'))() for column in header}
+    source = pyarrow.BufferReader(pyarrow.py_buffer(reader.view)) if hasattr(reader, 'view') else reader
+    table = pyarrow.csv.read_csv(source,
+                                 parse_options=pyarrow.csv.ParseOptions(delimiter=file_type.field_delimiter,
+                                                                        quote_char=file_type.text_qualifier),
+                                 convert_options=pyarrow.csv.ConvertOptions(column_types=column_types,
+                                                                            include_columns=columns,
+                                                                            strings_can_be_null=False))
+    df = table.to_pandas(types_mapper={pyarrow.int64(): pandas.Int64Dtype(),
+                                       pyarrow.bool_(): pandas.BooleanDtype()}.get)
+    return apply_schema(df, file_type.column_schema)
+
+
+def parse_csv(reader, file_type, project=True):
+    """
+    Parses the file into a dataframe. A file type with a column schema is parsed with pyarrow using the schema's
+    dtypes and projection, or with the pandas parser when pyarrow is not installed. A file that does not fit its
+    schema is parsed again with every column as a string, which keeps the text of every value and the key dtype.
+    A file type without a schema is parsed the way it always has been.
+    The projection is skipped when project is False, for the master, which is written back with every column.
+    """
+    columns = get_columns(file_type.column_schema, file_type) if project and file_type.column_schema else None
+    if file_type.column_schema is None:
+        return pandas.read_csv(filepath_or_buffer=reader,
+                               delimiter=file_type.field_delimiter,
+                               quotechar=file_type.text_qualifier)
+    try:
+        if pyarrow is not None:
+            return parse_arrow(reader, file_type, project)
+        return pandas.read_csv(filepath_or_buffer=reader,
+                               delimiter=file_type.field_delimiter,
+                               quotechar=file_type.text_qualifier,
+                               dtype=get_dtypes(file_type.column_schema),
+                               usecols=columns)
+    except (ValueError, TypeError) as e:
+        logging.info('Handling ValueError: {}, parsing without the schema.'.format(e))
+    reader.seek(0)
+    return pandas.read_csv(filepath_or_buffer=reader,
+                           delimiter=file_type.field_delimiter,
+                           quotechar=file_type.text_qualifier,
+                           dtype=str,
+                           keep_default_na=False,
+                           usecols=columns)
@@ -0,0 +1,277 @@
+from contextlib import contextmanager
+import logging
+import math
+import os
+import tempfile
+from classes.decompressing_reader import DecompressingReader
+from classes.s3_object import S3Object
+from classes.file_processing_data import FileProcessingData
+from botocore.exceptions import ClientError
+from pandas.core.groupby.groupby import DataError
+import pandas
+import change_set_functions
+import compression_functions
+import s3_functions
+import transfer
+import upsert_engine
+
+# Rows read from S3 per chunk while spilling.
+STREAMING_CHUNK_ROWS = 50000
+# Rough ratio of in-memory dataframe size to csv size, used to size the partitions.
+DATAFRAME_SIZE_FACTOR = 5
+
+
+def get_partition_count(total_file_size, memory_limit_mb):
+    """
+    Returns the number of hash partitions needed so a single partition of the given csv bytes fits in the memory limit.
+    """
+    memory_limit = max(int(memory_limit_mb), 1) * 1024 * 1024
+    return max(1, int(math.ceil(total_file_size * DATAFRAME_SIZE_FACTOR / memory_limit)))
+
+
+def get_key_text(values):
+    """
+    Returns the key column as text, whole numbers written without a decimal point so 1 and 1.0 are the same key
+    whether pandas inferred an integer or a float column for the file.
+    """
+    text = values.astype(str)
+    if pandas.api.types.is_float_dtype(values):
+        whole = values.notna() & (values == values.round())
+        text[whole] = values[whole].astype('int64').astype(str)
+    return text
+
+
+def get_partition_ids(df, key_columns, partition_count, normalize=True):
+    """
+    Returns the partition number of each row, using a hash of the primary key columns.
+    The key is hashed as text so the partition does not depend on the dtype pandas inferred for the file. Without
+    normalize whole floats are hashed as written by astype(str), the way partitioned masters laid out before
+    get_key_text were.
+    """
+    df_keys = df[key_columns]
+    if not normalize:
+        df_keys = df_keys.astype(str)
+    elif isinstance(df_keys, pandas.Series):
+        df_keys = get_key_text(df_keys)
+    else:
+        df_keys = df_keys.apply(get_key_text)
+    return pandas.util.hash_pandas_object(df_keys, index=False) % partition_count
+
+
+def download(s3, s3_object, spill_dir, name, current=False):
+    """
+    Downloads the csv object to a file in the spill directory and returns its path. The master is read as the
+    version whose ETag the new master is written conditionally on, a user object with current as its current
+    version.
+    """
+    path = os.path.join(spill_dir, name)
+    transfer.download_file(s3, s3_object, path, current)
+    return path
+
+
+@contextmanager
+def open_csv(path):
+    """
+    Opens the downloaded csv file, a gzip, zstd or bz2 file is decompressed as it is read.
+    """
+    with open(path, 'rb') as source:
+        codec = compression_functions.detect_codec(source)
+        yield DecompressingReader(source, codec) if codec is not None else source
+
+
+def read_header(path, file_type):
+    """
+    Returns the column names of the downloaded csv file without reading the data.
+    """
+    with open_csv(path) as source:
+        return list(pandas.read_csv(filepath_or_buffer=source,
+                                    delimiter=file_type.field_delimiter,
+                                    quotechar=file_type.text_qualifier,
+                                    nrows=0).columns)
+
+
+def read_chunks(source, file_type):
+    """
+    Returns an iterator over the opened csv file in chunks of STREAMING_CHUNK_ROWS rows.
+    Values are kept as text so each partition writes back exactly what was read.
+    """
+    return pandas.read_csv(filepath_or_buffer=source,
+                           delimiter=file_type.field_delimiter,
+                           quotechar=file_type.text_qualifier,
+                           dtype=str,
+                           keep_default_na=False,
+                           chunksize=STREAMING_CHUNK_ROWS)
+
+
+def read_spill_file(spill_path, columns, file_type):
+    """
+    Reads a spill file back into a dataframe. A partition nobody wrote to is returned empty.
+    """
+    if not os.path.exists(spill_path):
+        return pandas.DataFrame(columns=columns, dtype=str)
+    return pandas.read_csv(filepath_or_buffer=spill_path,
+                           delimiter=file_type.field_delimiter,
+                           quotechar=file_type.text_qualifier,
+                           dtype=str,
+                           keep_default_na=False)
+
+
+def spill_partitions(path, file_type, spill_dir, prefix, partition_count):
+    """
+    Streams the downloaded csv file into one spill file per hash partition.
+    Returns the number of rows read and the uncompressed size of the file.
+    """
+    row_count = 0
+    with open_csv(path) as source:
+        for chunk in read_chunks(source, file_type):
+            row_count += len(chunk.index)
+            partition_ids = get_partition_ids(chunk, file_type.key_columns, partition_count)
+            for partition_id, df_partition in chunk.groupby(partition_ids.values):
+                spill_path = os.path.join(spill_dir, '{}_{}.csv'.format(prefix, partition_id))
+                df_partition.to_csv(spill_path, mode='a', header=not os.path.exists(spill_path), index=False,
+                                    sep=file_type.field_delimiter, quotechar=file_type.text_qualifier)
+        # the parser reads a compressed file to the end, an uncompressed one is its own size
+        uncompressed_size = source.tell() if isinstance(source, DecompressingReader) else os.path.getsize(path)
+    return row_count, uncompressed_size
+
+
+def merge_to_mstr_streaming(user_object, file_type):
+    """
+    Out of core version of merge_to_mstr.
+    Streams the user and master objects into hash partitions on local disk, upserts one partition at a time and
+    streams the new master object back to S3, so memory use is bounded by file_type.memory_limit_mb. Compressed
+    objects are decompressed as they are read and the master is written with the file type's mstr_compression.
+    A merge that leaves every mstr row as it was skips the write, and the change set is written when the file
+    type asks for one.
+    The master is written conditionally on the ETag it was read with. When another worker wrote it in between, the
+    merge is done again on top of the new master, up to s3_functions.conflict_retries times.
+    """
+    s3 = s3_functions.get_s3_resource()
+    # set the master object
+    mstr_object = S3Object(user_object.bucket, file_type.master_file_s3_key)
+    # make sure the user object still exists
+    if not s3_functions.s3_file_exists(s3, user_object):
+        logging.info('User file does not exist.')
+        return 'User file not found'
+
+    if not user_object.key.startswith('user/'):
+        logging.info('User object error')
+        return 'User object error'
+
+    try:
+        for attempt in range(s3_functions.conflict_retries + 1):
+            try:
+                file_processing_data = merge_partitions(s3, user_object, mstr_object, file_type)
+                break
+            except ClientError as e:
+                if not s3_functions.is_conflict(e):
+                    raise
+                # another worker wrote the master first, merge again on top of its version
+                logging.info('Mstr {} changed while merging, attempt {}.'.format(file_type.master_file_s3_key,
+                                                                                 attempt + 1))
+                mstr_object.metadata = None
+                s3_functions.wait_to_retry(attempt)
+        else:
+            return s3_functions.CONFLICT
+        logging.info(str(file_processing_data))
+        user_object.processing_data = file_processing_data
+    except DataError as e:
+        logging.info('Handling DataError: {}'.format(e))
+        return 'Error'
+    except KeyError as e:
+        logging.info('Handling KeyError: {}'.format(e))
+        return 'Key error'
+    except Exception as e:
+        logging.info('Handling Exception error: {}'.format(e))
+        return 'Error'
+    return 'Success'
+
+
+def merge_partitions(s3, user_object, mstr_object, file_type):
+    """
+    Runs one attempt of a streaming merge and returns its FileProcessingData. Raises a conflict ClientError when
+    the master changes while it is downloaded or before the new master is written.
+    """
+    mstr_metadata = s3_functions.get_object_metadata(s3, mstr_object)
+    mstr_exists = mstr_metadata.exists
+    mstr_prev_file_size = mstr_metadata.size
+    # the new master is only written if the master still has this ETag
+    mstr_conditions = s3_functions.get_write_conditions(mstr_metadata.etag if mstr_exists else None)
+
+    with tempfile.TemporaryDirectory(prefix='s3-data-merge-') as spill_dir:
+        with user_object.stage_timer.stage('download'):
+            stg_path = download(s3, user_object, spill_dir, 'stg_download', current=True)
+            mstr_path = download(s3, mstr_object, spill_dir, 'mstr_download') if mstr_exists else None
+        # the user object's size is only known once it is downloaded, it may have been put again since its event
+        stg_file_size = user_object.metadata.size
+        partition_count = get_partition_count(stg_file_size + mstr_prev_file_size, file_type.memory_limit_mb)
+        logging.info('Streaming merge with {} partitions.'.format(partition_count))
+        stg_columns = read_header(stg_path, file_type)
+        mstr_columns = read_header(mstr_path, file_type) if mstr_exists else file_type.key_columns
+        # new columns from the stg are added after the existing mstr columns, the same as pandas.concat
+        mstr_new_columns = mstr_columns + [column for column in stg_columns if column not in mstr_columns]
+
+        file_processing_data = FileProcessingData(stg_file_name=user_object.key.replace('user/', ''),
+                                                  mstr_file_name=file_type.master_file_s3_key.replace('mstr/', ''),
+                                                  stg_column_count=len(stg_columns),
+                                                  stg_file_size=stg_file_size,
+                                                  mstr_prev_column_count=len(mstr_columns),
+                                                  mstr_prev_file_size=mstr_prev_file_size,
+                                                  mstr_new_column_count=len(mstr_new_columns))
+
+        logging.info('Spilling stg partitions.')
+        with user_object.stage_timer.stage('stg_spill'):
+            file_processing_data.stg_row_count, file_processing_data.stg_uncompressed_size = spill_partitions(
+                stg_path, file_type, spill_dir, 'stg', partition_count)
+        if mstr_exists:
+            logging.info('Spilling mstr partitions.')
+            with user_object.stage_timer.stage('mstr_spill'):
+                file_processing_data.mstr_prev_row_count, file_processing_data.mstr_prev_uncompressed_size = \
+                    spill_partitions(mstr_path, file_type, spill_dir, 'mstr', partition_count)
+
+        logging.info('Merging partitions.')
+        change_sets = []
+        mstr_new_path = os.path.join(spill_dir, 'mstr_new.csv')
+        pandas.DataFrame(columns=mstr_new_columns).to_csv(mstr_new_path, index=False,
+                                                          sep=file_type.field_delimiter,
+                                                          quotechar=file_type.text_qualifier)
+        for partition_id in range(partition_count):
+            df_stg = read_spill_file(os.path.join(spill_dir, 'stg_{}.csv'.format(partition_id)), stg_columns,
+                                     file_type)
+            df_mstr = read_spill_file(os.path.join(spill_dir, 'mstr_{}.csv'.format(partition_id)), mstr_columns,
+                                      file_type)
+            upsert_result = upsert_engine.upsert_file_type(df_mstr, df_stg, file_type, user_object.stage_timer)
+            file_processing_data.stg_distinct_row_count += len(upsert_result.df_stg.index)
+            file_processing_data.mstr_new_row_count += len(upsert_result.df_mstr_new.index)
+            file_processing_data.update_count += upsert_result.update_count
+            file_processing_data.new_record_count += upsert_result.new_record_count
+            file_processing_data.unchanged_count += upsert_result.unchanged_count
+            if upsert_result.df_change_set is not None:
+                change_sets.append(upsert_result.df_change_set)
+            upsert_result.df_mstr_new.reindex(columns=mstr_new_columns).to_csv(mstr_new_path, mode='a', header=False,
+                                                                               index=False,
+                                                                               sep=file_type.field_delimiter,
+                                                                               quotechar=file_type.text_qualifier)
+        file_processing_data.stg_duplicates = file_processing_data.stg_row_count - \
+            file_processing_data.stg_distinct_row_count
+
+        file_processing_data.bytes_downloaded = stg_file_size + mstr_prev_file_size
+        if file_processing_data.new_record_count == 0 and \
+                file_processing_data.unchanged_count == file_processing_data.update_count:
+            logging.info('No mstr rows changed, skipping the mstr write.')
+            file_processing_data.mstr_write_skipped = 1
+            file_processing_data.mstr_new_file_size = mstr_prev_file_size
+        else:
+            # write out the new file in parts, only if no other worker wrote the master since it was read
+            logging.info('Uploading new mstr file.')
+            with user_object.stage_timer.stage('upload'):
+                writer = transfer.upload_file(s3, mstr_object, mstr_new_path, file_type.mstr_compression,
+                                              file_type.mstr_compression_level, mstr_conditions)
+            s3_functions.set_written_metadata(mstr_object, writer.size, writer.response)
+            file_processing_data.mstr_new_file_size = writer.size
+            file_processing_data.mstr_new_uncompressed_size = mstr_object.uncompressed_size
+            file_processing_data.bytes_uploaded = file_processing_data.mstr_new_file_size
+    if change_sets:
+        file_processing_data.change_set_key = change_set_functions.write_change_set(
+            s3, file_type, user_object, pandas.concat(change_sets, ignore_index=True))
+    return file_processing_data
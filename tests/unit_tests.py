@@ -1,12 +1,142 @@
+import asyncio
+import bz2
+from collections.abc import MutableMapping
+import fcntl
+import gzip
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
 import unittest
+from unittest import mock
+from urllib.parse import quote, unquote
 import app
 from classes.file_types import FileType
+from classes.keyed_executor import KeyedExecutor
+from classes.merge_pipeline import MergePipeline
+from classes.dataframe_cache import DataFrameCache
+from classes.disk_dataframe_cache import DiskDataFrameCache
+from classes.file_type_registry import FileTypeRegistry
+from classes.local_file_type_store import LocalFileTypeStore
+from classes.memory_file_type_store import MemoryFileTypeStore
+from classes.processed_ledger import ProcessedLedger
+from classes.memory_ledger_store import MemoryLedgerStore
+from classes.local_ledger_store import LocalLedgerStore
 import boto3
 from classes.s3_object import S3Object
+from classes.file_processing_data import FileProcessingData
+from classes.json_lines_exporter import JsonLinesExporter
+from classes.emf_exporter import EmfExporter
+from classes.prometheus_exporter import PrometheusExporter
+from classes.object_metadata import ObjectMetadata
 import pandas
 from pandas.testing import assert_frame_equal
 import s3_functions
+import clients
+import compression_functions
+import streaming_merge
+import transfer
+import upsert_engine
+import schema_functions
+import message_functions
+from classes.visibility_heartbeat import VisibilityHeartbeat
+from classes.poll_scheduler import PollScheduler
+from classes.acknowledgement_manager import AcknowledgementManager
+from classes.buffer_reader import BufferReader
+import delta_log
+import partitioned_store
+from botocore.exceptions import ClientError
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+import merge_benchmark  # noqa: E402
+from local_s3 import LocalS3, LocalS3Client  # noqa: E402
+from local_sqs import LocalMessage, LocalQueue, get_s3_event_body  # noqa: E402
+
+
+def setUpModule():
+    # keep file types created by the tests out of the file_types.json in the repo
+    seed = LocalFileTypeStore(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'file_types.json')).load()
+    s3_functions.file_type_registry = FileTypeRegistry(MemoryFileTypeStore(seed))
+
+
+class FileStore(MutableMapping):
+    """
+    Dictionary of (bucket, key) to object body kept as files in a directory, so several processes share it.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+
+    def get_path(self, item):
+        return os.path.join(self.directory, quote('{}/{}'.format(*item), safe=''))
+
+    def __getitem__(self, item):
+        try:
+            with open(self.get_path(item), 'rb') as object_file:
+                return object_file.read()
+        except FileNotFoundError:
+            raise KeyError(item)
+
+    def __setitem__(self, item, body):
+        with tempfile.NamedTemporaryFile('wb', dir=self.directory, prefix='.', delete=False) as object_file:
+            object_file.write(body)
+        os.replace(object_file.name, self.get_path(item))
+
+    def __delitem__(self, item):
+        try:
+            os.remove(self.get_path(item))
+        except FileNotFoundError:
+            raise KeyError(item)
+
+    def __iter__(self):
+        for name in os.listdir(self.directory):
+            if not name.startswith('.'):
+                yield tuple(unquote(name).split('/', 1))
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+
+class FileLock:
+    """
+    Lock held across processes with flock on a file, and across the threads of this process.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.thread_lock = threading.Lock()
+        self.lock_file = None
+
+    def __enter__(self):
+        self.thread_lock.acquire()
+        self.lock_file = open(self.path, 'a')
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+        self.lock_file.close()
+        self.thread_lock.release()
+
+
+class FileS3Resource(LocalS3):
+    """
+    LocalS3 keeping its objects in a directory, standing in for S3 shared by several worker processes.
+    Conditional writes are checked and applied under a lock held across the processes.
+    """
+    def __init__(self, directory):
+        super().__init__(store=FileStore(directory), lock=FileLock(os.path.join(directory, '.lock')))
+
+
+def fake_read_csv(s3, s3_object, file_type, project=True):
+    return pandas.read_csv(s3.Object(s3_object.bucket, s3_object.key).get()['Body'],
+                           delimiter=file_type.field_delimiter,
+                           quotechar=file_type.text_qualifier)
 
 
 class TestGetObject(unittest.TestCase):
@@ -47,6 +177,8 @@ class TestGetObject(unittest.TestCase):
              }
         result = app.get_object(message_body)
         self.assertEqual(result.path, 's3://some_bucket_name/some_object_key')
+        self.assertEqual(result.event_time, '2020-02-22T21:28:03.647Z')
+        self.assertEqual(result.sequencer, '005E519CE5135DFF6C')
 
     def test_get_object_blank_message(self):
         # Test that when we send in a blank message we get back a blank object.
@@ -142,6 +274,14 @@ class TestCreateNewFileType(unittest.TestCase):
         result = s3_functions.create_new_file_type('user/unit_test.csv')
         self.assertEqual(self.expected, result)
 
+    def test_create_new_file_type_matches_only_its_key(self):
+        result = s3_functions.create_new_file_type('user/report1.csv')
+        self.assertEqual(result.incoming_file_pattern, 'user/report1.csv')
+        self.assertEqual(result.master_file_s3_key, 'mstr/report1.csv')
+        for key in ('user/report_final.csv', 'user/report.csv', 'user/report2.csv', 'user/reports/q3/summary.csv'):
+            file_type = s3_functions.file_type_registry.lookup(key)
+            self.assertTrue(file_type is None or file_type.master_file_s3_key != result.master_file_s3_key)
+
     def test_create_new_file_type_bad_key(self):
         result = s3_functions.create_new_file_type('junk.csv')
         self.assertIsNone(result)
@@ -238,5 +378,1523 @@ class TestGetDataFrame(unittest.TestCase):
         self.assertIsNone(result)
 
 
+class TestStreamingMerge(unittest.TestCase):
+    df_mstr = pandas.DataFrame(data={'Id': ['1', '2', '3', '4'], 'Name': ['a', 'b', 'c', 'd']})
+    df_stg = pandas.DataFrame(data={'Id': ['3', '5', '5', '6'], 'Name': ['C', 'e', 'E', 'f']})
+
+    def test_get_partition_count_small_file(self):
+        result = streaming_merge.get_partition_count(1024, 512)
+        self.assertEqual(result, 1)
+
+    def test_get_partition_count_large_file(self):
+        result = streaming_merge.get_partition_count(1024 * 1024 * 1024, 512)
+        self.assertEqual(result, 10)
+
+    def test_get_partition_ids_match_across_files(self):
+        # the same key must land in the same partition whichever file it comes from
+        mstr_ids = streaming_merge.get_partition_ids(self.df_mstr, 'Id', 4)
+        stg_ids = streaming_merge.get_partition_ids(self.df_stg, 'Id', 4)
+        self.assertEqual(mstr_ids[2], stg_ids[0])
+
+    def test_get_partition_ids_ignore_number_dtype(self):
+        df_int = pandas.DataFrame(data={'Id': [1, 2, 30], 'Name': ['a', 'b', 'c']})
+        df_float = pandas.DataFrame(data={'Id': [1.0, 2.0, 30.0], 'Name': ['a', 'b', 'c']})
+        df_text = pandas.DataFrame(data={'Id': ['1', '2', '30'], 'Name': ['a', 'b', 'c']})
+        int_ids = list(streaming_merge.get_partition_ids(df_int, ['Id'], 8))
+        self.assertEqual(list(streaming_merge.get_partition_ids(df_float, ['Id'], 8)), int_ids)
+        self.assertEqual(list(streaming_merge.get_partition_ids(df_text, ['Id'], 8)), int_ids)
+
+    def test_partitioned_upsert_matches_in_memory(self):
+        # summing the stats of each partition gives the same result as merging everything at once
+        result = upsert_engine.upsert(self.df_mstr, self.df_stg, ['Id'])
+        mstr_ids = streaming_merge.get_partition_ids(self.df_mstr, ['Id'], 3)
+        stg_ids = streaming_merge.get_partition_ids(self.df_stg, ['Id'], 3)
+        partition_results = [upsert_engine.upsert(self.df_mstr[mstr_ids == i], self.df_stg[stg_ids == i], ['Id'])
+                             for i in range(3)]
+        self.assertEqual(result.update_count, sum(r.update_count for r in partition_results))
+        self.assertEqual(result.new_record_count, sum(r.new_record_count for r in partition_results))
+        df_partitioned = pandas.concat([r.df_mstr_new for r in partition_results])
+        assert_frame_equal(result.df_mstr_new.sort_values('Id').reset_index(drop=True),
+                           df_partitioned.sort_values('Id').reset_index(drop=True))
+
+
+    def test_streaming_merge_again_after_conflict(self):
+        s3 = LocalS3()
+        s3.store[('bucket', 'mstr/streamFile.csv')] = b'Id,Name\n1,a\n2,b\n'
+        s3.store[('bucket', 'user/streamFile1.csv')] = b'Id,Name\n2,c\n3,d\n'
+        file_type = FileType('Stream CSV', 'user/streamFile*.csv', 'mstr/streamFile.csv', 'Id', ',', '"',
+                             merge_mode='streaming')
+        upsert_file_type = upsert_engine.upsert_file_type
+
+        def other_worker_writes(*args):
+            # another worker writes the master after this one read it
+            if s3.store[('bucket', 'mstr/streamFile.csv')] == b'Id,Name\n1,a\n2,b\n':
+                s3.store[('bucket', 'mstr/streamFile.csv')] = b'Id,Name\n1,a\n2,b\n4,e\n'
+            return upsert_file_type(*args)
+
+        with mock.patch('s3_functions.get_s3_resource', return_value=s3), \
+                mock.patch('s3_functions.conflict_backoff_seconds', 0), \
+                mock.patch('upsert_engine.upsert_file_type', side_effect=other_worker_writes):
+            result = streaming_merge.merge_to_mstr_streaming(S3Object('bucket', 'user/streamFile1.csv'), file_type)
+        self.assertEqual(result, 'Success')
+        df_mstr = pandas.read_csv(io.BytesIO(s3.store[('bucket', 'mstr/streamFile.csv')]), dtype=str)
+        self.assertEqual(dict(zip(df_mstr['Id'], df_mstr['Name'])), {'1': 'a', '2': 'c', '3': 'd', '4': 'e'})
+
+    def test_streaming_merge_compressed(self):
+        s3 = LocalS3()
+        s3.store[('bucket', 'mstr/streamFile.csv')] = gzip.compress(b'Id,Name\n1,a\n2,b\n')
+        s3.store[('bucket', 'user/streamFile1.csv.bz2')] = bz2.compress(b'Id,Name\n2,c\n3,d\n')
+        file_type = FileType('Stream CSV', 'user/streamFile*.csv', 'mstr/streamFile.csv', 'Id', ',', '"',
+                             merge_mode='streaming', mstr_compression='gzip')
+        user_object = S3Object('bucket', 'user/streamFile1.csv.bz2')
+        with mock.patch('s3_functions.get_s3_resource', return_value=s3):
+            self.assertEqual(streaming_merge.merge_to_mstr_streaming(user_object, file_type), 'Success')
+        body = gzip.decompress(s3.store[('bucket', 'mstr/streamFile.csv')])
+        self.assertEqual(body, b'Id,Name\n1,a\n2,c\n3,d\n')
+        self.assertEqual(user_object.processing_data.mstr_new_uncompressed_size, len(body))
+
+    def test_streaming_matches_memory_merge(self):
+        # updates, unchanged rows, new keys and duplicate stg keys, merged in several partitions
+        mstr_body = ''.join('{},name {},{}\n'.format(i, i, i % 7) for i in range(40)).encode('utf-8')
+        stg_body = ''.join('{},name {},{}\n'.format(i, i if i % 3 else i * 10, i % 7)
+                           for i in list(range(30, 50)) + [35, 45]).encode('utf-8')
+        processing_data = {}
+        masters = {}
+        for merge_mode in ('memory', 'streaming'):
+            s3 = LocalS3()
+            s3.store[('bucket', 'mstr/streamFile.csv')] = b'Id,Name,Score\n' + mstr_body
+            s3.store[('bucket', 'user/streamFile1.csv')] = b'Id,Name,Score\n' + stg_body
+            file_type = FileType('Stream CSV', 'user/streamFile*.csv', 'mstr/streamFile.csv', 'Id', ',', '"',
+                                 merge_mode=merge_mode)
+            user_object = S3Object('bucket', 'user/streamFile1.csv')
+            with mock.patch('s3_functions.get_s3_resource', return_value=s3), \
+                    mock.patch.object(s3_functions, 'mstr_cache', DataFrameCache()), \
+                    mock.patch('streaming_merge.get_partition_count', return_value=4):
+                if merge_mode == 'memory':
+                    result = s3_functions.merge_to_mstr(user_object, file_type)
+                else:
+                    result = streaming_merge.merge_to_mstr_streaming(user_object, file_type)
+            self.assertEqual(result, 'Success')
+            # the transfer and cache stats differ by how each mode reads its objects
+            processing_data[merge_mode] = {field: value for field, value in vars(user_object.processing_data).items()
+                                           if field not in ('bytes_downloaded', 'mstr_cache_misses', 'stage_seconds')}
+            df_mstr = pandas.read_csv(io.BytesIO(s3.store[('bucket', 'mstr/streamFile.csv')]))
+            masters[merge_mode] = df_mstr.sort_values('Id').reset_index(drop=True)
+        assert_frame_equal(masters['streaming'], masters['memory'])
+        self.assertEqual(processing_data['streaming'], processing_data['memory'])
+
+    def merge_streaming(self, stg_body, **kwargs):
+        s3 = LocalS3()
+        s3.store[('bucket', 'mstr/streamFile.csv')] = b'Id,Name,Score\n1,a,1\n2,b,2\n'
+        s3.store[('bucket', 'user/streamFile1.csv')] = stg_body
+        file_type = FileType('Stream CSV', 'user/streamFile*.csv', 'mstr/streamFile.csv', 'Id', ',', '"',
+                             merge_mode='streaming', **kwargs)
+        # the same S3 event delivered twice
+        user_objects = [S3Object('bucket', 'user/streamFile1.csv', sequencer='01', size=len(stg_body),
+                                 etag=hashlib.md5(stg_body).hexdigest()) for _ in range(2)]
+        with mock.patch('s3_functions.get_s3_resource', return_value=s3), \
+                mock.patch.object(s3_functions, 'processed_ledger', ProcessedLedger(MemoryLedgerStore())):
+            results = [s3_functions.merge_batch_to_mstr([user_object], file_type)[0] for user_object in user_objects]
+        user_object = user_objects[0]
+        return s3, user_object, results
+
+    def test_streaming_unchanged_rows_skip_mstr_write(self):
+        s3, user_object, results = self.merge_streaming(b'Id,Name,Score\n2,b,2\n')
+        self.assertEqual(results, ['Success', s3_functions.ALREADY_PROCESSED])
+        self.assertEqual(s3.calls['put'], 0)
+        self.assertEqual(user_object.processing_data.mstr_write_skipped, 1)
+        self.assertEqual(user_object.processing_data.unchanged_count, 1)
+
+    def test_streaming_change_set(self):
+        s3, user_object, results = self.merge_streaming(b'Id,Name,Score\n2,B,2\n3,c,3\n', write_change_set=True)
+        self.assertEqual(results[0], 'Success')
+        key = user_object.processing_data.change_set_key
+        self.assertEqual(key, 'mstr/streamFile/_changes/streamFile1-01.parquet')
+        df_change_set = pandas.read_parquet(io.BytesIO(s3.store[('bucket', key)]))
+        self.assertEqual(sorted(df_change_set['change']), ['insert', 'update'])
+
+    def test_streaming_partial_update(self):
+        s3, user_object, results = self.merge_streaming(b'Id,Name\n2,B\n', update_mode='partial')
+        self.assertEqual(results[0], 'Success')
+        df_mstr = pandas.read_csv(io.BytesIO(s3.store[('bucket', 'mstr/streamFile.csv')]), dtype=str)
+        self.assertEqual(dict(zip(df_mstr['Id'], df_mstr['Name'])), {'1': 'a', '2': 'B'})
+        self.assertEqual(dict(zip(df_mstr['Id'], df_mstr['Score'])), {'1': '1', '2': '2'})
+
+def legacy_upsert(df_mstr, df_stg, primary_key):
+    """
+    The original merge_to_mstr logic, kept as the reference for the upsert engine.
+    """
+    df_stg = df_stg.drop_duplicates(subset=primary_key, keep='last')
+    update_count = len(df_mstr.merge(df_stg, "inner", on=primary_key).index)
+    new_record_count = len(df_mstr.merge(df_stg, "right", on=primary_key).index) - update_count
+    df_mstr_new = pandas.concat([df_mstr, df_stg])
+    df_mstr_new.drop_duplicates(subset=primary_key, keep='last', inplace=True)
+    return df_stg, df_mstr_new, update_count, new_record_count
+
+
+class TestUpsertEngine(unittest.TestCase):
+    df_mstr = pandas.DataFrame(data={'Id': [1, 2, 3, 4, 4, 6],
+                                     'Region': ['a', 'a', 'b', 'b', 'b', 'c'],
+                                     'Name': ['m1', 'm2', 'm3', 'm4', 'm4b', 'm6']})
+    df_stg = pandas.DataFrame(data={'Id': [3, 5, 5, 4, 7, 3],
+                                    'Region': ['b', 'a', 'a', 'c', 'c', 'b'],
+                                    'Name': ['s3', 's5', 's5b', 's4', 's7', 's3b'],
+                                    'Updated': ['2020-01-03', '2020-01-02', '2020-01-01', '2020-01-01', '2020-01-01',
+                                                '2020-01-01']})
+
+    def assert_matches_legacy(self, df_mstr, df_stg, primary_key):
+        df_stg_legacy, df_mstr_new_legacy, update_count, new_record_count = legacy_upsert(df_mstr, df_stg, primary_key)
+        result = upsert_engine.upsert(df_mstr, df_stg, primary_key)
+        self.assertEqual(result.update_count, update_count)
+        self.assertEqual(result.new_record_count, new_record_count)
+        assert_frame_equal(result.df_stg, df_stg_legacy)
+        assert_frame_equal(result.df_mstr_new, df_mstr_new_legacy.reset_index(drop=True))
+
+    def test_upsert_matches_legacy(self):
+        self.assert_matches_legacy(self.df_mstr, self.df_stg, ['Id'])
+
+    def test_upsert_composite_key_matches_legacy(self):
+        self.assert_matches_legacy(self.df_mstr, self.df_stg, ['Id', 'Region'])
+
+    def test_upsert_empty_mstr_matches_legacy(self):
+        self.assert_matches_legacy(pandas.DataFrame(columns=['Id']), self.df_stg.astype({'Id': object}), ['Id'])
+
+    def test_upsert_random_matches_legacy(self):
+        df_mstr = pandas.DataFrame(data={'Id': [i % 700 for i in range(1000)], 'Value': range(1000)})
+        df_stg = pandas.DataFrame(data={'Id': [(i * 7) % 1100 for i in range(500)], 'Value': range(500)})
+        self.assert_matches_legacy(df_mstr, df_stg, ['Id'])
+
+    def test_dedupe_keep_first(self):
+        result = upsert_engine.dedupe(self.df_stg, ['Id'], keep='first')
+        self.assertEqual(list(result['Name']), ['s3', 's5', 's4', 's7'])
+
+    def test_dedupe_keep_newest(self):
+        result = upsert_engine.dedupe(self.df_stg, ['Id'], keep='newest', timestamp_column='Updated')
+        self.assertEqual(list(result['Name']), ['s3', 's5', 's4', 's7'])
+
+    def test_dedupe_newest_without_timestamp(self):
+        with self.assertRaises(ValueError):
+            upsert_engine.dedupe(self.df_stg, ['Id'], keep='newest')
+
+    def test_file_type_key_columns(self):
+        file_type = FileType("Composite CSV", "user/composite*.csv", "mstr/composite.csv", ['Id', 'Region'], ",", "\"")
+        self.assertEqual(file_type.key_columns, ['Id', 'Region'])
+
+
+class TestPartitionedStore(unittest.TestCase):
+    file_type = FileType("Identifier CSV", "user/randomDataFile*.csv", "mstr/randomDataFile.csv", "Id", ",", "\"",
+                         storage_format='parquet', partition_count=8)
+
+    def test_get_manifest_key(self):
+        result = partitioned_store.get_manifest_key(self.file_type)
+        self.assertEqual(result, 'mstr/randomDataFile/_manifest.json')
+
+    def test_read_manifest_missing(self):
+        result = partitioned_store.read_manifest(LocalS3(), 'bucket', self.file_type)
+        self.assertIsNone(result)
+
+    def test_upsert_partitions_only_rewrites_touched_partitions(self):
+        s3 = LocalS3()
+        df_mstr = pandas.DataFrame(data={'Id': [str(i) for i in range(100)], 'Name': ['a'] * 100})
+        manifest, replaced_keys, update_count, new_record_count, unchanged_count = partitioned_store.upsert_partitions(
+            s3, 'bucket', self.file_type, partitioned_store.new_manifest(self.file_type), df_mstr)
+        self.assertEqual(new_record_count, 100)
+        self.assertEqual(len(manifest['partitions']), 8)
+
+        df_stg = pandas.DataFrame(data={'Id': ['5', '500'], 'Name': ['b', 'c']})
+        new_manifest, replaced_keys, update_count, new_record_count, unchanged_count = partitioned_store.upsert_partitions(
+            s3, 'bucket', self.file_type, manifest, df_stg)
+        touched = set(streaming_merge.get_partition_ids(df_stg, ['Id'], 8))
+        self.assertEqual(len(replaced_keys), len(touched))
+        self.assertEqual(update_count, 1)
+        self.assertEqual(new_record_count, 1)
+        for partition_id in range(8):
+            if partition_id not in touched:
+                self.assertEqual(manifest['partitions'][str(partition_id)], new_manifest['partitions'][str(partition_id)])
+        row_count, file_size = partitioned_store.get_manifest_totals(new_manifest)
+        self.assertEqual(row_count, 101)
+
+    def test_float_stg_keys_find_int_mstr_partition(self):
+        s3 = LocalS3()
+        df_mstr = pandas.DataFrame(data={'Id': list(range(20)), 'Name': ['a'] * 20})
+        manifest = partitioned_store.upsert_partitions(s3, 'bucket', self.file_type,
+                                                       partitioned_store.new_manifest(self.file_type), df_mstr)[0]
+        # a missing key makes pandas read the stg key column as floats
+        df_stg = pandas.DataFrame(data={'Id': [3.0, 5.0, 7.0, 11.0, 13.0, None], 'Name': ['b'] * 6})
+        manifest, replaced_keys, update_count, new_record_count, unchanged_count = partitioned_store.upsert_partitions(
+            s3, 'bucket', self.file_type, manifest, df_stg)
+        self.assertEqual((update_count, new_record_count), (5, 1))
+
+    def test_export_mstr_to_csv(self):
+        s3 = LocalS3()
+        df_mstr = pandas.DataFrame(data={'Id': ['1', '2', '3'], 'Name': ['a', 'b', 'c']})
+        manifest = partitioned_store.upsert_partitions(s3, 'bucket', self.file_type,
+                                                       partitioned_store.new_manifest(self.file_type), df_mstr)[0]
+        partitioned_store.write_manifest(s3, 'bucket', self.file_type, manifest)
+        with mock.patch('s3_functions.get_s3_resource', return_value=s3):
+            self.assertEqual(partitioned_store.export_mstr_to_csv('bucket', self.file_type), 'Success')
+        df_export = pandas.read_csv(io.BytesIO(s3.store[('bucket', 'mstr/randomDataFile.csv')]), dtype=str)
+        self.assertEqual(sorted(df_export['Id']), ['1', '2', '3'])
+
+    def test_merge_exports_mstr_to_csv(self):
+        s3 = LocalS3()
+        s3.store[('bucket', 'user/exportFile_1.csv')] = b'Id,Name\n1,a\n2,b\n'
+        s3.store[('bucket', 'user/exportFile_2.csv')] = b'Id,Name\n2,c\n3,d\n'
+        file_type = FileType('Export CSV', 'user/exportFile*.csv', 'mstr/exportFile.csv', 'Id', ',', '"',
+                             storage_format='parquet', partition_count=4, export_csv=True)
+        with mock.patch('s3_functions.get_s3_resource', return_value=s3), \
+                mock.patch.object(s3_functions, 'processed_ledger', ProcessedLedger(MemoryLedgerStore())):
+            for key in ('user/exportFile_1.csv', 'user/exportFile_2.csv'):
+                self.assertEqual(s3_functions.merge_to_mstr(S3Object('bucket', key, sequencer=key), file_type),
+                                 'Success')
+        df_export = pandas.read_csv(io.BytesIO(s3.store[('bucket', 'mstr/exportFile.csv')]), dtype=str)
+        self.assertEqual(dict(zip(df_export['Id'], df_export['Name'])), {'1': 'a', '2': 'c', '3': 'd'})
+
+    def test_export_csv_needs_parquet_mstr(self):
+        with self.assertRaises(ValueError):
+            FileType('Export CSV', 'user/exportFile*.csv', 'mstr/exportFile.csv', 'Id', ',', '"', export_csv=True)
+
+
+class TestKeyedExecutor(unittest.TestCase):
+    def test_same_key_runs_in_order(self):
+        executor = KeyedExecutor(max_workers=4)
+        results = []
+
+        def task(value):
+            time.sleep(0.01 * (5 - value))
+            results.append(value)
+        for value in range(5):
+            executor.submit('mstr/userEmailFile.csv', task, value)
+        executor.shutdown(wait=True)
+        self.assertEqual(results, [0, 1, 2, 3, 4])
+
+    def test_different_keys_run_in_parallel(self):
+        executor = KeyedExecutor(max_workers=2)
+        barrier = threading.Barrier(2, timeout=5)
+        # each task waits for the other, so this only finishes if they run at the same time
+        first = executor.submit('mstr/userEmailFile.csv', barrier.wait)
+        second = executor.submit('mstr/randomDataFile.csv', barrier.wait)
+        executor.shutdown(wait=True)
+        self.assertIsNone(first.exception())
+        self.assertIsNone(second.exception())
+
+    def test_pending_is_empty_after_shutdown(self):
+        executor = KeyedExecutor(max_workers=2)
+        future = executor.submit('key', lambda: 'Success')
+        executor.shutdown(wait=True)
+        self.assertEqual(future.result(), 'Success')
+        self.assertEqual(executor.pending(), set())
+
+
+class TestDataFrameCache(unittest.TestCase):
+    df = pandas.DataFrame(data={'Id': range(100), 'Name': ['some name'] * 100})
+
+    def test_cache_hit_with_same_etag(self):
+        cache = DataFrameCache()
+        cache.put('s3://bucket/mstr/a.csv', '"etag1"', self.df)
+        result = cache.get('s3://bucket/mstr/a.csv', '"etag1"')
+        self.assertIs(result, self.df)
+        self.assertEqual((cache.hits, cache.misses), (1, 0))
+
+    def test_cache_miss_with_changed_etag(self):
+        cache = DataFrameCache()
+        cache.put('s3://bucket/mstr/a.csv', '"etag1"', self.df)
+        result = cache.get('s3://bucket/mstr/a.csv', '"etag2"')
+        self.assertIsNone(result)
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+
+    def test_cache_evicts_least_recently_used(self):
+        size = int(self.df.memory_usage(index=True, deep=True).sum())
+        cache = DataFrameCache(max_bytes=size * 2)
+        cache.put('a', '1', self.df)
+        cache.put('b', '1', self.df)
+        cache.get('a', '1')
+        cache.put('c', '1', self.df)
+        self.assertIsNone(cache.get('b', '1'))
+        self.assertIsNotNone(cache.get('a', '1'))
+        self.assertIsNotNone(cache.get('c', '1'))
+        self.assertEqual(cache.current_bytes, size * 2)
+
+    def test_cache_skips_oversized_dataframe(self):
+        cache = DataFrameCache(max_bytes=10)
+        cache.put('a', '1', self.df)
+        self.assertIsNone(cache.get('a', '1'))
+        self.assertEqual(cache.current_bytes, 0)
+
+
+class TestDiskDataFrameCache(unittest.TestCase):
+    df = pandas.DataFrame(data={'Id': range(100), 'Name': ['some name'] * 100})
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def test_cache_hit_with_same_etag(self):
+        cache = DiskDataFrameCache(self.directory)
+        cache.put('s3://bucket/mstr/a.csv', '"etag1"', self.df)
+        assert_frame_equal(cache.get('s3://bucket/mstr/a.csv', '"etag1"'), self.df)
+        self.assertIsNone(cache.get('s3://bucket/mstr/a.csv', '"etag2"'))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_new_etag_replaces_the_file(self):
+        cache = DiskDataFrameCache(self.directory)
+        cache.put('a', '1', self.df)
+        cache.put('a', '2', self.df.head(10))
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+        self.assertEqual(len(cache.get('a', '2').index), 10)
+        self.assertEqual(cache.current_bytes, os.path.getsize(cache.get_file_path('a', '2')))
+
+    def test_cache_survives_restart(self):
+        cache = DiskDataFrameCache(self.directory)
+        cache.put('a', '1', self.df)
+        cache.put('b', '1', self.df.head(10))
+        cache = DiskDataFrameCache(self.directory)
+        assert_frame_equal(cache.get('a', '1'), self.df)
+        self.assertEqual(list(cache.entries), ['b', 'a'])
+
+    def test_cache_evicts_least_recently_used(self):
+        cache = DiskDataFrameCache(self.directory)
+        cache.put('a', '1', self.df)
+        size = cache.current_bytes
+        cache.set_max_bytes(size * 2)
+        cache.put('b', '1', self.df)
+        cache.get('a', '1')
+        cache.put('c', '1', self.df)
+        self.assertIsNone(cache.get('b', '1'))
+        self.assertIsNotNone(cache.get('a', '1'))
+        self.assertEqual(cache.current_bytes, size * 2)
+        self.assertEqual(len(os.listdir(self.directory)), 2)
+
+    def test_warm_reads_most_recently_used(self):
+        cache = DiskDataFrameCache(self.directory)
+        for path in ('a', 'b', 'c'):
+            cache.put(path, '1', self.df)
+        memory_cache = DataFrameCache()
+        self.assertEqual(DiskDataFrameCache(self.directory).warm(memory_cache, 2), 2)
+        self.assertEqual(list(memory_cache.entries), ['b', 'c'])
+
+    def test_get_dataframe_maps_cached_master(self):
+        file_type = FileType("Email CSV", "user/userEmailFile*.csv", "mstr/userEmailFile.csv", "Email", ",", "\"")
+        s3 = LocalS3()
+        s3.store[('bucket', 'mstr/userEmailFile.csv')] = b'Email,Name\nb@example.com,x\nc@example.com,c\n'
+        cache = DiskDataFrameCache(self.directory)
+        df = s3_functions.get_dataframe(s3, S3Object('bucket', 'mstr/userEmailFile.csv'), file_type,
+                                        disk_cache=cache)
+        s3_object = S3Object('bucket', 'mstr/userEmailFile.csv')
+        with mock.patch('s3_functions.read_csv') as read_csv:
+            result = s3_functions.get_dataframe(s3, s3_object, file_type, cache=DataFrameCache(),
+                                                disk_cache=DiskDataFrameCache(self.directory))
+        read_csv.assert_not_called()
+        assert_frame_equal(result, df)
+        self.assertIn('disk_cache_read', s3_object.stage_timer.seconds)
+
+
+class TestObjectMetadata(unittest.TestCase):
+    file_type = FileType("Email CSV", "user/userEmailFile*.csv", "mstr/userEmailFile.csv", "Email", ",", "\"")
+
+    def setUp(self):
+        s3_functions.mstr_cache.set_max_bytes(0)
+        self.s3 = LocalS3()
+        self.s3.store[('bucket', 'user/userEmailFile1.csv')] = b'Email,Name\na@example.com,a\nb@example.com,b\n'
+        self.s3.store[('bucket', 'mstr/userEmailFile.csv')] = b'Email,Name\nb@example.com,x\nc@example.com,c\n'
+
+    def tearDown(self):
+        s3_functions.mstr_cache.set_max_bytes(512 * 1024 * 1024)
+
+    def test_get_object_metadata_heads_once(self):
+        s3_object = S3Object('bucket', 'mstr/userEmailFile.csv')
+        s3_functions.get_object_metadata(self.s3, s3_object)
+        result = s3_functions.get_object_metadata(self.s3, s3_object)
+        body = self.s3.store[('bucket', 'mstr/userEmailFile.csv')]
+        self.assertEqual(result, ObjectMetadata(True, len(body), hashlib.md5(body).hexdigest()))
+        self.assertEqual(self.s3.calls['head'], 1)
+
+    def test_get_object_metadata_missing_object(self):
+        result = s3_functions.get_object_metadata(self.s3, S3Object('bucket', 'mstr/missing.csv'))
+        self.assertFalse(result.exists)
+
+    def test_get_object_metadata_from_event(self):
+        s3_object = S3Object('bucket', 'user/userEmailFile1.csv', size=883, etag='c6da448942001149be5b5728cbf7b422')
+        result = s3_functions.get_object_metadata(self.s3, s3_object)
+        self.assertEqual(result, ObjectMetadata(True, 883, 'c6da448942001149be5b5728cbf7b422'))
+        self.assertEqual(self.s3.calls['head'], 0)
+
+    def test_merge_request_counts(self):
+        # the user object metadata comes from the event, the master is checked with a single HEAD and the metadata
+        # of the new master comes from the PUT response
+        user_object = S3Object('bucket', 'user/userEmailFile1.csv', size=44, etag='etag')
+        with mock.patch('s3_functions.get_s3_resource', return_value=self.s3), \
+                mock.patch('s3_functions.read_csv', side_effect=fake_read_csv):
+            result = s3_functions.merge_to_mstr(user_object, self.file_type)
+        self.assertEqual(result, 'Success')
+        self.assertEqual(self.s3.calls, {'head': 1, 'get': 2, 'put': 1})
+        df_mstr = pandas.read_csv(io.BytesIO(self.s3.store[('bucket', 'mstr/userEmailFile.csv')]))
+        self.assertEqual(list(df_mstr['Email']), ['c@example.com', 'a@example.com', 'b@example.com'])
+
+
+class TestFileTypeRegistry(unittest.TestCase):
+    email = FileType("Email CSV", "user/userEmailFile*.csv", "mstr/userEmailFile.csv", "Email", ",", "\"")
+    email_archive = FileType("Email Archive CSV", "user/userEmailFile_archive*.csv", "mstr/userEmailArchive.csv",
+                             "Email", ",", "\"")
+    catch_all = FileType("Any CSV", "*.csv", "mstr/any.csv", "Id", ",", "\"")
+
+    def test_first_listed_pattern_wins(self):
+        registry = FileTypeRegistry(MemoryFileTypeStore([self.email_archive.to_dict(), self.email.to_dict(),
+                                                         self.catch_all.to_dict()]))
+        self.assertEqual(registry.lookup('user/userEmailFile_archive1.csv'), self.email_archive)
+        self.assertEqual(registry.lookup('user/userEmailFile1.csv'), self.email)
+        self.assertEqual(registry.lookup('user/other.csv'), self.catch_all)
+        self.assertIsNone(registry.lookup('user/other.txt'))
+
+    def test_lookup_with_many_file_types(self):
+        items = [FileType('File {}'.format(i), 'user/file{:04d}_*.csv'.format(i), 'mstr/file{}.csv'.format(i), 'Id',
+                          ',', '\"').to_dict() for i in range(500)]
+        registry = FileTypeRegistry(MemoryFileTypeStore(items))
+        self.assertEqual(len(registry), 500)
+        self.assertEqual(registry.lookup('user/file0321_2020.csv').file_process_name, 'File 321')
+        self.assertIsNone(registry.lookup('user/file9999_2020.csv'))
+
+    def test_reload_when_store_changes(self):
+        store = MemoryFileTypeStore([self.email.to_dict()])
+        registry = FileTypeRegistry(store, reload_interval=0)
+        self.assertIsNone(registry.lookup('user/other.csv'))
+        store.put(self.catch_all.to_dict())
+        self.assertEqual(registry.lookup('user/other.csv'), self.catch_all)
+
+    def test_invalid_file_type_left_out(self):
+        item = dict(self.catch_all.to_dict(), update_mode='merge')
+        registry = FileTypeRegistry(MemoryFileTypeStore([self.email.to_dict(), item]))
+        self.assertEqual(registry.lookup('user/userEmailFile1.csv'), self.email)
+        self.assertIsNone(registry.lookup('user/other.csv'))
+
+    def test_add_persists_to_local_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'file_types.json')
+            registry = FileTypeRegistry(LocalFileTypeStore(path))
+            registry.add(self.email)
+            result = FileTypeRegistry(LocalFileTypeStore(path)).lookup('user/userEmailFile1.csv')
+        self.assertEqual(result, self.email)
+
+    def test_lookup_file_persists_new_file_type(self):
+        s3_functions.lookup_file('user/registry_test.csv')
+        result = s3_functions.file_type_registry.lookup('user/registry_test.csv')
+        self.assertEqual(result.master_file_s3_key, 'mstr/registry_test.csv')
+
+
+def make_message(message_id, key, event_time, sequencer):
+    return LocalMessage(message_id, get_s3_event_body('bucket', key, event_time, sequencer))
+
+
+class TestTransfer(unittest.TestCase):
+    def setUp(self):
+        self.s3 = LocalS3()
+        self.df = pandas.DataFrame({'Id': range(100), 'Value': ['value {}'.format(i) for i in range(100)]})
+        self.body = self.df.to_csv(index=False).encode('utf-8')
+        self.s3.store[('bucket', 'mstr/data.csv')] = self.body
+        patcher = mock.patch.multiple('transfer', part_size=256, max_concurrency=4)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_ranged_download(self):
+        s3_object = S3Object('bucket', 'mstr/data.csv')
+        reader = transfer.download_object(self.s3, s3_object)
+        self.assertEqual(reader.read(), self.body)
+        # one HEAD for the size, then a GET per part
+        self.assertEqual(self.s3.calls['head'], 1)
+        self.assertEqual(self.s3.calls['get'], -(-len(self.body) // 256))
+
+    def test_single_get_download_checks_etag(self):
+        s3_object = S3Object('bucket', 'mstr/data.csv', size=len(self.body), etag='stale')
+        with mock.patch('transfer.part_size', len(self.body)):
+            with self.assertRaises(ClientError):
+                transfer.download_object(self.s3, s3_object)
+            s3_object = S3Object('bucket', 'mstr/data.csv')
+            self.assertEqual(transfer.download_object(self.s3, s3_object).read(), self.body)
+        self.assertEqual(self.s3.calls['get'], 2)
+
+    def test_download_current_version(self):
+        # the ETag of a user object's event is stale once the key is put again
+        s3_object = S3Object('bucket', 'mstr/data.csv', size=10, etag='stale')
+        self.assertEqual(transfer.download_object(self.s3, s3_object, current=True).read(), self.body)
+        self.assertEqual(s3_object.metadata.size, len(self.body))
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'data.csv')
+            transfer.download_file(self.s3, S3Object('bucket', 'mstr/data.csv', size=10, etag='stale'), path,
+                                   current=True)
+            with open(path, 'rb') as downloaded:
+                self.assertEqual(downloaded.read(), self.body)
+
+    def test_merge_user_object_put_again(self):
+        self.s3.store[('bucket', 'user/data_1.csv')] = b'Id,Value\n1,new\n'
+        with mock.patch('s3_functions.get_s3_resource', return_value=self.s3), \
+                mock.patch.object(s3_functions, 'mstr_cache', DataFrameCache()), \
+                mock.patch.object(s3_functions, 'processed_ledger', ProcessedLedger(MemoryLedgerStore())):
+            for merge_mode in ('memory', 'streaming'):
+                file_type = FileType('Data', 'user/data*.csv', 'mstr/data.csv', 'Id', ',', '"', merge_mode=merge_mode)
+                user_object = S3Object('bucket', 'user/data_1.csv', sequencer=merge_mode, size=10, etag='stale')
+                self.assertEqual(s3_functions.merge_to_mstr(user_object, file_type), 'Success')
+                self.assertEqual(user_object.processing_data.stg_file_size, len(b'Id,Value\n1,new\n'))
+
+    def test_large_download_buffer_not_kept(self):
+        transfer.thread_buffers.buffer = None
+        with mock.patch('transfer.max_buffer_size', 512):
+            self.assertEqual(transfer.download_object(self.s3, S3Object('bucket', 'mstr/data.csv')).read(), self.body)
+            self.assertIsNone(transfer.thread_buffers.buffer)
+            self.assertEqual(len(transfer.get_buffer(100)), 100)
+
+    def test_read_csv_from_download_buffer(self):
+        file_type = FileType('Data', 'user/data*.csv', 'mstr/data.csv', 'Id', ',', '"')
+        df = s3_functions.read_csv(self.s3, S3Object('bucket', 'mstr/data.csv'), file_type)
+        assert_frame_equal(df, self.df)
+
+    def test_multipart_upload(self):
+        s3_object = S3Object('bucket', 'mstr/new.csv')
+        metadata = s3_functions.write_csv(self.s3, s3_object, self.df)
+        self.assertEqual(self.s3.store[('bucket', 'mstr/new.csv')], self.body)
+        self.assertEqual(self.s3.calls['put'], -(-len(self.body) // 256))
+        self.assertEqual(metadata.size, len(self.body))
+        self.assertTrue(metadata.etag.endswith('-{}'.format(self.s3.calls['put'])))
+
+    def test_small_upload_single_put(self):
+        s3_object = S3Object('bucket', 'mstr/new.csv')
+        s3_functions.write_csv(self.s3, s3_object, self.df.head(2))
+        self.assertEqual(self.s3.calls['put'], 1)
+        self.assertEqual(self.s3.uploads, {})
+
+    def test_failed_upload_is_aborted(self):
+        s3_object = S3Object('bucket', 'mstr/data.csv')
+        with mock.patch.object(LocalS3Client, 'upload_part', side_effect=ClientError({'Error': {'Code': '500'}},
+                                                                                      'UploadPart')):
+            with self.assertRaises(ClientError):
+                s3_functions.write_csv(self.s3, s3_object, self.df)
+        # the upload is discarded and the old object is untouched
+        self.assertEqual(self.s3.uploads, {})
+        self.assertEqual(self.s3.store[('bucket', 'mstr/data.csv')], self.body)
+
+
+class TestPartialUpdate(unittest.TestCase):
+    df_mstr = pandas.DataFrame(data={'Id': [1, 2, 3], 'Name': ['a', 'b', 'c'], 'Score': [10, 20, 30]})
+    df_stg = pandas.DataFrame(data={'Id': [3, 4, 3], 'Name': ['x', 'y', 'z']})
+
+    def test_partial_upsert_keeps_other_columns(self):
+        result = upsert_engine.partial_upsert(self.df_mstr, self.df_stg, ['Id'])
+        self.assertEqual(result.update_count, 1)
+        self.assertEqual(result.new_record_count, 1)
+        self.assertEqual(list(result.df_mstr_new['Name']), ['a', 'b', 'z', 'y'])
+        self.assertEqual(list(result.df_mstr_new['Score'][:3]), [10, 20, 30])
+        self.assertTrue(pandas.isna(result.df_mstr_new['Score'][3]))
+        self.assertEqual(list(result.mstr_row_positions), [0, 1, 2])
+
+    def test_partial_upsert_adds_new_columns(self):
+        df_stg = pandas.DataFrame(data={'Id': [2], 'Flag': ['on']})
+        result = upsert_engine.partial_upsert(self.df_mstr, df_stg, ['Id'])
+        self.assertEqual(list(result.df_mstr_new.columns), ['Id', 'Name', 'Score', 'Flag'])
+        self.assertEqual(list(result.df_mstr_new['Name']), ['a', 'b', 'c'])
+        self.assertEqual(result.df_mstr_new['Flag'].isna().tolist(), [True, False, True])
+
+    def test_partial_upsert_unchanged(self):
+        df_stg = pandas.DataFrame(data={'Id': [1, 2], 'Score': [10, 20]})
+        result = upsert_engine.partial_upsert(self.df_mstr, df_stg, ['Id'], change_set=True)
+        self.assertTrue(result.mstr_unchanged)
+        self.assertEqual(list(result.df_change_set['change']), ['unchanged', 'unchanged'])
+
+    def test_partial_upsert_keeps_last_repeated_mstr_key(self):
+        df_mstr = pandas.DataFrame(data={'Id': [1, 1, 2], 'Name': ['a', 'b', 'c'], 'Score': [1, 2, 3]})
+        result = upsert_engine.partial_upsert(df_mstr, pandas.DataFrame(data={'Id': [1], 'Name': ['x']}), ['Id'])
+        self.assertEqual(list(result.df_mstr_new['Name']), ['x', 'c'])
+        self.assertEqual(list(result.df_mstr_new['Score']), [2, 3])
+
+    def test_upsert_file_type_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            FileType('Partial CSV', 'user/partial*.csv', 'mstr/partial.csv', 'Id', ',', '"', update_mode='merge')
+        file_type = FileType('Partial CSV', 'user/partial*.csv', 'mstr/partial.csv', 'Id', ',', '"')
+        file_type.update_mode = 'merge'
+        with self.assertRaises(ValueError):
+            upsert_engine.upsert_file_type(self.df_mstr, self.df_stg, file_type)
+
+    def test_partitions_keep_columns_the_stg_lacks(self):
+        file_type = FileType('Partial CSV', 'user/partial*.csv', 'mstr/partial.csv', 'Id', ',', '"',
+                             storage_format='parquet', partition_count=4, update_mode='partial')
+        s3 = LocalS3()
+        df_mstr = pandas.DataFrame(data={'Id': [str(i) for i in range(20)], 'Name': ['a'] * 20,
+                                         'Score': list(range(20))})
+        manifest = partitioned_store.upsert_partitions(s3, 'bucket', file_type,
+                                                       partitioned_store.new_manifest(file_type), df_mstr)[0]
+        df_stg = pandas.DataFrame(data={'Id': ['5', '50'], 'Name': ['b', 'c']})
+        manifest, replaced_keys, update_count, new_record_count, unchanged_count = \
+            partitioned_store.upsert_partitions(s3, 'bucket', file_type, manifest, df_stg)
+        self.assertEqual((update_count, new_record_count), (1, 1))
+        df_new = pandas.concat([partitioned_store.read_partition(s3, 'bucket', manifest, partition_id)
+                                for partition_id in range(4)]).set_index('Id')
+        self.assertEqual(df_new.loc['5', 'Name'], 'b')
+        self.assertEqual(df_new.loc['5', 'Score'], 5)
+        self.assertEqual(df_new.loc['6', 'Score'], 6)
+        self.assertTrue(pandas.isna(df_new.loc['50', 'Score']))
+        # setting the values a partition already has doesn't rewrite it
+        result = partitioned_store.upsert_partitions(s3, 'bucket', file_type, manifest,
+                                                     pandas.DataFrame(data={'Id': ['5'], 'Name': ['b']}))
+        self.assertEqual(result[1], [])
+
+
+class TestDeltaLog(unittest.TestCase):
+    def setUp(self):
+        self.s3 = LocalS3()
+        self.file_type = FileType('Delta CSV', 'user/deltaFile*.csv', 'mstr/deltaFile.csv', 'Id', ',', '"',
+                                  merge_mode='delta', compaction_row_limit=100)
+        self.s3.store[('bucket', 'mstr/deltaFile.csv')] = b'Id,Value\n1,a\n2,b\n'
+        self.s3.store[('bucket', 'user/deltaFile1.csv')] = b'Id,Value\n2,c\n3,d\n3,e\n'
+        self.s3.store[('bucket', 'user/deltaFile2.csv')] = b'Id,Value\n3,f\n4,g\n'
+        for patcher in [mock.patch('s3_functions.get_s3_resource', return_value=self.s3),
+                        mock.patch('s3_functions.read_csv', side_effect=fake_read_csv)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def merge(self, *keys):
+        return s3_functions.merge_batch_to_mstr([S3Object('bucket', key) for key in keys], self.file_type)
+
+    def test_deltas_leave_the_base_untouched(self):
+        self.assertEqual(self.merge('user/deltaFile1.csv', 'user/deltaFile2.csv'), ['Success', 'Success'])
+        self.assertEqual(self.s3.store[('bucket', 'mstr/deltaFile.csv')], b'Id,Value\n1,a\n2,b\n')
+        manifest = delta_log.read_manifest(self.s3, 'bucket', self.file_type)
+        self.assertEqual([delta['key'] for delta in manifest['deltas']],
+                         ['mstr/deltaFile/_delta/0000000001.parquet', 'mstr/deltaFile/_delta/0000000002.parquet'])
+        # the deltas hold the deduped stg rows
+        self.assertEqual([delta['row_count'] for delta in manifest['deltas']], [2, 2])
+
+    def test_read_mstr_last_writer_wins(self):
+        self.merge('user/deltaFile1.csv', 'user/deltaFile2.csv')
+        df_mstr = delta_log.read_mstr('bucket', self.file_type)
+        self.assertEqual(dict(zip(df_mstr['Id'], df_mstr['Value'])), {1: 'a', 2: 'c', 3: 'f', 4: 'g'})
+
+    def test_read_mstr_partial_update(self):
+        self.file_type.update_mode = 'partial'
+        self.s3.store[('bucket', 'mstr/deltaFile.csv')] = b'Id,Value,Score\n1,a,1\n2,b,2\n'
+        self.merge('user/deltaFile1.csv', 'user/deltaFile2.csv')
+        df_mstr = delta_log.read_mstr('bucket', self.file_type)
+        self.assertEqual(dict(zip(df_mstr['Id'], df_mstr['Value'])), {1: 'a', 2: 'c', 3: 'f', 4: 'g'})
+        self.assertEqual(list(df_mstr['Score'][:2]), [1, 2])
+
+    def test_compact(self):
+        self.merge('user/deltaFile1.csv', 'user/deltaFile2.csv')
+        df_merged = delta_log.read_mstr('bucket', self.file_type)
+        self.assertEqual(delta_log.compact('bucket', self.file_type), 'Success')
+        manifest = delta_log.read_manifest(self.s3, 'bucket', self.file_type)
+        self.assertEqual(manifest['deltas'], [])
+        self.assertEqual(manifest['compacted_sequence'], 2)
+        self.assertNotIn(('bucket', 'mstr/deltaFile/_delta/0000000001.parquet'), self.s3.store)
+        df_base = pandas.read_csv(io.BytesIO(self.s3.store[('bucket', 'mstr/deltaFile.csv')]))
+        assert_frame_equal(df_base, df_merged)
+        # new deltas continue the sequence
+        self.merge('user/deltaFile1.csv')
+        manifest = delta_log.read_manifest(self.s3, 'bucket', self.file_type)
+        self.assertEqual([delta['sequence'] for delta in manifest['deltas']], [3])
+
+    def test_compact_unchanged_deltas_skip_base_write(self):
+        self.s3.store[('bucket', 'user/deltaFileSame.csv')] = b'Id,Value\n2,b\n'
+        self.merge('user/deltaFileSame.csv')
+        puts = self.s3.calls['put']
+        self.assertEqual(delta_log.compact('bucket', self.file_type), 'Success')
+        self.assertEqual(self.s3.store[('bucket', 'mstr/deltaFile.csv')], b'Id,Value\n1,a\n2,b\n')
+        self.assertEqual(delta_log.read_manifest(self.s3, 'bucket', self.file_type)['deltas'], [])
+        # only the manifest is written
+        self.assertEqual(self.s3.calls['put'], puts + 1)
+
+    def test_redelivered_event_skipped(self):
+        with mock.patch.object(s3_functions, 'processed_ledger', ProcessedLedger(MemoryLedgerStore())):
+            user_objects = [S3Object('bucket', 'user/deltaFile1.csv', sequencer='01', size=1, etag='etag')
+                            for _ in range(2)]
+            self.assertEqual(s3_functions.merge_batch_to_mstr(user_objects[:1], self.file_type), ['Success'])
+            self.assertEqual(s3_functions.merge_batch_to_mstr(user_objects[1:], self.file_type),
+                             [s3_functions.ALREADY_PROCESSED])
+        self.assertEqual(len(delta_log.read_manifest(self.s3, 'bucket', self.file_type)['deltas']), 1)
+
+    def test_change_set_rejected(self):
+        with self.assertRaises(ValueError):
+            FileType('Delta CSV', 'user/deltaFile*.csv', 'mstr/deltaFile.csv', 'Id', ',', '"', merge_mode='delta',
+                     write_change_set=True)
+
+    def test_compaction_scheduled_at_row_limit(self):
+        self.file_type.compaction_row_limit = 4
+        self.merge('user/deltaFile1.csv')
+        self.assertFalse(delta_log.compaction_executor.pending())
+        self.merge('user/deltaFile2.csv')
+        for future in delta_log.compaction_executor.pending():
+            self.assertEqual(future.result(), 'Success')
+        self.assertEqual(delta_log.read_manifest(self.s3, 'bucket', self.file_type)['deltas'], [])
+
+    def test_needs_compaction_by_age(self):
+        manifest = dict(delta_log.new_manifest(), deltas=[{'row_count': 1, 'created': 1000.0}])
+        self.assertFalse(delta_log.needs_compaction(manifest, self.file_type, now=1000.0 + 59 * 60))
+        self.assertTrue(delta_log.needs_compaction(manifest, self.file_type, now=1000.0 + 60 * 60))
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        s3_functions.mstr_cache.set_max_bytes(0)
+        self.s3 = LocalS3()
+        self.s3.store[('bucket', 'mstr/userEmailFile.csv')] = b'Email,Name\na@example.com,a\n'
+        self.s3.store[('bucket', 'user/userEmailFile1.csv')] = b'Email,Name\na@example.com,A\nb@example.com,b\n'
+        self.s3.store[('bucket', 'user/userEmailFile2.csv')] = b'Email,Name\nc@example.com,c\n'
+        self.exporter = types.SimpleNamespace(records=[])
+        self.exporter.export = self.exporter.records.append
+        patcher = mock.patch('s3_functions.get_s3_resource', return_value=self.s3)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('metrics.exporters', [self.exporter])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        s3_functions.mstr_cache.set_max_bytes(512 * 1024 * 1024)
+
+    def test_stage_timings_emitted(self):
+        messages = [make_message('1', 'user/userEmailFile1.csv', '2020-02-22T21:28:03.000Z', '01'),
+                    make_message('2', 'user/userEmailFile2.csv', '2020-02-22T21:28:04.000Z', '02')]
+        key, file_type, entries = message_functions.group_messages(messages)[0]
+        app.process_messages(entries, file_type)
+        first, second = self.exporter.records
+        self.assertEqual([first['result'], second['result']], ['Success', 'Success'])
+        self.assertEqual(set(first['stage_seconds']),
+                         {'message_parse', 'file_type_lookup', 'stg_download', 'stg_parse', 'mstr_download',
+                          'mstr_parse', 'dedupe', 'join', 'compare', 'serialize', 'upload', 'delete'})
+        # the master is read and written once for the batch and counted on the first file
+        self.assertNotIn('mstr_download', second['stage_seconds'])
+        self.assertEqual(first['bytes_downloaded'], len(b'Email,Name\na@example.com,a\n') +
+                         len(self.s3.store[('bucket', 'user/userEmailFile1.csv')]))
+        self.assertEqual(first['bytes_uploaded'], len(self.s3.store[('bucket', 'mstr/userEmailFile.csv')]))
+        self.assertEqual(second['bytes_uploaded'], 0)
+        self.assertGreater(first['peak_memory_mb'], 0)
+        json.dumps(first)
+
+    def test_failed_file_emitted(self):
+        messages = [make_message('1', 'user/userEmailFileMissing.csv', '2020-02-22T21:28:03.000Z', '01')]
+        key, file_type, entries = message_functions.group_messages(messages)[0]
+        app.process_messages(entries, file_type)
+        record, = self.exporter.records
+        self.assertEqual(record['result'], 'User file not found')
+        # without a dead letter queue the message is left on the queue
+        self.assertNotIn('delete', record['stage_seconds'])
+        self.assertFalse(messages[0].deleted)
+
+    def test_json_lines_exporter(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'metrics.jsonl')
+            exporter = JsonLinesExporter(path)
+            exporter.export({'stg_file_name': 'a.csv', 'result': 'Success'})
+            exporter.export({'stg_file_name': 'b.csv', 'result': 'Error'})
+            with open(path) as metrics_file:
+                self.assertEqual([json.loads(line)['result'] for line in metrics_file], ['Success', 'Error'])
+
+    def test_emf_document(self):
+        record = dict(FileProcessingData('a.csv', 'mstr.csv', stg_row_count=3, bytes_uploaded=10,
+                                         stage_seconds={'upload': 0.5}).to_dict(), result='Success')
+        document = EmfExporter('unused').get_document(record)
+        self.assertEqual(document['upload_seconds'], 0.5)
+        metric_units = {metric['Name']: metric['Unit'] for metric in document['_aws']['CloudWatchMetrics'][0]['Metrics']}
+        self.assertEqual(metric_units['upload_seconds'], 'Seconds')
+        self.assertEqual(metric_units['bytes_uploaded'], 'Bytes')
+        self.assertEqual(metric_units['stg_row_count'], 'Count')
+        self.assertEqual(document['_aws']['CloudWatchMetrics'][0]['Dimensions'], [['MstrFileName', 'Result']])
+
+    def test_prometheus_render(self):
+        exporter = PrometheusExporter()
+        for result in ['Success', 'Success', 'Error']:
+            exporter.export(dict(FileProcessingData('a.csv', 'mstr.csv', stg_row_count=3, bytes_downloaded=10,
+                                                    stage_seconds={'upload': 0.5}).to_dict(), result=result))
+        text = exporter.render()
+        self.assertIn('s3_data_merge_files_total{mstr_file="mstr.csv",result="Success"} 2', text)
+        self.assertIn('s3_data_merge_stage_seconds_total{stage="upload"} 1.5', text)
+        self.assertIn('s3_data_merge_bytes_downloaded_total 30', text)
+
+
+class TestSchemaFunctions(unittest.TestCase):
+    body = b'Id,Name,Count,Score,Note\n007,a,1,1.5,x\n2,"b,c",,2.5,y\n'
+
+    def parse(self, file_type, body=None):
+        return schema_functions.parse_csv(BufferReader(memoryview(bytearray(body or self.body))), file_type)
+
+    def test_typed_parse(self):
+        file_type = FileType('Typed', 'user/typed*.csv', 'mstr/typed.csv', 'Id', ',', '"',
+                             column_schema={'dtypes': {'Id': 'str', 'Count': 'Int64', 'Score': 'float64'},
+                                            'categorical_columns': ['Name']})
+        df = self.parse(file_type)
+        self.assertEqual(list(df['Id']), ['007', '2'])
+        self.assertEqual(str(df['Count'].dtype), 'Int64')
+        self.assertTrue(df['Count'].isna()[1])
+        self.assertEqual(str(df['Name'].dtype), 'category')
+        # columns missing from the schema keep their text
+        self.assertEqual(list(df['Note']), ['x', 'y'])
+
+    def test_projection_keeps_key(self):
+        file_type = FileType('Typed', 'user/typed*.csv', 'mstr/typed.csv', 'Id', ',', '"',
+                             column_schema={'dtypes': {'Id': 'str'}, 'columns': ['Score']})
+        self.assertEqual(sorted(self.parse(file_type).columns), ['Id', 'Score'])
+
+    def test_projection_keeps_mstr_columns(self):
+        s3 = LocalS3()
+        s3.store[('bucket', 'mstr/typed.csv')] = b'Id,Name,Secret\n1,a,x\n2,b,y\n'
+        s3.store[('bucket', 'user/typed_1.csv')] = b'Id,Name,Secret\n3,c,z\n'
+        file_type = FileType('Typed', 'user/typed*.csv', 'mstr/typed.csv', 'Id', ',', '"',
+                             column_schema={'dtypes': {'Id': 'str'}, 'columns': ['Name']})
+        with mock.patch('s3_functions.get_s3_resource', return_value=s3), \
+                mock.patch.object(s3_functions, 'mstr_cache', DataFrameCache()):
+            self.assertEqual(s3_functions.merge_to_mstr(S3Object('bucket', 'user/typed_1.csv'), file_type),
+                             'Success')
+        self.assertEqual(s3.store[('bucket', 'mstr/typed.csv')], b'Id,Name,Secret\n1,a,x\n2,b,y\n3,c,\n')
+
+    def test_file_not_fitting_schema(self):
+        file_type = FileType('Typed', 'user/typed*.csv', 'mstr/typed.csv', 'Id', ',', '"',
+                             column_schema={'dtypes': {'Id': 'str', 'Count': 'Int64'}})
+        df = self.parse(file_type, b'Id,Count\n007,1\n2,many\n')
+        self.assertEqual(list(df['Id']), ['007', '2'])
+        self.assertEqual(list(df['Count']), ['1', 'many'])
+
+    def test_inferred_schema(self):
+        file_type = FileType('Typed', 'user/typed*.csv', 'mstr/typed.csv', 'Id', ',', '"')
+        schema = schema_functions.get_inferred_schema(self.parse(file_type), file_type)
+        self.assertEqual(schema, {'dtypes': {'Id': 'str', 'Name': 'str', 'Count': 'float64', 'Score': 'float64',
+                                             'Note': 'str'}})
+
+    def test_created_file_type_infers_schema_once(self):
+        s3 = LocalS3()
+        s3.store[('bucket', 'user/schemaTest.csv')] = b'Id,Count\n007,1\n8,2\n'
+        file_type = s3_functions.lookup_file('user/schemaTest.csv')
+        self.assertTrue(file_type.infer_schema)
+        df = s3_functions.read_csv(s3, S3Object('bucket', 'user/schemaTest.csv'), file_type)
+        self.assertEqual(list(df['Id']), ['007', '8'])
+        self.assertEqual(file_type.column_schema, {'dtypes': {'Id': 'str', 'Count': 'Int64'}})
+        stored = [item for item in s3_functions.file_type_registry.store.load()
+                  if item['incoming_file_pattern'] == 'user/schemaTest.csv']
+        self.assertEqual(stored[0]['column_schema'], file_type.column_schema)
+
+
+class TestCompression(unittest.TestCase):
+    def setUp(self):
+        self.s3 = LocalS3()
+        self.df = pandas.DataFrame({'Id': [str(i) for i in range(200)],
+                                    'Value': ['value {}'.format(i) for i in range(200)]})
+        self.body = self.df.to_csv(index=False).encode('utf-8')
+        self.file_type = FileType('Data', 'user/data*.csv', 'mstr/data.csv', 'Id', ',', '"',
+                                  column_schema={'dtypes': {'Id': 'str', 'Value': 'str'}})
+        patcher = mock.patch.multiple('transfer', part_size=256, max_concurrency=4)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def compress(self, codec):
+        buffer = io.BytesIO()
+        stream = compression_functions.open_compressed(buffer, codec)
+        stream.write(self.body)
+        stream.close()
+        return buffer.getvalue()
+
+    def test_read_compressed_user_files(self):
+        for codec, extension in (('gzip', '.gz'), ('zstd', '.zst'), ('bz2', '.bz2')):
+            key = 'user/data.csv' + extension
+            self.s3.store[('bucket', key)] = self.compress(codec)
+            s3_object = S3Object('bucket', key)
+            df = s3_functions.read_csv(self.s3, s3_object, self.file_type)
+            assert_frame_equal(df, self.df)
+            self.assertEqual(s3_object.uncompressed_size, len(self.body))
+
+    def test_codec_detected_from_magic_bytes(self):
+        self.s3.store[('bucket', 'user/data.csv')] = self.compress('gzip')
+        reader = transfer.download_object(self.s3, S3Object('bucket', 'user/data.csv'))
+        self.assertEqual(compression_functions.detect_codec(reader, 'user/data.csv'), 'gzip')
+        self.assertEqual(reader.tell(), 0)
+        self.assertEqual(compression_functions.detect_codec(io.BytesIO(self.body), 'user/data.csv'), None)
+
+    def test_lookup_compressed_key(self):
+        self.assertEqual(compression_functions.strip_extension('user/userEmailFile_1.csv.gz'),
+                         'user/userEmailFile_1.csv')
+        self.assertEqual(s3_functions.lookup_file('user/userEmailFile_1.csv.gz'),
+                         s3_functions.lookup_file('user/userEmailFile_1.csv'))
+
+    def test_compressed_mstr_write(self):
+        for codec in ('gzip', 'zstd', 'bz2'):
+            s3_object = S3Object('bucket', 'mstr/data.csv')
+            metadata = s3_functions.write_csv(self.s3, s3_object, self.df, codec, 1)
+            stored = self.s3.store[('bucket', 'mstr/data.csv')]
+            self.assertEqual(compression_functions.detect_codec(io.BytesIO(stored)), codec)
+            self.assertEqual(metadata.size, len(stored))
+            self.assertLess(metadata.size, len(self.body))
+            self.assertEqual(s3_object.uncompressed_size, len(self.body))
+            s3_object = S3Object('bucket', 'mstr/data.csv')
+            assert_frame_equal(s3_functions.read_csv(self.s3, s3_object, self.file_type), self.df)
+
+    def test_processing_data_sizes(self):
+        file_type = FileType('Data', 'user/data*.csv', 'mstr/data.csv', 'Id', ',', '"', mstr_compression='gzip')
+        self.s3.store[('bucket', 'user/data.csv.gz')] = self.compress('gzip')
+        user_object = S3Object('bucket', 'user/data.csv.gz')
+        with mock.patch('s3_functions.get_s3_resource', return_value=self.s3), \
+                mock.patch.object(s3_functions, 'mstr_cache', DataFrameCache()):
+            self.assertEqual(s3_functions.merge_to_mstr(user_object, file_type), 'Success')
+        data = user_object.processing_data
+        self.assertEqual(data.stg_uncompressed_size, len(self.body))
+        self.assertLess(data.stg_file_size, len(self.body))
+        self.assertEqual(data.mstr_new_file_size, len(self.s3.store[('bucket', 'mstr/data.csv')]))
+        self.assertEqual(data.mstr_new_uncompressed_size, len(self.body))
+
+
+class TestProcessedLedger(unittest.TestCase):
+    def setUp(self):
+        self.s3 = LocalS3()
+        self.mstr_body = b'Email,Name\na@example.com,a\nb@example.com,b\n'
+        self.s3.store[('bucket', 'mstr/userEmailFile.csv')] = self.mstr_body
+        self.s3.store[('bucket', 'user/userEmailFile1.csv')] = b'Email,Name\nc@example.com,c\n'
+        self.s3.store[('bucket', 'user/userEmailFileSame.csv')] = b'Email,Name\nb@example.com,b\nb@example.com,b\n'
+        patcher = mock.patch('s3_functions.get_s3_resource', return_value=self.s3)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(s3_functions, 'processed_ledger', ProcessedLedger(MemoryLedgerStore()))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(s3_functions, 'mstr_cache', DataFrameCache())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def process(self, key, sequencer):
+        key, file_type, entries = message_functions.group_messages([make_message(sequencer, key, '2020-02-22T21:28:03.000Z',
+                                                                  sequencer)])[0]
+        return app.process_messages(entries, file_type)[0], entries[0][1]
+
+    def test_redelivered_event_skipped(self):
+        self.assertEqual(self.process('user/userEmailFile1.csv', '01')[0], 'Success')
+        puts = self.s3.calls['put']
+        result, user_object = self.process('user/userEmailFile1.csv', '01')
+        self.assertEqual(result, s3_functions.ALREADY_PROCESSED)
+        self.assertEqual(user_object.processing_data.duplicate_event, 1)
+        self.assertEqual(self.s3.calls['put'], puts)
+        # uploading the same key again is a new event
+        self.assertEqual(self.process('user/userEmailFile1.csv', '02')[0], 'Success')
+
+    def test_unchanged_rows_skip_mstr_write(self):
+        result, user_object = self.process('user/userEmailFileSame.csv', '01')
+        self.assertEqual(result, 'Success')
+        self.assertEqual(self.s3.calls['put'], 0)
+        self.assertEqual(self.s3.store[('bucket', 'mstr/userEmailFile.csv')], self.mstr_body)
+        self.assertEqual(user_object.processing_data.mstr_write_skipped, 1)
+        self.assertEqual(user_object.processing_data.unchanged_count, 1)
+
+    def test_unchanged_count(self):
+        df_mstr = pandas.DataFrame({'Id': ['1', '2'], 'Name': ['a', 'b']})
+        result = upsert_engine.upsert(df_mstr, pandas.DataFrame({'Name': ['b'], 'Id': ['2']}), ['Id'])
+        self.assertEqual(result.unchanged_count, 1)
+        self.assertTrue(result.mstr_unchanged)
+        result = upsert_engine.upsert(df_mstr, pandas.DataFrame({'Id': ['2'], 'Name': ['c']}), ['Id'])
+        self.assertEqual(result.unchanged_count, 0)
+        self.assertFalse(result.mstr_unchanged)
+
+    def test_local_ledger_store(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'ledger.jsonl')
+            s3_object = S3Object('bucket', 'user/a.csv', sequencer='01', size=1, etag='"abc"')
+            ProcessedLedger(LocalLedgerStore(path)).record(s3_object, 'Success')
+            ledger = ProcessedLedger(LocalLedgerStore(path))
+            self.assertTrue(ledger.contains(s3_object))
+            self.assertFalse(ledger.contains(S3Object('bucket', 'user/a.csv', sequencer='02', size=1, etag='abc')))
+            self.assertFalse(ledger.contains(S3Object('bucket', 'user/a.csv', size=1, etag='abc')))
+
+
+class TestChangeSet(unittest.TestCase):
+    def test_change_set(self):
+        df_mstr = pandas.DataFrame({'Id': ['1', '2', '3'], 'Name': ['a', 'b', 'c'], 'Count': [1, 2, 3]})
+        df_stg = pandas.DataFrame({'Id': ['2', '3', '4'], 'Name': ['b', 'C', 'd'], 'Count': [2, 3, 4]})
+        df_change_set = upsert_engine.upsert(df_mstr, df_stg, ['Id'], change_set=True).df_change_set
+        self.assertEqual(list(df_change_set.columns), ['Id', 'change', 'column', 'before', 'after'])
+        rows = {(row.Id, row.change): row for row in df_change_set.itertuples()}
+        self.assertEqual(set(rows), {('4', 'insert'), ('3', 'update'), ('2', 'unchanged')})
+        self.assertEqual((rows[('3', 'update')].column, rows[('3', 'update')].before, rows[('3', 'update')].after),
+                         ('Name', 'c', 'C'))
+
+    def test_change_set_written_after_mstr(self):
+        s3 = LocalS3()
+        s3.store[('bucket', 'mstr/changes.csv')] = b'Id,Name\n1,a\n2,b\n'
+        s3.store[('bucket', 'user/changes1.csv')] = b'Id,Name\n2,B\n3,c\n'
+        file_type = FileType('Changes', 'user/changes*.csv', 'mstr/changes.csv', 'Id', ',', '"',
+                             write_change_set=True)
+        user_object = S3Object('bucket', 'user/changes1.csv', sequencer='01')
+        with mock.patch('s3_functions.get_s3_resource', return_value=s3), \
+                mock.patch.object(s3_functions, 'mstr_cache', DataFrameCache()):
+            self.assertEqual(s3_functions.merge_to_mstr(user_object, file_type), 'Success')
+        key = user_object.processing_data.change_set_key
+        self.assertEqual(key, 'mstr/changes/_changes/changes1-01.parquet')
+        df_change_set = pandas.read_parquet(io.BytesIO(s3.store[('bucket', key)]))
+        self.assertEqual(sorted(df_change_set['change']), ['insert', 'update'])
+
+    def test_failed_change_set_keeps_merge(self):
+        s3 = LocalS3()
+        put_object = LocalS3Client.put_object
+
+        def fail_change_sets(client, Bucket, Key, Body, **conditions):
+            if '/_changes/' in Key:
+                raise ClientError({'Error': {'Code': '503'}}, 'PutObject')
+            return put_object(client, Bucket, Key, Body, **conditions)
+        ledger = ProcessedLedger(MemoryLedgerStore())
+        with mock.patch('s3_functions.get_s3_resource', return_value=s3), \
+                mock.patch.object(s3_functions, 'mstr_cache', DataFrameCache()), \
+                mock.patch.object(s3_functions, 'processed_ledger', ledger), \
+                mock.patch.object(LocalS3Client, 'put_object', fail_change_sets):
+            for merge_mode in ('memory', 'streaming'):
+                s3.store[('bucket', 'mstr/changes.csv')] = b'Id,Name\n1,a\n2,b\n'
+                s3.store[('bucket', 'user/changes1.csv')] = b'Id,Name\n2,B\n3,c\n'
+                file_type = FileType('Changes', 'user/changes*.csv', 'mstr/changes.csv', 'Id', ',', '"',
+                                     merge_mode=merge_mode, write_change_set=True)
+                user_object = S3Object('bucket', 'user/changes1.csv', sequencer=merge_mode)
+                self.assertEqual(s3_functions.merge_to_mstr(user_object, file_type), 'Success')
+                self.assertEqual(user_object.processing_data.change_set_key, '')
+                self.assertEqual(s3.store[('bucket', 'mstr/changes.csv')], b'Id,Name\n1,a\n2,B\n3,c\n')
+                self.assertTrue(ledger.contains(user_object))
+
+
+def merge_in_worker_process(directory, keys):
+    """
+    Merges the user objects one at a time the way a separate worker instance would, against the shared store.
+    """
+    s3 = FileS3Resource(directory)
+    s3_functions.get_s3_resource = lambda: s3
+    s3_functions.conflict_retries = 100
+    s3_functions.conflict_backoff_seconds = 0.01
+    file_type = FileType('Workers', 'user/workers*.csv', 'mstr/workers.csv', 'Id', ',', '"')
+    return [s3_functions.merge_to_mstr(S3Object('bucket', key), file_type) for key in keys]
+
+
+class TestMultipleWorkers(unittest.TestCase):
+    def test_conditional_write_conflict_is_retried(self):
+        s3 = LocalS3()
+        s3.store[('bucket', 'mstr/workers.csv')] = b'Id,Name\n1,a\n'
+        s3.store[('bucket', 'user/workers1.csv')] = b'Id,Name\n2,b\n'
+        file_type = FileType('Workers', 'user/workers*.csv', 'mstr/workers.csv', 'Id', ',', '"')
+        write_csv = s3_functions.write_csv
+
+        def write_after_other_worker(*args, **kwargs):
+            # another worker writes the master between this worker's read and write, once
+            if write_after_other_worker.first:
+                write_after_other_worker.first = False
+                s3.store[('bucket', 'mstr/workers.csv')] = b'Id,Name\n1,a\n3,c\n'
+            return write_csv(*args, **kwargs)
+        write_after_other_worker.first = True
+        with mock.patch('s3_functions.get_s3_resource', return_value=s3), \
+                mock.patch('s3_functions.write_csv', side_effect=write_after_other_worker), \
+                mock.patch.object(s3_functions, 'mstr_cache', DataFrameCache()), \
+                mock.patch.object(s3_functions, 'conflict_backoff_seconds', 0):
+            self.assertEqual(s3_functions.merge_to_mstr(S3Object('bucket', 'user/workers1.csv'), file_type), 'Success')
+        df_mstr = pandas.read_csv(io.BytesIO(s3.store[('bucket', 'mstr/workers.csv')]))
+        self.assertEqual(sorted(df_mstr['Id']), [1, 2, 3])
+
+    def test_conflict_leaves_message_on_queue(self):
+        message = make_message('1', 'user/workers1.csv', '2020-02-22T21:28:03.000Z', '01')
+        user_object = message_functions.get_object(json.loads(message.body))
+        with mock.patch('metrics.exporters', []):
+            message_functions.acknowledge_messages([(message, user_object)], [s3_functions.CONFLICT])
+        self.assertFalse(message.deleted)
+
+    def test_visibility_heartbeat(self):
+        message = make_message('1', 'user/workers1.csv', '2020-02-22T21:28:03.000Z', '01')
+        with VisibilityHeartbeat([message], 30, interval=0.01) as heartbeat:
+            time.sleep(0.1)
+        beats = heartbeat.beats
+        self.assertGreater(beats, 0)
+        self.assertEqual(message.visibility_timeout, 30)
+        time.sleep(0.05)
+        self.assertEqual(heartbeat.beats, beats)
+
+    def test_visibility_heartbeat_extends_on_start(self):
+        message = make_message('1', 'user/workers1.csv', '2020-02-22T21:28:03.000Z', '01')
+        with VisibilityHeartbeat([message], 300, interval=60) as heartbeat:
+            self.assertEqual(heartbeat.beats, 1)
+            self.assertEqual(message.visibility_timeout, 300)
+
+    def test_visibility_heartbeat_extends_in_batches(self):
+        messages = [make_message(str(index), 'user/workers{}.csv'.format(index), '2020-02-22T21:28:03.000Z', '01')
+                    for index in range(25)]
+        queue = LocalQueue([messages])
+        messages[3].deleted = True
+        with VisibilityHeartbeat(messages, 300, interval=60, queue=queue):
+            self.assertEqual([len(request) for request in queue.visibility_requests], [10, 10, 5])
+        self.assertEqual(queue.calls['change_visibility'], 0)
+        self.assertEqual([message.visibility_timeout for message in messages].count(300), 24)
+
+    def test_heartbeat_interval_from_queue(self):
+        queue = LocalQueue([])
+        queue.attributes = {'VisibilityTimeout': '30'}
+        self.assertEqual(app.get_heartbeat_interval(queue, 300), 15)
+        queue.attributes = {}
+        self.assertEqual(app.get_heartbeat_interval(queue, 300), 150)
+
+    def test_worker_pool_hides_messages_when_received(self):
+        messages = [make_message(str(index), 'user/workers{}.csv'.format(index), '2020-02-22T21:28:03.000Z', '01')
+                    for index in range(2)]
+        heartbeat = VisibilityHeartbeat([], 300, interval=60).start()
+        hidden = []
+
+        def process_messages(entries, file_type, heartbeat):
+            hidden.extend(getattr(message, 'visibility_timeout', None) for message, user_object in entries)
+            heartbeat.remove([message for message, user_object in entries])
+        with mock.patch('app.process_messages', side_effect=process_messages), \
+                mock.patch.object(delta_log, 'delta_masters', {}):
+            app.run_worker_pool(LocalQueue([messages]), 1, 0.001, heartbeat=heartbeat)
+        heartbeat.stop()
+        # the second group waited for a worker with its message already hidden
+        self.assertEqual(hidden, [300, 300])
+        self.assertEqual(heartbeat.messages, [])
+
+    def test_worker_processes_lose_no_updates(self):
+        process_count = 4
+        files_per_process = 5
+        with tempfile.TemporaryDirectory() as directory:
+            s3 = FileS3Resource(directory)
+            s3.store[('bucket', 'mstr/workers.csv')] = b'Id,Name\n0,start\n'
+            work = []
+            for process in range(process_count):
+                keys = []
+                for index in range(files_per_process):
+                    key = 'user/workers_{}_{}.csv'.format(process, index)
+                    first_id = 1 + (process * files_per_process + index) * 10
+                    s3.store[('bucket', key)] = ('Id,Name\n' + ''.join('{},{}\n'.format(row_id, key)
+                                                for row_id in range(first_id, first_id + 10))).encode('utf-8')
+                    keys.append(key)
+                work.append((directory, keys))
+            with multiprocessing.get_context('fork').Pool(process_count) as pool:
+                results = pool.starmap(merge_in_worker_process, work)
+            self.assertEqual([result for process_results in results for result in process_results],
+                             ['Success'] * process_count * files_per_process)
+            df_mstr = pandas.read_csv(io.BytesIO(s3.store[('bucket', 'mstr/workers.csv')]))
+            self.assertEqual(sorted(df_mstr['Id']), list(range(1 + process_count * files_per_process * 10)))
+
+
+class TestGroupMessages(unittest.TestCase):
+    def test_group_messages_by_master(self):
+        messages = [make_message('1', 'user/userEmailFile_b.csv', '2020-02-22T21:28:05.000Z', '005E519CE5135DFF6C'),
+                    make_message('2', 'user/randomDataFile.csv', '2020-02-22T21:28:04.000Z', '005E519CE5135DFF6C'),
+                    make_message('3', 'user/userEmailFile_a.csv', '2020-02-22T21:28:03.000Z', '005E519CE5135DFF6B'),
+                    make_message('4', 'user/userEmailFile_c.csv', '2020-02-22T21:28:05.000Z', '005E519CE5135DFF6C1')]
+        batches = message_functions.group_messages(messages)
+        self.assertEqual([key for key, file_type, entries in batches],
+                         ['mstr/userEmailFile.csv', 'mstr/randomDataFile.csv'])
+        key, file_type, entries = batches[0]
+        self.assertEqual(file_type.file_process_name, 'Email CSV')
+        # ordered by event time, then by sequencer for events in the same millisecond
+        self.assertEqual([message.message_id for message, user_object in entries], ['3', '1', '4'])
+
+    def test_group_messages_invalid_message(self):
+        message = make_message('1', 'user/userEmailFile.csv', None, None)
+        message.body = json.dumps({'Records': 'This is some junk message format.'})
+        batches = message_functions.group_messages([message])
+        self.assertEqual(len(batches), 1)
+        key, file_type, entries = batches[0]
+        self.assertEqual(key, '1')
+        self.assertIsNone(file_type)
+
+
+class TestMergePipeline(unittest.TestCase):
+    def setUp(self):
+        s3_functions.mstr_cache.set_max_bytes(0)
+        self.s3 = LocalS3()
+        self.s3.store[('bucket', 'user/userEmailFile1.csv')] = b'Email,Name\na@example.com,a\nb@example.com,b\n'
+        self.s3.store[('bucket', 'user/userEmailFile2.csv')] = b'Email,Name\nb@example.com,B\n'
+        self.s3.store[('bucket', 'user/randomDataFile1.csv')] = b'Id,Value\n1,x\n'
+        self.s3.store[('bucket', 'mstr/userEmailFile.csv')] = b'Email,Name\nc@example.com,c\n'
+
+    def tearDown(self):
+        s3_functions.mstr_cache.set_max_bytes(512 * 1024 * 1024)
+
+    def test_pipeline_merges_and_deletes_messages(self):
+        first = [make_message('1', 'user/userEmailFile1.csv', '2020-02-22T21:28:03.000Z', '01'),
+                 make_message('2', 'user/randomDataFile1.csv', '2020-02-22T21:28:03.000Z', '02')]
+        second = [make_message('3', 'user/userEmailFile2.csv', '2020-02-22T21:28:04.000Z', '03')]
+        pipeline = MergePipeline(LocalQueue([first, second]), worker_count=2, minutes_without_message_limit=0.005,
+                                 queue_size=1)
+        with mock.patch('s3_functions.get_s3_resource', return_value=self.s3), \
+                mock.patch('s3_functions.read_csv', side_effect=fake_read_csv):
+            asyncio.run(pipeline.run())
+        self.assertTrue(all(message.deleted for message in first + second))
+        df_mstr = pandas.read_csv(io.BytesIO(self.s3.store[('bucket', 'mstr/userEmailFile.csv')]))
+        # the second user file is applied after the first
+        self.assertEqual(list(df_mstr['Name']), ['c', 'a', 'B'])
+        self.assertIn(('bucket', 'mstr/randomDataFile.csv'), self.s3.store)
+        # the locks are dropped once their masters are done with
+        self.assertEqual(pipeline.locks, {})
+
+    def test_pipeline_continues_after_acknowledge_error(self):
+        first = [make_message('1', 'user/userEmailFile1.csv', '2020-02-22T21:28:03.000Z', '01')]
+        second = [make_message('2', 'user/userEmailFile2.csv', '2020-02-22T21:28:04.000Z', '02')]
+        pipeline = MergePipeline(LocalQueue([first, second]), worker_count=1, minutes_without_message_limit=0.005,
+                                 queue_size=1)
+        acknowledge_messages = message_functions.acknowledge_messages
+        failures = [ClientError({'Error': {'Code': 'InternalError'}}, 'DeleteMessage')]
+
+        def fail_once(*args):
+            if failures:
+                raise failures.pop()
+            return acknowledge_messages(*args)
+
+        with mock.patch('s3_functions.get_s3_resource', return_value=self.s3), \
+                mock.patch('s3_functions.read_csv', side_effect=fake_read_csv), \
+                mock.patch('message_functions.acknowledge_messages', side_effect=fail_once), \
+                mock.patch.object(s3_functions, 'processed_ledger', ProcessedLedger(MemoryLedgerStore())):
+            asyncio.run(pipeline.run())
+        self.assertFalse(first[0].deleted)
+        self.assertTrue(second[0].deleted)
+        self.assertEqual(pipeline.locks, {})
+
+    def test_pipeline_groups_messages_off_event_loop(self):
+        messages = [make_message('1', 'user/userEmailFile1.csv', '2020-02-22T21:28:03.000Z', '01')]
+        pipeline = MergePipeline(LocalQueue([messages]), worker_count=1, minutes_without_message_limit=0.005,
+                                 queue_size=1)
+        group_messages = message_functions.group_messages
+        threads = []
+
+        def record_thread(*args):
+            threads.append(threading.current_thread().name)
+            return group_messages(*args)
+
+        with mock.patch('s3_functions.get_s3_resource', return_value=self.s3), \
+                mock.patch('s3_functions.read_csv', side_effect=fake_read_csv), \
+                mock.patch('message_functions.group_messages', side_effect=record_thread), \
+                mock.patch.object(s3_functions, 'processed_ledger', ProcessedLedger(MemoryLedgerStore())):
+            asyncio.run(pipeline.run())
+        self.assertTrue(messages[0].deleted)
+        self.assertEqual(len(threads), 1)
+        self.assertTrue(threads[0].startswith('io'))
+
+
 if __name__ == '__main__':
     unittest.main()
+
+
+class TestPollScheduler(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.signals = []
+
+    def get_messages(self, count, sent_seconds_ago=1):
+        messages = []
+        for index in range(count):
+            message = make_message(str(index), 'user/userEmailFile_{}.csv'.format(index), '2020-02-22T21:28:03.647Z',
+                                  '{:018X}'.format(index))
+            message.attributes = {'SentTimestamp': str(int((self.now - sent_seconds_ago) * 1000))}
+            messages.append(message)
+        return messages
+
+    def get_scheduler(self, queue, **kwargs):
+        return PollScheduler(queue, lambda action, details: self.signals.append((action, details)),
+                             clock=lambda: self.now, **kwargs)
+
+    def test_empty_queue_is_long_polled(self):
+        queue = LocalQueue([])
+        scheduler = self.get_scheduler(queue)
+        self.assertEqual(scheduler.receive(), [])
+        self.assertEqual(queue.receives, [(10, 20)])
+
+    def test_backlog_is_short_polled_into_larger_batches(self):
+        queue = LocalQueue([self.get_messages(10) for batch in range(4)])
+        scheduler = self.get_scheduler(queue, max_batch_messages=30)
+        messages = scheduler.receive()
+        self.assertEqual(len(messages), 30)
+        self.assertEqual(queue.receives, [(10, 0), (10, 0), (10, 0)])
+        self.assertEqual(len(queue.batches), 1)
+
+    def test_drained_queue_ends_the_round(self):
+        queue = LocalQueue([self.get_messages(10), self.get_messages(3)])
+        scheduler = self.get_scheduler(queue)
+        self.assertEqual(len(scheduler.receive()), 13)
+        self.assertEqual(len(queue.receives), 2)
+
+    def test_scale_out_on_depth(self):
+        queue = LocalQueue([self.get_messages(10) for batch in range(10)])
+        scheduler = self.get_scheduler(queue, max_batch_messages=10, scale_out_depth=50)
+        scheduler.receive()
+        self.assertEqual(self.signals, [('scale_out', {'queue_depth': 90, 'message_age_seconds': 1})])
+        # the signal isn't repeated until its cooldown runs out
+        self.now += 30
+        scheduler.receive()
+        self.assertEqual(len(self.signals), 1)
+        self.now += 600
+        scheduler.receive()
+        self.assertEqual([action for action, details in self.signals], ['scale_out', 'scale_out'])
+
+    def test_scale_out_on_message_age(self):
+        queue = LocalQueue([self.get_messages(2, sent_seconds_ago=400)])
+        scheduler = self.get_scheduler(queue, scale_out_latency_seconds=300)
+        scheduler.receive()
+        self.assertEqual(scheduler.message_age, 400)
+        self.assertEqual([action for action, details in self.signals], ['scale_out'])
+
+    def test_scale_in_waits_for_the_cooldown(self):
+        queue = LocalQueue([self.get_messages(10) for batch in range(10)])
+        scheduler = self.get_scheduler(queue, max_batch_messages=50, scale_out_depth=50, depth_check_seconds=0)
+        scheduler.receive()
+        scheduler.receive()
+        self.assertEqual([action for action, details in self.signals], ['scale_out'])
+        self.now += 600
+        scheduler.receive()
+        self.assertEqual([action for action, details in self.signals], ['scale_out', 'scale_in'])
+
+    def test_scale_in_after_low_depth_window(self):
+        scheduler = self.get_scheduler(LocalQueue([]), scale_in_window_seconds=300)
+        self.assertIsNone(scheduler.get_scale_action())
+        self.now += 200
+        self.assertIsNone(scheduler.get_scale_action())
+        # the queue rises above the scale in depth and the window starts again
+        scheduler.queue_depth = 5
+        self.assertIsNone(scheduler.get_scale_action())
+        scheduler.queue_depth = 0
+        self.now += 200
+        self.assertIsNone(scheduler.get_scale_action())
+        self.now += 299
+        self.assertIsNone(scheduler.get_scale_action())
+        self.now += 1
+        self.assertEqual(scheduler.get_scale_action(), 'scale_in')
+
+    def test_signals_kept_are_capped(self):
+        scheduler = self.get_scheduler(LocalQueue([]), signal_cooldown_seconds=0)
+        for index in range(scheduler.signals.maxlen + 10):
+            scheduler.signal('scale_out')
+        self.assertEqual(len(scheduler.signals), scheduler.signals.maxlen)
+        self.assertEqual(len(self.signals), scheduler.signals.maxlen + 10)
+
+    def test_send_sqs_message_action(self):
+        sqs = mock.MagicMock()
+        with mock.patch('clients.get_resource', return_value=sqs):
+            app.send_sqs_message('i-1', 'outgoing', 'scale_out', {'queue_depth': 90})
+        outgoing = sqs.get_queue_by_name.return_value
+        arguments = outgoing.send_message.call_args.kwargs
+        self.assertEqual(arguments['MessageBody'], 'Scale Out')
+        self.assertEqual(arguments['MessageAttributes']['action']['StringValue'], 'scale_out')
+        self.assertEqual(arguments['MessageAttributes']['queue_depth'],
+                         {'StringValue': '90', 'DataType': 'Number'})
+
+
+class TestAcknowledgementManager(unittest.TestCase):
+    def setUp(self):
+        self.messages = [make_message(str(index), 'user/userEmailFile_{}.csv'.format(index), '2020-02-22T21:28:03.647Z',
+                                     '{:018X}'.format(index)) for index in range(25)]
+        self.queue = LocalQueue([self.messages])
+        self.dead_letter_queue = LocalQueue([])
+        self.manager = AcknowledgementManager(self.queue, self.dead_letter_queue, max_delay_seconds=60,
+                                              backoff_seconds=0)
+
+    def test_deletes_in_batches_of_ten(self):
+        deleted = []
+        for message in self.messages:
+            self.manager.add(message, deleted.append)
+        self.assertEqual([len(request) for request in self.queue.delete_requests], [10, 10])
+        self.manager.stop()
+        self.assertEqual([len(request) for request in self.queue.delete_requests], [10, 10, 5])
+        self.assertTrue(all(message.deleted for message in self.messages))
+        self.assertEqual((self.manager.deleted, len(deleted)), (25, 25))
+
+    def test_background_thread_sends_partial_batch(self):
+        manager = AcknowledgementManager(self.queue, max_delay_seconds=0.01).start()
+        manager.add(self.messages[0])
+        for attempt in range(100):
+            if self.messages[0].deleted:
+                break
+            time.sleep(0.01)
+        manager.stop()
+        self.assertTrue(self.messages[0].deleted)
+
+    def test_retries_only_failed_entries(self):
+        self.queue.delete_failures = {'receipt-1': 2, 'receipt-2': 'sender'}
+        for message in self.messages[:3]:
+            self.manager.add(message)
+        self.manager.flush()
+        self.assertEqual(self.queue.delete_requests, [['receipt-0', 'receipt-1', 'receipt-2'], ['receipt-1'],
+                                                      ['receipt-1']])
+        self.assertEqual([message.deleted for message in self.messages[:3]], [True, True, False])
+        self.assertEqual((self.manager.deleted, self.manager.failed), (2, 1))
+
+    def test_invalid_message_goes_to_dead_letter_queue(self):
+        user_object = message_functions.get_object(json.loads(self.messages[1].body))
+        with mock.patch.object(message_functions, 'acknowledger', self.manager), \
+                mock.patch('metrics.emit') as emit:
+            message_functions.acknowledge_messages([(self.messages[0], None), (self.messages[1], user_object)],
+                                                   ['', 'User file not found'])
+            self.manager.flush()
+        self.assertEqual([attributes['result']['StringValue'] for body, attributes in self.dead_letter_queue.sent],
+                         ['Invalid message', 'User file not found'])
+        self.assertEqual(self.dead_letter_queue.sent[1][0], self.messages[1].body)
+        self.assertTrue(self.messages[0].deleted and self.messages[1].deleted)
+        emit.assert_called_once_with(user_object, 'User file not found')
+        self.assertIn('delete', user_object.stage_timer.seconds)
+
+    def test_unparsable_body_goes_to_dead_letter_queue(self):
+        self.messages[0].body = 'not json'
+        [(key, file_type, entries)] = message_functions.group_messages(self.messages[:1])
+        self.assertEqual(entries, [(self.messages[0], None)])
+        with mock.patch.object(message_functions, 'acknowledger', self.manager):
+            self.assertEqual(app.process_messages(entries, file_type), [''])
+            self.manager.flush()
+        self.assertEqual([body for body, attributes in self.dead_letter_queue.sent], ['not json'])
+        self.assertTrue(self.messages[0].deleted)
+
+    def test_failed_merge_is_left_on_queue(self):
+        user_object = message_functions.get_object(json.loads(self.messages[0].body))
+        with mock.patch.object(message_functions, 'acknowledger', self.manager), \
+                mock.patch('metrics.emit') as emit:
+            message_functions.acknowledge_messages([(self.messages[0], user_object)], ['Error'])
+            self.manager.flush()
+        self.assertEqual(self.dead_letter_queue.sent, [])
+        self.assertFalse(self.messages[0].deleted)
+        emit.assert_called_once_with(user_object, 'Error')
+
+    def test_bad_input_is_kept_without_dead_letter_queue(self):
+        manager = AcknowledgementManager(self.queue, max_delay_seconds=60)
+        with mock.patch.object(message_functions, 'acknowledger', manager):
+            message_functions.acknowledge_messages([(self.messages[0], None)], [''])
+            manager.flush()
+        self.assertFalse(self.messages[0].deleted)
+
+
+class TestMergeBenchmark(unittest.TestCase):
+    def test_scenarios_run_in_one_process(self):
+        scenarios = {'small': dict(merge_benchmark.SCENARIO_DEFAULTS, mstr_rows=200, stg_rows=50),
+                     'small_batch': dict(merge_benchmark.SCENARIO_DEFAULTS, mstr_rows=200, stg_rows=50, stg_files=3),
+                     'small_streaming': dict(merge_benchmark.SCENARIO_DEFAULTS, mstr_rows=200, stg_rows=50,
+                                             merge_mode='streaming')}
+        with mock.patch.object(s3_functions, 'get_s3_resource'), \
+                mock.patch.object(s3_functions, 'processed_ledger'), \
+                mock.patch.object(s3_functions, 'mstr_cache', DataFrameCache()), \
+                mock.patch('metrics.exporters', []):
+            for name in ('small', 'small_batch', 'small_streaming', 'small'):
+                stages = merge_benchmark.run_scenario(scenarios[name])
+                self.assertEqual(stages[-1]['requests'], {'sqs_delete': scenarios[name]['stg_files']})
+
+
+class TestClients(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.dict(os.environ, {'AWS_DEFAULT_REGION': 'us-east-1'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        clients.set_client_config(16)
+        self.addCleanup(clients.set_client_config, 32)
+
+    def test_resource_is_reused_by_its_thread(self):
+        self.assertIs(clients.get_resource('s3'), clients.get_resource('s3'))
+
+    def test_threads_share_one_client(self):
+        resources = []
+        thread = threading.Thread(target=lambda: resources.append(clients.get_resource('s3')))
+        thread.start()
+        thread.join()
+        resource = clients.get_resource('s3')
+        self.assertIsNot(resources[0], resource)
+        self.assertIs(resources[0].meta.client, resource.meta.client)
+        self.assertIs(resource.meta.client, clients.get_client('s3'))
+
+    def test_client_config(self):
+        config = clients.get_client('s3').meta.config
+        self.assertEqual((config.max_pool_connections, config.tcp_keepalive), (16, True))
+        resource = clients.get_resource('s3')
+        clients.set_client_config(8, keepalive=False)
+        self.assertIsNot(clients.get_resource('s3'), resource)
+        config = clients.get_resource('s3').meta.client.meta.config
+        self.assertEqual((config.max_pool_connections, config.tcp_keepalive), (8, False))
+
+    def test_app_import_defers_merge_modules(self):
+        code = 'import sys, app; print(sorted(name for name in ("pandas", "pyarrow", "boto3", "s3_functions") ' \
+               'if name in sys.modules))'
+        output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True,
+                                cwd=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')).stdout
+        self.assertEqual(output.strip(), '[]')
@@ -0,0 +1,212 @@
+from concurrent.futures import ThreadPoolExecutor
+import io
+import logging
+import os
+import shutil
+import threading
+import time
+from botocore.exceptions import ClientError
+from classes.buffer_reader import BufferReader
+from classes.multipart_writer import MultipartWriter
+import compression_functions
+import s3_functions
+
+MB = 1024 * 1024
+# S3 does not accept multipart parts smaller than 5 MB, apart from the last one
+MIN_PART_SIZE = 5 * MB
+READ_CHUNK_SIZE = 1 * MB
+
+# objects up to one part are moved with a single request, app.main sets these from the config
+part_size = 8 * MB
+max_concurrency = 8
+# largest download buffer kept by a thread, a larger download gets a buffer of its own that is freed with its reader
+max_buffer_size = 64 * MB
+
+# download buffer of each thread, kept between downloads so a large master is not reallocated every merge
+thread_buffers = threading.local()
+
+
+def set_transfer_config(part_size_mb, concurrency, max_buffer_mb=64):
+    global part_size, max_concurrency, max_buffer_size
+    part_size = max(part_size_mb * MB, MIN_PART_SIZE)
+    max_concurrency = max(concurrency, 1)
+    max_buffer_size = max_buffer_mb * MB
+
+
+def get_buffer(size):
+    """
+    Returns this thread's download buffer, grown to at least size bytes. A download over max_buffer_size gets a
+    buffer that is not kept, so every thread does not hold on to the largest object it ever read.
+    """
+    if size > max_buffer_size:
+        return bytearray(size)
+    buffer = getattr(thread_buffers, 'buffer', None)
+    if buffer is None or len(buffer) < size:
+        buffer = bytearray(size)
+        thread_buffers.buffer = buffer
+    return buffer
+
+
+def get_ranges(size):
+    return [(start, min(start + part_size, size)) for start in range(0, size, part_size)]
+
+
+def read_into(body, view):
+    """
+    Reads a streaming response body into the view.
+    """
+    position = 0
+    while position < len(view):
+        chunk = body.read(min(READ_CHUNK_SIZE, len(view) - position))
+        if not chunk:
+            break
+        view[position:position + len(chunk)] = chunk
+        position += len(chunk)
+    if position != len(view) or body.read(1):
+        raise IOError('Expected {} bytes, the object changed while downloading.'.format(len(view)))
+
+
+def download_range(s3, s3_object, view, start, etag):
+    # If-Match makes every range come from the same version of the object
+    response = s3.meta.client.get_object(Bucket=s3_object.bucket, Key=s3_object.key, IfMatch='"{}"'.format(etag),
+                                         Range='bytes={}-{}'.format(start, start + len(view) - 1))
+    read_into(response['Body'], view)
+
+
+def download_object(s3, s3_object, current=False):
+    """
+    Downloads the object into this thread's buffer and returns a file object reading from it.
+    Objects larger than one part are fetched with concurrent ranged GETs, each written into its own slice of the
+    buffer. Every GET is for the ETag the size was read with. The returned reader is only valid until the next
+    download on the same thread.
+    With current, an object that changed since its metadata was read is downloaded again at its current version
+    instead of raising a conflict. That is for user objects, whose metadata comes from an S3 event that a later put
+    of the same key leaves stale. A master that changed is a conflict for the merge to retry.
+    """
+    try:
+        return download_version(s3, s3_object)
+    except ClientError as e:
+        if not current or not s3_functions.is_conflict(e):
+            raise
+        refresh_metadata(s3, s3_object, e)
+    return download_version(s3, s3_object)
+
+
+def download_version(s3, s3_object):
+    metadata = s3_functions.get_object_metadata(s3, s3_object)
+    view = memoryview(get_buffer(metadata.size))[:metadata.size]
+    ranges = get_ranges(metadata.size)
+    if len(ranges) == 1:
+        download_range(s3, s3_object, view, 0, metadata.etag)
+    elif len(ranges) > 1:
+        with ThreadPoolExecutor(max_workers=min(max_concurrency, len(ranges)), thread_name_prefix='download') as executor:
+            futures = [executor.submit(download_range, s3, s3_object, view[start:end], start, metadata.etag)
+                       for start, end in ranges]
+            for future in futures:
+                future.result()
+    return BufferReader(view)
+
+
+def refresh_metadata(s3, s3_object, error):
+    """
+    HEADs the object again after a GET failed because it changed. Raises NoSuchKey when it has since been deleted.
+    """
+    logging.info('Handling ClientError: {}, {} changed since its metadata was read.'.format(error, s3_object.path))
+    s3_object.metadata = None
+    if not s3_functions.get_object_metadata(s3, s3_object).exists:
+        raise ClientError({'Error': {'Code': 'NoSuchKey', 'Message': 'The object was deleted.'}}, 'GetObject')
+
+
+def download_file(s3, s3_object, path, current=False):
+    """
+    Downloads the object to a local file with concurrent ranged GETs, each written at its offset in the file, so
+    memory use is bounded by the parts in flight whatever the size of the object. Every GET is made If-Match the
+    ETag of the object's metadata, if the object changes while it is downloaded a conflict ClientError is raised.
+    With current the object is downloaded again at its current version instead, as download_object does.
+    """
+    try:
+        download_version_to_file(s3, s3_object, path)
+        return
+    except ClientError as e:
+        if not current or not s3_functions.is_conflict(e):
+            raise
+        refresh_metadata(s3, s3_object, e)
+    download_version_to_file(s3, s3_object, path)
+
+
+def download_version_to_file(s3, s3_object, path):
+    metadata = s3_functions.get_object_metadata(s3, s3_object)
+    with open(path, 'wb') as target:
+        target.truncate(metadata.size)
+    ranges = get_ranges(metadata.size)
+    if not ranges:
+        return
+    with ThreadPoolExecutor(max_workers=min(max_concurrency, len(ranges)), thread_name_prefix='download') as executor:
+        futures = [executor.submit(download_range_to_file, s3, s3_object, path, start, end, metadata.etag)
+                   for start, end in ranges]
+        for future in futures:
+            future.result()
+
+
+def download_range_to_file(s3, s3_object, path, start, end, etag):
+    view = memoryview(bytearray(end - start))
+    download_range(s3, s3_object, view, start, etag)
+    with open(path, 'r+b') as target:
+        target.seek(start)
+        target.write(view)
+
+
+def upload_file(s3, s3_object, path, compression=None, compression_level=None, conditions=None):
+    """
+    Uploads a local file to the object in parts, at most max_concurrency in flight, compressed on the way when a
+    codec is given. Returns the closed MultipartWriter, its size and response describe the new object, and the
+    file size is set as the object's uncompressed_size. conditions are passed to the request that commits the
+    object.
+    """
+    writer = MultipartWriter(s3, s3_object, part_size, max_concurrency, conditions)
+    stream = compression_functions.open_compressed(writer, compression, compression_level) if compression else writer
+    try:
+        with open(path, 'rb') as source:
+            shutil.copyfileobj(source, stream, READ_CHUNK_SIZE)
+        if stream is not writer:
+            # writes the end of the compressed stream, the writer is still open
+            stream.close()
+    except BaseException:
+        writer.abort()
+        raise
+    writer.close()
+    s3_object.uncompressed_size = os.path.getsize(path)
+    return writer
+
+
+def upload_csv(s3, s3_object, df, compression=None, compression_level=None, conditions=None, **to_csv_args):
+    """
+    Writes the dataframe to the object as csv. Parts are uploaded while to_csv is still serializing the rest of
+    the dataframe, compressed on the way when a codec is given. Returns the closed MultipartWriter, its size and
+    response describe the new object, and the csv size is set as the object's uncompressed_size. conditions are
+    passed to the request that commits the object.
+    The serialize stage of the object's timer excludes the time spent waiting on uploads, which is counted in the
+    upload stage with the time taken to finish the upload.
+    """
+    writer = MultipartWriter(s3, s3_object, part_size, max_concurrency, conditions)
+    stream = compression_functions.open_compressed(writer, compression, compression_level) if compression else writer
+    text = io.TextIOWrapper(stream, encoding='utf-8', newline='')
+    start = time.perf_counter()
+    try:
+        df.to_csv(text, index=False, **to_csv_args)
+        text.flush()
+        if stream is not writer:
+            s3_object.uncompressed_size = stream.tell()
+            # writes the end of the compressed stream, the writer is still open
+            stream.close()
+    except BaseException:
+        writer.abort()
+        raise
+    serialized = time.perf_counter()
+    text.close()
+    writer.close()
+    if stream is writer:
+        s3_object.uncompressed_size = writer.size
+    s3_object.stage_timer.add('serialize', serialized - start - writer.wait_seconds)
+    s3_object.stage_timer.add('upload', writer.wait_seconds + time.perf_counter() - serialized)
+    return writer
@@ -0,0 +1,278 @@
+import numpy
+import pandas
+from classes.file_types import UPDATE_MODES
+from classes.stage_timer import StageTimer
+from classes.upsert_result import UpsertResult
+
+DEDUPE_STRATEGIES = ('first', 'last', 'newest')
+# columns of a change set after the key columns
+CHANGE_SET_COLUMNS = ['change', 'column', 'before', 'after']
+
+
+def get_key_codes(df_mstr, df_stg, key_columns):
+    """
+    Builds one hash index over the keys of both dataframes.
+    Returns the integer key codes of the mstr rows, of the stg rows and the number of distinct keys.
+    Equal keys get equal codes whichever dataframe they come from, missing values are treated as a key like merge does.
+    """
+    keys = pandas.concat([df_mstr[key_columns], df_stg[key_columns]], ignore_index=True)
+    if len(key_columns) == 1:
+        codes, uniques = pandas.factorize(keys[key_columns[0]], use_na_sentinel=False)
+        key_count = len(uniques)
+    else:
+        grouped = keys.groupby(key_columns, sort=False, dropna=False)
+        codes = grouped.ngroup().to_numpy()
+        key_count = grouped.ngroups
+    mstr_row_count = len(df_mstr.index)
+    return codes[:mstr_row_count], codes[mstr_row_count:], key_count
+
+
+def get_stg_keep_positions(df_stg, stg_codes, keep='last', timestamp_column=None):
+    """
+    Returns the positions of the stg rows that survive the dedupe, in their original order.
+    keep is 'first', 'last' or 'newest', newest keeps the row with the latest timestamp_column value and the last
+    row of any ties.
+    """
+    if keep not in DEDUPE_STRATEGIES:
+        raise ValueError('Unknown dedupe strategy: {}'.format(keep))
+    if keep == 'newest':
+        if timestamp_column is None:
+            raise ValueError('The newest dedupe strategy needs a timestamp column.')
+        timestamps = pandas.to_datetime(df_stg[timestamp_column], errors='coerce').reset_index(drop=True)
+        order = timestamps.sort_values(kind='mergesort', na_position='first').index.to_numpy()
+        duplicated = pandas.Series(stg_codes[order]).duplicated(keep='last').to_numpy()
+        return numpy.sort(order[~duplicated])
+    duplicated = pandas.Series(stg_codes).duplicated(keep=keep).to_numpy()
+    return numpy.flatnonzero(~duplicated)
+
+
+def get_row_hashes(df, columns):
+    """
+    Returns a 64 bit hash of the values of each row, in the given column order.
+    """
+    return pandas.util.hash_pandas_object(df[columns], index=False).to_numpy()
+
+
+def get_unchanged_count(df_mstr, df_stg_distinct, mstr_codes, stg_codes, key_count, in_mstr, mstr_updated,
+                        partial=False):
+    """
+    Returns how many of the deduped stg rows replace a mstr row holding the same values, compared by row hash.
+    Only counted when both dataframes have the same columns, or with partial when the mstr has every stg column,
+    and each updated key has a single mstr row, otherwise applying the stg changes the mstr anyway.
+    """
+    columns = list(df_stg_distinct.columns) if partial else list(df_mstr.columns)
+    stg_matched = in_mstr[stg_codes]
+    if not set(df_stg_distinct.columns) <= set(df_mstr.columns) or \
+            (not partial and set(columns) != set(df_stg_distinct.columns)) or \
+            int(mstr_updated.sum()) != int(stg_matched.sum()):
+        return 0
+    mstr_hashes = numpy.zeros(key_count, dtype=numpy.uint64)
+    mstr_hashes[mstr_codes[mstr_updated]] = get_row_hashes(df_mstr[mstr_updated], columns)
+    stg_hashes = get_row_hashes(df_stg_distinct[stg_matched], columns)
+    return int((mstr_hashes[stg_codes[stg_matched]] == stg_hashes).sum())
+
+
+def get_text(values):
+    return pandas.Series(values, dtype=object).astype('string')
+
+
+def get_change_set(df_mstr, df_stg_distinct, key_columns, mstr_codes, stg_codes, key_count, in_mstr, mstr_updated,
+                   partial=False):
+    """
+    Returns the changes the deduped stg makes to the mstr, one row for each inserted key, each unchanged key and
+    each changed column of an updated key. The rows have the key columns followed by change, 'insert', 'update'
+    or 'unchanged', and for updates the column with its before and after values as text.
+    With partial only the stg columns are compared, the others are left as they were.
+    """
+    stg_matched = in_mstr[stg_codes]
+    # position of the mstr row each matched stg row replaces, the last one when a key is repeated in the mstr
+    mstr_positions = numpy.zeros(key_count, dtype=numpy.int64)
+    mstr_positions[mstr_codes[mstr_updated]] = numpy.flatnonzero(mstr_updated)
+    mstr_positions = mstr_positions[stg_codes[stg_matched]]
+    df_after = df_stg_distinct[stg_matched]
+    df_keys = df_after[key_columns].reset_index(drop=True)
+    missing = [None] * len(df_keys.index)
+    changed = numpy.zeros(len(df_keys.index), dtype=bool)
+    frames = [df_stg_distinct.loc[~stg_matched, key_columns].assign(change='insert')]
+    columns = [] if partial else list(df_mstr.columns)
+    columns += [column for column in df_stg_distinct.columns if column not in columns]
+    for column in columns:
+        if column in key_columns:
+            continue
+        before = get_text(df_mstr[column].to_numpy()[mstr_positions] if column in df_mstr.columns else missing)
+        after = get_text(df_after[column].to_numpy() if column in df_after.columns else missing)
+        different = (~before.eq(after).fillna(False) & ~(before.isna() & after.isna())).to_numpy()
+        changed |= different
+        frames.append(df_keys[different].assign(change='update', column=column, before=before[different].to_numpy(),
+                                                after=after[different].to_numpy()))
+    frames.append(df_keys[~changed].assign(change='unchanged'))
+    df_change_set = pandas.concat(frames, ignore_index=True).reindex(columns=key_columns + CHANGE_SET_COLUMNS)
+    return df_change_set.astype({column: 'string' for column in CHANGE_SET_COLUMNS})
+
+
+def dedupe(df_stg, key_columns, keep='last', timestamp_column=None, stage_timer=None):
+    """
+    Returns the stg dataframe deduped on the key columns.
+    """
+    stage_timer = stage_timer if stage_timer is not None else StageTimer()
+    with stage_timer.stage('dedupe'):
+        mstr_codes, stg_codes, key_count = get_key_codes(df_stg.iloc[0:0], df_stg, key_columns)
+        return df_stg.iloc[get_stg_keep_positions(df_stg, stg_codes, keep, timestamp_column)]
+
+
+def upsert(df_mstr, df_stg, key_columns, keep='last', timestamp_column=None, stage_timer=None, change_set=False):
+    """
+    Applies the stg dataframe to the mstr dataframe in one pass over a shared key index.
+    The stg is deduped, then every mstr row whose key is in the stg is replaced and the remaining stg rows are added.
+    Returns an UpsertResult with the deduped stg, the new mstr, the update and new record counts and how many of
+    the updates left the row as it was. With change_set the result also has the change set of the upsert.
+    The time spent deduping and joining is added to the stage_timer when one is passed in.
+    """
+    stage_timer = stage_timer if stage_timer is not None else StageTimer()
+    with stage_timer.stage('join'):
+        mstr_codes, stg_codes, key_count = get_key_codes(df_mstr, df_stg, key_columns)
+    with stage_timer.stage('dedupe'):
+        stg_keep_positions = get_stg_keep_positions(df_stg, stg_codes, keep, timestamp_column)
+        df_stg_distinct = df_stg.iloc[stg_keep_positions]
+        stg_codes = stg_codes[stg_keep_positions]
+
+    with stage_timer.stage('join'):
+        in_stg = numpy.zeros(key_count, dtype=bool)
+        in_stg[stg_codes] = True
+        in_mstr = numpy.zeros(key_count, dtype=bool)
+        in_mstr[mstr_codes] = True
+        mstr_updated = in_stg[mstr_codes]
+        # a key repeated in the mstr keeps its last row, the same as drop_duplicates on the concatenated frames
+        mstr_keep = ~mstr_updated & ~pandas.Series(mstr_codes).duplicated(keep='last').to_numpy()
+
+        df_mstr_new = pandas.concat([df_mstr[mstr_keep], df_stg_distinct], ignore_index=True)
+    with stage_timer.stage('compare'):
+        unchanged_count = get_unchanged_count(df_mstr, df_stg_distinct, mstr_codes, stg_codes, key_count, in_mstr,
+                                              mstr_updated)
+    df_change_set = None
+    if change_set:
+        with stage_timer.stage('change_set'):
+            df_change_set = get_change_set(df_mstr, df_stg_distinct, key_columns, mstr_codes, stg_codes, key_count,
+                                           in_mstr, mstr_updated)
+    return UpsertResult(df_stg=df_stg_distinct,
+                        df_mstr_new=df_mstr_new,
+                        stg_row_count=len(df_stg.index),
+                        update_count=int(mstr_updated.sum()),
+                        new_record_count=int((~in_mstr[stg_codes]).sum()),
+                        unchanged_count=unchanged_count,
+                        df_change_set=df_change_set)
+
+
+def set_partial_columns(df_base, df_stg_distinct, key_columns, updated, stg_positions):
+    """
+    Returns df_base with the non key stg columns set on the updated rows from the stg rows at stg_positions, one
+    column at a time. The other columns are left as they are, stg columns the mstr doesn't have are added and are
+    empty on the rows that were not updated.
+    """
+    df_new = df_base.reset_index(drop=True)
+    if not updated.any():
+        return df_new
+    # the stg row of every base row, the first stg row stands in for the rows that are not updated
+    positions = numpy.where(updated, stg_positions, 0)
+    for column in df_stg_distinct.columns:
+        if column in key_columns:
+            continue
+        values = df_stg_distinct[column].iloc[positions].set_axis(df_new.index)
+        if column in df_new.columns:
+            df_new[column] = df_new[column].where(~updated, values)
+        else:
+            df_new[column] = values.where(updated)
+    return df_new
+
+
+def partial_upsert(df_mstr, df_stg, key_columns, keep='last', timestamp_column=None, stage_timer=None,
+                   change_set=False):
+    """
+    Applies the stg dataframe to the mstr dataframe column by column, for stg files holding the key and only the
+    columns that changed. The stg is deduped, then the stg columns of every mstr row whose key is in the stg are
+    set from it and the remaining stg rows are added. Mstr columns the stg doesn't have keep their values, and
+    are empty on the added rows. Updated rows stay where they are, a key repeated in the mstr keeps its last row.
+    df_mstr only needs the key columns and the stg columns it has for the updates to be applied, the result's
+    mstr_row_positions are the positions of its rows in df_mstr_new so callers can carry the other columns over.
+    Returns an UpsertResult like upsert.
+    """
+    stage_timer = stage_timer if stage_timer is not None else StageTimer()
+    with stage_timer.stage('join'):
+        mstr_codes, stg_codes, key_count = get_key_codes(df_mstr, df_stg, key_columns)
+    with stage_timer.stage('dedupe'):
+        stg_keep_positions = get_stg_keep_positions(df_stg, stg_codes, keep, timestamp_column)
+        df_stg_distinct = df_stg.iloc[stg_keep_positions]
+        stg_codes = stg_codes[stg_keep_positions]
+
+    with stage_timer.stage('join'):
+        in_stg = numpy.zeros(key_count, dtype=bool)
+        in_stg[stg_codes] = True
+        in_mstr = numpy.zeros(key_count, dtype=bool)
+        in_mstr[mstr_codes] = True
+        mstr_updated = in_stg[mstr_codes]
+        mstr_row_positions = numpy.flatnonzero(~pandas.Series(mstr_codes).duplicated(keep='last').to_numpy())
+        # position in the deduped stg of each key, -1 for keys it doesn't have
+        stg_positions = numpy.full(key_count, -1, dtype=numpy.int64)
+        stg_positions[stg_codes] = numpy.arange(len(stg_codes))
+        row_stg_positions = stg_positions[mstr_codes[mstr_row_positions]]
+        updated = row_stg_positions >= 0
+        stg_new = ~in_mstr[stg_codes]
+    with stage_timer.stage('update'):
+        df_base = df_mstr if len(mstr_row_positions) == len(df_mstr.index) else df_mstr.iloc[mstr_row_positions]
+        df_mstr_new = set_partial_columns(df_base, df_stg_distinct, key_columns, updated, row_stg_positions)
+        if stg_new.any():
+            df_mstr_new = pandas.concat([df_mstr_new, df_stg_distinct[stg_new]], ignore_index=True)
+    with stage_timer.stage('compare'):
+        unchanged_count = get_unchanged_count(df_mstr, df_stg_distinct, mstr_codes, stg_codes, key_count, in_mstr,
+                                              mstr_updated, partial=True)
+    df_change_set = None
+    if change_set:
+        with stage_timer.stage('change_set'):
+            df_change_set = get_change_set(df_mstr, df_stg_distinct, key_columns, mstr_codes, stg_codes, key_count,
+                                           in_mstr, mstr_updated, partial=True)
+    return UpsertResult(df_stg=df_stg_distinct,
+                        df_mstr_new=df_mstr_new,
+                        stg_row_count=len(df_stg.index),
+                        update_count=int(mstr_updated.sum()),
+                        new_record_count=int(stg_new.sum()),
+                        unchanged_count=unchanged_count,
+                        df_change_set=df_change_set,
+                        mstr_row_positions=mstr_row_positions)
+
+
+def partial_upsert_each(df_mstr, stg_frames, key_columns):
+    """
+    Applies each stg dataframe to the mstr in turn with partial_upsert, for stg files that may each have different
+    columns. Returns an UpsertResult with the last mstr and the counts of every step added up.
+    """
+    df_mstr_new = df_mstr
+    results = []
+    for df_stg in stg_frames:
+        results.append(partial_upsert(df_mstr_new, df_stg, key_columns))
+        df_mstr_new = results[-1].df_mstr_new
+    return UpsertResult(df_stg=pandas.concat([result.df_stg for result in results] or [df_mstr.iloc[0:0]],
+                                             ignore_index=True),
+                        df_mstr_new=df_mstr_new,
+                        stg_row_count=sum(result.stg_row_count for result in results),
+                        update_count=sum(result.update_count for result in results),
+                        new_record_count=sum(result.new_record_count for result in results),
+                        unchanged_count=sum(result.unchanged_count for result in results))
+
+
+def upsert_file_type(df_mstr, df_stg, file_type, stage_timer=None):
+    """
+    Runs upsert, or partial_upsert when the file type's update mode is partial, with the key, dedupe and change
+    set settings of the file type.
+    """
+    if file_type.update_mode not in UPDATE_MODES:
+        raise ValueError('Unknown update mode: {}'.format(file_type.update_mode))
+    function = partial_upsert if file_type.update_mode == 'partial' else upsert
+    return function(df_mstr, df_stg, file_type.key_columns, file_type.dedupe_strategy, file_type.timestamp_column,
+                    stage_timer, file_type.write_change_set)
+
+
+def dedupe_file_type(df_stg, file_type, stage_timer=None):
+    """
+    Runs dedupe with the key and dedupe settings of the file type.
+    """
+    return dedupe(df_stg, file_type.key_columns, file_type.dedupe_strategy, file_type.timestamp_column, stage_timer)